@@ -0,0 +1,12 @@
+"""
+Client library of the instrument socket protocol, shared by the bridges
+(socket-mqtt, opcua-socket) and the test client.
+"""
+from instrument_client.codec import (ENCODINGS, available_encodings, decode_message,
+                                     encode_message)
+from instrument_client.aio import AsyncConnection
+from instrument_client.connection import Connection
+from instrument_client.pool import ConnectionPool
+
+__all__ = ["AsyncConnection", "Connection", "ConnectionPool", "ENCODINGS", "available_encodings",
+           "decode_message", "encode_message"]
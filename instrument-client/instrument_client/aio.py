@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Persistent, auto-reconnecting asyncio client connection to an instrument
+socket, for clients that talk to many instruments from one event loop.
+"""
+import asyncio
+import logging
+from collections import deque
+from instrument_client.codec import decode_message, encode_message
+from instrument_client.connection import HEADER, READ_SIZE
+
+__author__ = "Brent Maranzano"
+__license__ = "MIT"
+
+
+class AsyncConnection(object):
+    """asyncio counterpart of Connection:
+        1. start() opens the connection in a background task, which reopens
+           it with exponential backoff whenever it is lost. The framing (and
+           encoding) is negotiated after every connect, then the coroutine
+           on_connect is awaited (e.g. to subscribe again). Any error, also
+           of on_connect, drops the connection to be reopened.
+        2. One reader task reads every message. Responses complete the
+           requests in the order they were sent, so requests of several
+           tasks are pipelined on the connection. Messages pushed by the
+           instrument (with a "push" key) are queued for receive.
+        3. Every response has to arrive within timeout seconds, else the
+           connection is considered lost. A request whose response was lost
+           is only sent again if it is safe to repeat (retry=True), else
+           ConnectionError is raised.
+    """
+
+    def __init__(self, host, port, framing="length", encoding="json", timeout=10.0,
+                 connect_timeout=5.0, min_backoff=0.05, max_backoff=5.0,
+                 on_connect=None, push_queue_size=1000, logger=None):
+        """
+        Arguments
+        host (str): Name or IP address of the socket server.
+        port (int): Port number of the socket server.
+        framing (str): "newline" or "length" (see
+            serial-socket/instruments/framing.py).
+        encoding (str): One of instrument_client.codec.ENCODINGS.
+        timeout (float): Seconds to wait for a response.
+        connect_timeout (float): Seconds to wait for a connection.
+        min_backoff (float): Seconds before the first reconnection attempt.
+        max_backoff (float): Maximum seconds between reconnection attempts.
+        on_connect (coroutine function): Awaited with the connection after
+            every (re)connect.
+        push_queue_size (int): Maximum number of unread pushes (the oldest
+            push is dropped beyond that).
+        logger (logging.Logger): Logger (default the module logger).
+        """
+        if framing not in ("newline", "length"):
+            raise ValueError("unsupported framing: {}".format(framing))
+        self._host = host
+        self._port = port
+        self._framing = framing
+        self._encoding = encoding
+        self._timeout = timeout
+        self._connect_timeout = connect_timeout
+        self._min_backoff = min_backoff
+        self._max_backoff = max_backoff
+        self._on_connect = on_connect
+        self._push_queue_size = push_queue_size
+        self._logger = logger or logging.getLogger(__name__)
+        self._reader = None
+        self._writer = None
+        # Futures of the requests waiting for their response, oldest first.
+        self._pending = deque()
+        self._pushes = None
+        self._connected = None
+        self._task = None
+
+    async def start(self):
+        """Start connecting in the background."""
+        self._pushes = asyncio.Queue(maxsize=self._push_queue_size)
+        self._connected = asyncio.Event()
+        self._task = asyncio.ensure_future(self._maintain())
+
+    async def close(self):
+        """Close the connection for good."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._disconnect(ConnectionError("connection closed"))
+
+    async def request(self, message, retry=False):
+        """Send a request and wait for its response.
+
+        Arguments
+        message (dict): The request.
+        retry (bool): Send the request again if its response was lost.
+
+        Returns the response.
+        """
+        while True:
+            await self._connected.wait()
+            future = asyncio.get_event_loop().create_future()
+            self._pending.append(future)
+            self._writer.write(self._frame(message))
+            try:
+                await self._writer.drain()
+                return await asyncio.wait_for(future, self._timeout)
+            except (OSError, asyncio.TimeoutError) as err:
+                if isinstance(err, asyncio.TimeoutError):
+                    err = ConnectionError("no response within {} s".format(self._timeout))
+                    self._abort()
+                if not retry:
+                    raise err
+                self._logger.warning("resending request to {}:{}: {}".format(
+                    self._host, self._port, err))
+
+    async def receive(self):
+        """Wait for the next message pushed by the instrument.
+
+        Returns the message.
+        """
+        return await self._pushes.get()
+
+    async def _maintain(self):
+        """Open the connection and read from it, reopening it with
+        exponential backoff whenever it is lost. Runs as a task.
+        """
+        delay = self._min_backoff
+        while True:
+            reader_task = None
+            try:
+                await self._open()
+                reader_task = asyncio.ensure_future(self._read_messages())
+                self._connected.set()
+                if self._on_connect is not None:
+                    await self._on_connect(self)
+                delay = self._min_backoff
+                await reader_task
+            except asyncio.CancelledError:
+                if reader_task is not None:
+                    reader_task.cancel()
+                raise
+            except (OSError, ValueError, asyncio.IncompleteReadError,
+                    asyncio.TimeoutError) as err:
+                if reader_task is not None:
+                    reader_task.cancel()
+                self._disconnect(ConnectionError(str(err) or type(err).__name__))
+                self._logger.warning("connection to {}:{} lost ({}), retry in {:.2f} s".format(
+                    self._host, self._port, err, delay))
+            except Exception as err:
+                # e.g. on_connect failed on an unexpected response.
+                if reader_task is not None:
+                    reader_task.cancel()
+                self._disconnect(ConnectionError(str(err) or type(err).__name__))
+                self._logger.exception("connection to {}:{} failed, retry in {:.2f} s".format(
+                    self._host, self._port, delay))
+            await asyncio.sleep(delay)
+            delay = min(2 * delay, self._max_backoff)
+
+    async def _open(self):
+        """Connect and negotiate the framing and encoding."""
+        self._reader, self._writer = await asyncio.wait_for(
+            asyncio.open_connection(self._host, self._port), self._connect_timeout)
+        # Requested (and answered) in the legacy framing.
+        self._writer.write(encode_message(self._setting("set_framing", self._framing)))
+        received = decode_message(await asyncio.wait_for(
+            self._reader.read(READ_SIZE), self._timeout))
+        if received.get("framing") != self._framing:
+            raise ValueError("socket refused framing: {}".format(received))
+        if self._encoding != "json":
+            self._writer.write(self._frame(self._setting("set_encoding", self._encoding), "json"))
+            received = await asyncio.wait_for(self._read_message("json"), self._timeout)
+            if received.get("encoding") != self._encoding:
+                raise ValueError("socket refused encoding: {}".format(received))
+        self._logger.info("connected to socket {}:{} ({}, {})".format(
+            self._host, self._port, self._framing, self._encoding))
+
+    def _setting(self, command_name, parameters):
+        """Returns (dict) a connection setting request."""
+        return {
+            "user": None,
+            "password": None,
+            "command": {
+                "command_name": command_name,
+                "parameters": parameters
+            }
+        }
+
+    async def _read_messages(self):
+        """Hand every message read to its request, or to the push queue."""
+        while True:
+            try:
+                received = await self._read_message()
+            except (OSError, ValueError, asyncio.IncompleteReadError) as err:
+                # Fail the waiting requests right away, even on_connect's.
+                self._fail_pending(ConnectionError(str(err) or type(err).__name__))
+                raise
+            if isinstance(received, dict) and "push" in received:
+                if self._pushes.full():
+                    self._pushes.get_nowait()
+                self._pushes.put_nowait(received)
+                continue
+            while self._pending:
+                future = self._pending.popleft()
+                if not future.done():
+                    future.set_result(received)
+                    break
+
+    async def _read_message(self, encoding=None):
+        """Read and decode one message."""
+        if self._framing == "length":
+            size = HEADER.unpack(await self._reader.readexactly(HEADER.size))[0]
+            payload = await self._reader.readexactly(size)
+        else:
+            payload = b""
+            while not payload.strip():
+                payload = await self._reader.readuntil(b"\n")
+        return decode_message(payload.rstrip(b"\r\n") if self._framing == "newline" else payload,
+                              encoding or self._encoding)
+
+    def _frame(self, message, encoding=None):
+        """Returns (bytes) the framed message."""
+        payload = encode_message(message, encoding or self._encoding)
+        if self._framing == "length":
+            return HEADER.pack(len(payload)) + payload
+        return payload + b"\n"
+
+    def _abort(self):
+        """Drop the connection, so that it is reopened."""
+        if self._writer is not None:
+            self._writer.transport.abort()
+
+    def _disconnect(self, err):
+        """Close the connection and fail the waiting requests."""
+        if self._connected is not None:
+            self._connected.clear()
+        if self._writer is not None:
+            self._writer.transport.abort()
+        self._reader = None
+        self._writer = None
+        self._fail_pending(err)
+
+    def _fail_pending(self, err):
+        """Fail the requests waiting for a response."""
+        while self._pending:
+            future = self._pending.popleft()
+            if not future.done():
+                future.set_exception(err)
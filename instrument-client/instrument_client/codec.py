@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Message encodings of the instrument socket protocol (the client side of
+serial-socket/instruments/codec.py), plus the "raw" encoding for servers
+that exchange plain text.
+    "json"    - JSON text.
+    "msgpack" - MessagePack (requires the msgpack package).
+    "cbor"    - CBOR (requires the cbor2 package).
+    "raw"     - Text (str) sent and received as UTF-8, no serialization.
+"""
+import json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+__author__ = "Brent Maranzano"
+__license__ = "MIT"
+
+
+ENCODINGS = ("json", "msgpack", "cbor", "raw")
+
+
+def available_encodings():
+    """Returns (tuple) the encodings whose package is installed."""
+    installed = {"msgpack": msgpack is not None, "cbor": cbor2 is not None}
+    return tuple(encoding for encoding in ENCODINGS if installed.get(encoding, True))
+
+
+def encode_message(message, encoding="json"):
+    """Serialize a message.
+
+    Arguments
+    message (dict|str): Message to serialize (str for "raw").
+    encoding (str): One of available_encodings().
+
+    Returns (bytes) the serialized message.
+    """
+    if encoding == "msgpack":
+        return msgpack.packb(message, use_bin_type=True)
+    elif encoding == "cbor":
+        return cbor2.dumps(message)
+    elif encoding == "raw":
+        return message if isinstance(message, bytes) else message.encode("UTF-8")
+    return json.dumps(message).encode("ascii")
+
+
+def decode_message(payload, encoding="json"):
+    """Deserialize a message.
+
+    Arguments
+    payload (bytes): Serialized message.
+    encoding (str): One of available_encodings().
+
+    Returns the deserialized message (str for "raw").
+    """
+    if encoding == "msgpack":
+        return msgpack.unpackb(payload, raw=False)
+    elif encoding == "cbor":
+        return cbor2.loads(payload)
+    elif encoding == "raw":
+        return payload.decode("UTF-8")
+    return json.loads(payload.decode("UTF-8"))
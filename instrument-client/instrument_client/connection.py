@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Persistent, auto-reconnecting client connection to an instrument socket.
+"""
+import select
+import socket
+import struct
+import logging
+import threading
+from collections import deque
+from time import sleep, monotonic
+from instrument_client.codec import decode_message, encode_message
+
+__author__ = "Brent Maranzano"
+__license__ = "MIT"
+
+# Length prefix of the "length" framing of the instrument socket protocol.
+HEADER = struct.Struct("!I")
+READ_SIZE = 65536
+
+
+class Connection(object):
+    """Client connection to an instrument socket (or any socket server that
+    answers every request with one response) that is kept open between
+    requests.
+        1. The connection is opened on first use. If it can not be opened,
+           or is lost, it is reopened with exponential backoff (min_backoff,
+           doubling up to max_backoff) until it succeeds or retry_timeout
+           expires. The framing (and encoding) is negotiated after every
+           connect, then on_connect is called (e.g. to subscribe again).
+        2. Every response has to arrive within timeout seconds, else the
+           connection is considered lost.
+        3. A request that could not be sent is sent again on the new
+           connection. A request whose response was lost is only sent again
+           if it is safe to repeat (retry=True), else ConnectionError is
+           raised, as the instrument may have executed it.
+        4. Several requests can be pipelined (sent back to back) and their
+           responses are read in order.
+        5. Messages pushed by the instrument (with a "push" key) that arrive
+           while waiting for a response are kept for receive.
+    Framing "legacy" (one read is one message) with encoding "raw" talks to
+    plain text socket servers. A connection is thread safe, requests from
+    several threads are serialized (see ConnectionPool to run them in
+    parallel).
+    """
+
+    def __init__(self, host, port, framing="length", encoding="json", timeout=10.0,
+                 connect_timeout=5.0, min_backoff=0.05, max_backoff=5.0,
+                 retry_timeout=None, on_connect=None, logger=None):
+        """
+        Arguments
+        host (str): Name or IP address of the socket server.
+        port (int): Port number of the socket server.
+        framing (str): "legacy", "newline" or "length" (see
+            serial-socket/instruments/framing.py).
+        encoding (str): One of instrument_client.codec.ENCODINGS.
+        timeout (float): Seconds to wait for a response.
+        connect_timeout (float): Seconds to wait for a connection.
+        min_backoff (float): Seconds before the first reconnection attempt.
+        max_backoff (float): Maximum seconds between reconnection attempts.
+        retry_timeout (float): Seconds to keep trying to connect before
+            raising ConnectionError, None to try forever.
+        on_connect (function): Called with the connection after every
+            (re)connect.
+        logger (logging.Logger): Logger (default the module logger).
+        """
+        self._host = host
+        self._port = port
+        self._framing = framing
+        self._encoding = encoding
+        self._timeout = timeout
+        self._connect_timeout = connect_timeout
+        self._min_backoff = min_backoff
+        self._max_backoff = max_backoff
+        self._retry_timeout = retry_timeout
+        self._on_connect = on_connect
+        self._logger = logger or logging.getLogger(__name__)
+        self._sock = None
+        self._buffer = bytearray()
+        self._pushes = deque()
+        # Reentrant, so that on_connect can send requests.
+        self._lock = threading.RLock()
+
+    def connect(self):
+        """Open the connection if it is not open, retrying with exponential
+        backoff.
+        """
+        with self._lock:
+            if self._sock is not None:
+                return
+            delay = self._min_backoff
+            start = monotonic()
+            while True:
+                try:
+                    self._open()
+                    if self._on_connect is not None:
+                        self._on_connect(self)
+                    return
+                except ValueError:
+                    # Refused settings do not improve by retrying.
+                    self.close()
+                    raise
+                except OSError as err:
+                    self.close()
+                    if (self._retry_timeout is not None
+                            and monotonic() - start + delay > self._retry_timeout):
+                        raise ConnectionError("could not connect to {}:{}: {}".format(
+                            self._host, self._port, err))
+                    self._logger.warning("could not connect to {}:{} ({}), retry in {:.2f} s"
+                                         .format(self._host, self._port, err, delay))
+                    sleep(delay)
+                    delay = min(2 * delay, self._max_backoff)
+
+    def _open(self):
+        """Connect the socket and negotiate the framing and encoding."""
+        sock = socket.create_connection((self._host, self._port), timeout=self._connect_timeout)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.settimeout(self._timeout)
+        self._sock = sock
+        self._buffer = bytearray()
+        if self._framing != "legacy":
+            # Requested (and answered) in the legacy framing.
+            received = self._negotiate("set_framing", self._framing, "legacy", "json")
+            if received.get("framing") != self._framing:
+                raise ValueError("socket refused framing: {}".format(received))
+        if self._encoding not in ("json", "raw"):
+            received = self._negotiate("set_encoding", self._encoding, self._framing, "json")
+            if received.get("encoding") != self._encoding:
+                raise ValueError("socket refused encoding: {}".format(received))
+        self._logger.info("connected to socket {}:{} ({}, {})".format(
+            self._host, self._port, self._framing, self._encoding))
+
+    def _negotiate(self, command_name, parameters, framing, encoding):
+        """Send a connection setting request and wait for its response.
+
+        Returns (dict) the response.
+        """
+        message = {
+            "user": None,
+            "password": None,
+            "command": {
+                "command_name": command_name,
+                "parameters": parameters
+            }
+        }
+        self._send(message, framing, encoding)
+        return self._receive(framing, encoding)
+
+    def close(self):
+        """Close the connection. It is reopened by the next request."""
+        with self._lock:
+            if self._sock is not None:
+                try:
+                    self._sock.close()
+                except OSError:
+                    pass
+            self._sock = None
+            self._buffer = bytearray()
+
+    def request(self, message, retry=False):
+        """Send a request and wait for its response.
+
+        Arguments
+        message (dict|str): The request (str for the "raw" encoding).
+        retry (bool): Send the request again if its response was lost.
+
+        Returns the response.
+        """
+        return self.pipeline([message], retry)[0]
+
+    def pipeline(self, messages, retry=False):
+        """Send several requests back to back and wait for their responses.
+
+        Arguments
+        messages (list): The requests.
+        retry (bool): Send the requests again if a response was lost.
+
+        Returns (list) the responses, in the order of the requests.
+        """
+        with self._lock:
+            while True:
+                if self._sock is not None and self._closed_by_server():
+                    self._logger.info("socket {}:{} closed while idle, reconnecting".format(
+                        self._host, self._port))
+                    self.close()
+                self.connect()
+                sent = 0
+                try:
+                    for message in messages:
+                        self._send(message)
+                        sent += 1
+                    return [self._receive_response() for _ in messages]
+                except OSError as err:
+                    self.close()
+                    self._logger.warning("lost connection to {}:{}: {}".format(
+                        self._host, self._port, err))
+                    if sent and not retry:
+                        raise ConnectionError(
+                            "connection lost before the response was received: {}".format(err))
+
+    def receive(self, timeout=None):
+        """Wait for the next message sent by the server without a request
+        (e.g. a data push of a subscribed connection). A lost connection is
+        reopened (and on_connect called) and the wait continues.
+
+        Arguments
+        timeout (float): Seconds without a message after which the
+            connection is considered lost, None to wait forever.
+
+        Returns the message.
+        """
+        with self._lock:
+            while True:
+                if self._pushes:
+                    return self._pushes.popleft()
+                self.connect()
+                try:
+                    self._sock.settimeout(timeout)
+                    try:
+                        return self._receive()
+                    finally:
+                        if self._sock is not None:
+                            self._sock.settimeout(self._timeout)
+                except OSError as err:
+                    self.close()
+                    self._logger.warning("lost connection to {}:{}: {}".format(
+                        self._host, self._port, err))
+
+    def _closed_by_server(self):
+        """Check, without blocking, if the server closed the idle connection
+        (e.g. after a restart), so that the next request is not lost on it.
+
+        Returns (bool) True if the connection is closed.
+        """
+        try:
+            readable = select.select([self._sock], [], [], 0)[0]
+            return bool(readable) and not self._sock.recv(1, socket.MSG_PEEK)
+        except OSError:
+            return True
+
+    def _send(self, message, framing=None, encoding=None):
+        """Frame and send a message."""
+        framing = framing or self._framing
+        payload = encode_message(message, encoding or self._encoding)
+        if framing == "length":
+            payload = HEADER.pack(len(payload)) + payload
+        elif framing == "newline":
+            payload = payload + b"\n"
+        self._sock.sendall(payload)
+
+    def _receive_response(self):
+        """Read the next message that is not a push."""
+        while True:
+            received = self._receive()
+            if not (isinstance(received, dict) and "push" in received):
+                return received
+            self._pushes.append(received)
+
+    def _receive(self, framing=None, encoding=None):
+        """Read and decode one message."""
+        framing = framing or self._framing
+        if framing == "length":
+            size = HEADER.unpack(self._read_exactly(HEADER.size))[0]
+            payload = self._read_exactly(size)
+        elif framing == "newline":
+            payload = b""
+            while not payload:
+                index = self._buffer.find(b"\n")
+                while index < 0:
+                    self._fill()
+                    index = self._buffer.find(b"\n")
+                payload = bytes(self._buffer[:index]).rstrip(b"\r")
+                del self._buffer[:index + 1]
+        else:
+            if not self._buffer:
+                self._fill()
+            payload = bytes(self._buffer)
+            self._buffer = bytearray()
+        return decode_message(payload, encoding or self._encoding)
+
+    def _read_exactly(self, size):
+        """Read exactly size bytes."""
+        while len(self._buffer) < size:
+            self._fill()
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def _fill(self):
+        """Read the available bytes into the buffer."""
+        chunk = self._sock.recv(READ_SIZE)
+        if not chunk:
+            raise ConnectionResetError("socket closed by server")
+        self._buffer.extend(chunk)
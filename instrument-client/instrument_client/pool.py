@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Pool of persistent connections to an instrument socket.
+"""
+import threading
+from contextlib import contextmanager
+from instrument_client.connection import Connection
+
+__author__ = "Brent Maranzano"
+__license__ = "MIT"
+
+
+class ConnectionPool(object):
+    """Up to size Connections to one socket server, so that requests of
+    several threads run in parallel. Connections are created on demand and
+    kept open; the most recently used idle connection is reused first, so
+    that rarely needed connections can time out on the server side without
+    being used. A thread waits if all connections are busy.
+    """
+
+    def __init__(self, host, port, size=2, **options):
+        """
+        Arguments
+        host (str): Name or IP address of the socket server.
+        port (int): Port number of the socket server.
+        size (int): Maximum number of connections.
+        options: Connection options (see Connection).
+        """
+        if size < 1:
+            raise ValueError("size must be at least 1: {}".format(size))
+        self._host = host
+        self._port = port
+        self._options = options
+        self._size = size
+        self._idle = []
+        self._created = 0
+        self._closed = False
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection for the duration of the with block."""
+        connection = self._acquire()
+        try:
+            yield connection
+        finally:
+            self._release(connection)
+
+    def request(self, message, retry=False):
+        """Send a request on a pooled connection (see Connection.request)."""
+        with self.connection() as connection:
+            return connection.request(message, retry)
+
+    def pipeline(self, messages, retry=False):
+        """Send requests on a pooled connection (see Connection.pipeline)."""
+        with self.connection() as connection:
+            return connection.pipeline(messages, retry)
+
+    def close(self):
+        """Close the idle connections; busy ones are closed when released."""
+        with self._condition:
+            self._closed = True
+            for connection in self._idle:
+                connection.close()
+            self._created -= len(self._idle)
+            self._idle = []
+            self._condition.notify_all()
+
+    def _acquire(self):
+        """Take an idle connection, or create one if the pool is not full."""
+        with self._condition:
+            while True:
+                if self._closed:
+                    raise ConnectionError("connection pool is closed")
+                if self._idle:
+                    return self._idle.pop()
+                if self._created < self._size:
+                    self._created += 1
+                    return Connection(self._host, self._port, **self._options)
+                self._condition.wait()
+
+    def _release(self, connection):
+        """Return a connection to the pool."""
+        with self._condition:
+            if self._closed:
+                connection.close()
+                self._created -= 1
+            else:
+                self._idle.append(connection)
+            self._condition.notify()
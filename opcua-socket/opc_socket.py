@@ -4,7 +4,6 @@
 Service to interchange information between Delta V OPC UA server and Waters'
 Empower socket API
 """
-import socket
 import argparse
 import logging
 import logging.config
@@ -14,6 +13,7 @@ import threading
 from time import sleep
 from opcua import Client, ua
 from opc_tags import tags_dict
+from instrument_client import Connection
 from numpy import random
 
 __author__ = 'Giuseppe Cogoni'
@@ -38,27 +38,20 @@ class OpcSocket(object):
 
 
     def _connect_socket(self, host, port):
-        """Connect to socket. Note that the socket is left
-        as blocking and shouldn't be modified unless a selector
-        is used.
+        """Open a persistent connection to the socket, that is reopened
+        (with backoff) if it is lost. The socket exchanges plain text, one
+        read per message.
 
         Arguments:
         host (string): hostname or IP address of host.
         port (int): Socket server port number.
 
-        Returns a socket connection.
+        Returns (Connection) the socket connection.
         """
-        try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.connect((host, port))
-        except socket.error as err:
-            self._logger.error(
-                    "Failed to connect to socket {}:{}".format(host, port))
-            raise err
-        else:
-            self._logger.info(
-                    "Connected to socket host: {}, port: {}".format(host, port))
-        return sock
+        connection = Connection(host, port, framing="legacy", encoding="raw",
+                                logger=self._logger)
+        connection.connect()
+        return connection
 
 
     def run_command(self, command=''):
@@ -72,8 +65,7 @@ class OpcSocket(object):
         """
 
         self._logger.debug('OPC-socket sending message...')
-        self._sock.sendall(command.encode())
-        data = self._sock.recv(1024).decode(encoding='UTF-8')
+        data = self._sock.request(command)
         self._logger.debug('OPC-socket received the return: {}'.format(data))
         return data
 
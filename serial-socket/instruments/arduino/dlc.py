@@ -7,7 +7,8 @@ dynamic load cell (dlc).
 import logging
 import argparse
 from serial import Serial
-from instrument import SerialInstrument
+from instrument import SerialInstrument, add_instrument_arguments, instrument_options
+from arduino.stream import FrameReader, SampleRing
 
 
 __author__ = "Brent Maranzano"
@@ -24,13 +25,34 @@ class Dlc(SerialInstrument):
            _connect_instrument
            _update_data
            _set_about
+           _start_threads
+       The serial stream is read continuously by a FrameReader thread into
+       a ring buffer of the latest samples (buffer_frames frames), and the
+       statistics are calculated on the latest frame worth of samples at
+       every data update. The instrument_status reports a failed serial
+       port until the reader reopened it.
        Only the .set_SP_speed should be called from a user command, as
        the retrieving the current instrument values will automatically
        be performed by the Instrument class methods.
     """
 
-    def __init__(self, instrument_port, socket_ip, socket_port, host):
-        super(Dlc, self).__init__(instrument_port, socket_ip, socket_port, host)
+    def __init__(self, instrument_port, socket_ip, socket_port, host,
+                 number_pts=800, frame_marker=None, buffer_frames=16, **options):
+        """
+        Arguments (in addition to SerialInstrument)
+        number_pts (int): Number of samples in a frame of the Arduino.
+        frame_marker (bytes|str): Marker (or its hex string) at the start of
+            every frame, None if the firmware sends no marker.
+        buffer_frames (int): Number of frames kept in the ring buffer.
+        """
+        super(Dlc, self).__init__(instrument_port, socket_ip, socket_port, host,
+                                  **options)
+        if isinstance(frame_marker, str):
+            frame_marker = bytes.fromhex(frame_marker)
+        self._number_pts = number_pts
+        self._samples = SampleRing(buffer_frames * number_pts)
+        self._reader = FrameReader(self._instrument, self._samples, number_pts,
+                                   frame_marker, self._logger)
         # Set information about the attached device.
         self._device_information = {
             "instrument": "Arduino - DLC",
@@ -40,7 +62,9 @@ class Dlc(SerialInstrument):
         }
         self._data = {
             "PV": [],
-            "VAR": 0.0
+            "VAR": 0.0,
+            "SAMPLES": 0,
+            "RESYNCS": 0
         }
 
     def _connect_instrument(self, port):
@@ -61,43 +85,61 @@ class Dlc(SerialInstrument):
             self._logger.info("Connected to instrument on port {}".format(port))
         return connection
 
+    def _start_threads(self):
+        """Start reading the sample stream before the base class threads.
+        """
+        self._reader.start()
+        super(Dlc, self)._start_threads()
+
     def _update_data(self):
         """Update the data from the dynamic load cell.
 
         Returns dictionary of data
         """
         voltage = self._get_PV()
-        self._calculate_statistics(voltage)
+        if len(voltage) > 0:
+            self._calculate_statistics(voltage)
+        self._data["SAMPLES"] = self._samples.count
+        self._data["RESYNCS"] = self._reader.resyncs
+        # An error while the serial port fails, until it is reopened.
+        self._instrument_status = self._reader.status
         return self._data
 
-    def _get_PV(self, number_pts=800):
-        """Get the present value array from the DLC
+    def _get_PV(self, number_pts=None):
+        """Get the latest samples of the DLC from the ring buffer.
 
         Arguments
-        number_pts (int): Number of points to expected in the buffer.
-            Note that the number must coincide with the
-            Arduino output or the byte order may not be correct.
+        number_pts (int): Number of samples (default one frame, at most
+            the ring buffer).
 
-        Return (array): last full buffer read of the load cell data.
+        Return (numpy.ndarray): the latest samples of the load cell data,
+            fewer before enough samples were received.
         """
-        data = [int(self._instrument.read(2).hex(), 16)
-                for i in range(number_pts)]
-        return data
+        if number_pts is None:
+            number_pts = self._number_pts
+        return self._samples.window(number_pts)
 
     def _calculate_statistics(self, data):
         """Caclulate the statistics of the time series pressure fluctuations.
         Function directly modifies the class variable self._data.
+        The skewness and the (excess) kurtosis are normalized by the
+        variance, as scipy.stats.skew and scipy.stats.kurtosis. Both are 0
+        for a constant signal.
 
         Arguments
-        data (list): Time series data of pressure points.
+        data (numpy.ndarray): Time series data of pressure points.
         """
-        mean = sum(data)/len(data)
-        self._data["VAR"] = sum([(d-mean)**2 for d in data])/len(data)
-        self._data["SKEW"] = sum([(d-mean)**3 for d in data])/len(data)
-        self._data["KURTOSIS"] = sum([(d-mean)**4 for d in data])/len(data)
-        #self._data["VAR"] = var(data)
-        #self._data["SKEW"] = skew(data)
-        #self._data["KURTOSIS"] = kurtosis(data)
+        deviation = data - data.mean()
+        squared = deviation * deviation
+        var = squared.mean()
+        skew = 0.0
+        kurtosis = 0.0
+        if var > 0:
+            skew = (squared * deviation).mean() / var**1.5
+            kurtosis = (squared * squared).mean() / var**2 - 3.0
+        self._data["VAR"] = float(var)
+        self._data["SKEW"] = float(skew)
+        self._data["KURTOSIS"] = float(kurtosis)
 
 
 if __name__ == "__main__":
@@ -126,7 +168,28 @@ if __name__ == "__main__":
         type=str,
         default="ape-53"
     )
+    parser.add_argument(
+        "--number_pts",
+        help="number of samples in a frame of the Arduino",
+        type=int,
+        default=800
+    )
+    parser.add_argument(
+        "--frame_marker",
+        help="hex string of the marker at the start of every frame (e.g. a55a)",
+        type=str,
+        default=None
+    )
+    parser.add_argument(
+        "--buffer_frames",
+        help="number of frames kept in the sample ring buffer",
+        type=int,
+        default=16
+    )
+    add_instrument_arguments(parser)
     args = parser.parse_args()
     instrument = Dlc(args.instrument_port, args.socket_ip,
-        args.socket_port, args.host)
+        args.socket_port, args.host, number_pts=args.number_pts,
+        frame_marker=args.frame_marker, buffer_frames=args.buffer_frames,
+        **instrument_options(args))
     instrument.run()
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Continuous acquisition of the sample stream of the Arduino DLC.
+
+The Arduino sends frames of big-endian unsigned 16 bit samples. If the
+firmware starts every frame with a marker (e.g. b"\\xa5\\x5a"), the reader
+finds the frame boundaries itself and recovers from lost or corrupted bytes:
+a frame is only accepted once the marker of the next frame follows it.
+Without a marker the frames are assumed to be back to back and aligned with
+the start of the stream.
+"""
+import threading
+from time import sleep
+from numpy import concatenate, empty, frombuffer
+
+__author__ = "Brent Maranzano"
+__license__ = "MIT"
+
+# Seconds between attempts to reopen the serial port after it failed.
+REOPEN_DELAY = 2.0
+
+
+class SampleRing(object):
+    """Thread safe ring buffer of the most recent samples."""
+
+    def __init__(self, capacity, dtype="u2"):
+        """
+        Arguments
+        capacity (int): Number of samples kept.
+        dtype (str): numpy data type of the samples.
+        """
+        self._buffer = empty(capacity, dtype=dtype)
+        self._capacity = capacity
+        # Number of samples ever written.
+        self._count = 0
+        self._lock = threading.Lock()
+
+    @property
+    def count(self):
+        """Number of samples written since the start."""
+        return self._count
+
+    def extend(self, samples):
+        """Append samples, overwriting the oldest ones.
+
+        Arguments
+        samples (numpy.ndarray): Samples to append.
+        """
+        with self._lock:
+            total = self._count + len(samples)
+            if len(samples) > self._capacity:
+                samples = samples[-self._capacity:]
+            start = (total - len(samples)) % self._capacity
+            first = min(len(samples), self._capacity - start)
+            self._buffer[start:start + first] = samples[:first]
+            self._buffer[:len(samples) - first] = samples[first:]
+            self._count = total
+
+    def window(self, size):
+        """Get the most recent samples in the order they were received.
+
+        Arguments
+        size (int): Number of samples (at most the capacity).
+
+        Returns (numpy.ndarray) a copy of the samples, fewer than size if
+            not enough samples were received yet.
+        """
+        with self._lock:
+            size = min(size, self._count, self._capacity)
+            end = self._count % self._capacity
+            start = end - size
+            if start >= 0:
+                return self._buffer[start:end].copy()
+            return concatenate((self._buffer[start:], self._buffer[:end]))
+
+
+class FrameReader(object):
+    """Reads the sample stream of the DLC in a daemon thread and appends
+    every complete frame to a SampleRing, so no samples are lost in between
+    data updates. If the serial port fails (e.g. the USB cable is
+    unplugged), status reports the error and the port is reopened every
+    REOPEN_DELAY seconds until it works again.
+    """
+
+    def __init__(self, serial, ring, number_pts, marker=None, logger=None):
+        """
+        Arguments
+        serial (serial.Serial): Connection to the Arduino.
+        ring (SampleRing): Ring buffer that receives the samples.
+        number_pts (int): Number of samples per frame.
+        marker (bytes): Marker at the start of every frame, or None.
+        logger (logging.Logger): Logger of the instrument.
+        """
+        self._serial = serial
+        self._ring = ring
+        self._frame_bytes = 2 * number_pts
+        self._marker = marker or b""
+        self._logger = logger
+        # A marker found after losing the frame boundaries is only trusted
+        # once the next frame starts with a marker as well.
+        self._synchronized = False
+        self.frames = 0
+        self.resyncs = 0
+        # "ok", or the error of the serial port while it is failing.
+        self.status = "ok"
+        self._thread = threading.Thread(target=self._read_stream, daemon=True)
+
+    def start(self):
+        """Start reading the stream."""
+        self._thread.start()
+
+    def _read_stream(self):
+        """Read whatever the Arduino has sent and extract the frames, for as
+        long as the instrument is connected.
+        """
+        buffer = bytearray()
+        while True:
+            try:
+                if not self._serial.is_open:
+                    self._serial.open()
+                    self.status = "ok"
+                    self._log("info", "reopened the DLC serial port")
+                buffer.extend(self._serial.read(self._serial.in_waiting or 1))
+            # serial.SerialException is an OSError.
+            except OSError as err:
+                if self.status == "ok":
+                    self._log("error", "DLC serial port failed: {}".format(err))
+                self.status = "error: DLC serial port failed: {}".format(err)
+                del buffer[:]
+                self._synchronized = False
+                try:
+                    self._serial.close()
+                except OSError:
+                    pass
+                sleep(REOPEN_DELAY)
+                continue
+            self._extract_frames(buffer)
+
+    def _log(self, level, message):
+        """Log a message if the reader has a logger."""
+        if self._logger is not None:
+            getattr(self._logger, level)(message)
+
+    def _extract_frames(self, buffer):
+        """Move the complete frames at the start of the buffer to the ring
+        buffer, resynchronizing on the frame marker when the data between
+        frames is not a marker.
+
+        Arguments
+        buffer (bytearray): Bytes received and not yet processed (modified
+            in place).
+        """
+        marker = self._marker
+        frame_size = len(marker) + self._frame_bytes
+        while True:
+            if marker:
+                index = buffer.find(marker)
+                if index < 0:
+                    # Keep the bytes that could start a marker.
+                    del buffer[:max(0, len(buffer) - len(marker) + 1)]
+                    return
+                if index > 0:
+                    del buffer[:index]
+                    if self._synchronized:
+                        self._synchronized = False
+                        self.resyncs += 1
+                        if self._logger is not None:
+                            self._logger.warning(
+                                "lost DLC frame boundary, skipped {} bytes".format(index))
+                    continue
+                if not self._synchronized:
+                    if len(buffer) < frame_size + len(marker):
+                        return
+                    if buffer[frame_size:frame_size + len(marker)] != marker:
+                        # The marker was part of the samples.
+                        del buffer[:1]
+                        continue
+                    self._synchronized = True
+                else:
+                    # The frame is only complete if the next one follows.
+                    if len(buffer) < frame_size + len(marker):
+                        return
+                    if buffer[frame_size:frame_size + len(marker)] != marker:
+                        del buffer[:1]
+                        self._synchronized = False
+                        self.resyncs += 1
+                        if self._logger is not None:
+                            self._logger.warning("corrupted DLC frame, resynchronizing")
+                        continue
+            if len(buffer) < frame_size:
+                return
+            samples = frombuffer(bytes(buffer[len(marker):frame_size]), dtype=">u2")
+            del buffer[:frame_size]
+            self._ring.extend(samples)
+            self.frames += 1
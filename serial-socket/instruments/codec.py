@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Message encodings for the instrument socket protocol.
+
+Every connection starts in the "json" encoding. A client can negotiate a
+compact binary encoding with the "set_encoding" command, if the package of
+the encoding is installed on the instrument:
+    "json"    - JSON text (original behaviour).
+    "msgpack" - MessagePack (requires the msgpack package).
+    "cbor"    - CBOR (requires the cbor2 package).
+Binary encodings require the "length" framing, as the encoded messages may
+contain any byte (including newlines).
+"""
+import json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+__author__ = "Brent Maranzano"
+__license__ = "MIT"
+
+
+ENCODINGS = ("json", "msgpack", "cbor")
+BINARY_ENCODINGS = ("msgpack", "cbor")
+
+
+class EncodingError(Exception):
+    """Raised when a message can not be decoded with the negotiated
+    encoding."""
+
+
+def available_encodings():
+    """Returns (tuple) the encodings whose package is installed."""
+    installed = {"json": True, "msgpack": msgpack is not None, "cbor": cbor2 is not None}
+    return tuple(encoding for encoding in ENCODINGS if installed[encoding])
+
+
+def encode_message(message, encoding="json"):
+    """Serialize a message.
+
+    Arguments
+    message (dict): Message to serialize.
+    encoding (str): One of available_encodings().
+
+    Returns (bytes) the serialized message.
+    """
+    if encoding == "msgpack":
+        return msgpack.packb(message, use_bin_type=True)
+    elif encoding == "cbor":
+        return cbor2.dumps(message)
+    return json.dumps(message, ensure_ascii=True).encode(encoding="UTF-8")
+
+
+def decode_message(payload, encoding="json"):
+    """Deserialize a message.
+
+    Arguments
+    payload (bytes): Serialized message.
+    encoding (str): One of available_encodings().
+
+    Returns the deserialized message.
+    """
+    try:
+        if encoding == "msgpack":
+            return msgpack.unpackb(payload, raw=False)
+        elif encoding == "cbor":
+            return cbor2.loads(payload)
+        return json.loads(payload.decode("UTF-8"))
+    except Exception as err:
+        raise EncodingError("message not valid {}: {}".format(encoding, err))
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compares the size and the encode/decode time of the get_data response of
+each driver in every installed encoding (see codec.py), e.g.
+    python codec_benchmark.py --repeat 2000
+"""
+import argparse
+import random
+import timeit
+from codec import ENCODINGS, available_encodings, decode_message, encode_message
+
+__author__ = "Brent Maranzano"
+__license__ = "MIT"
+
+
+def sample_responses():
+    """Create a get_data response of each driver with representative
+    values.
+
+    Returns (dict) the responses by driver name.
+    """
+    common = {"user": "operator", "user_tag": "batch-42", "instrument_status": "ok"}
+    random.seed(0)
+    pressure = [random.randint(0, 65535) for _ in range(800)]
+    responses = {
+        "fake": {"status": "on", "SP1": 12, "SP2": 7, "PV1": 11.93, "PV2": 7.04},
+        "ika": {"SP_speed": 250.0, "PV_speed": 248.7},
+        "ismatec": {"SP": 1.5, "PV": 1.49, "MODE": "flowrate",
+                    "FLOWRATE": 1.49, "VOLUME": 12.7},
+        "arduino dlc": {"PV": pressure, "VAR": 2.1e8, "SKEW": 3.4e10,
+                        "KURTOSIS": 7.9e16},
+    }
+    for response in responses.values():
+        response.update(common)
+    return responses
+
+
+def benchmark(response, encoding, repeat):
+    """Measure one response in one encoding.
+
+    Arguments
+    response (dict): Response to encode.
+    encoding (str): Encoding to measure.
+    repeat (int): Number of encodes and decodes to time.
+
+    Returns (tuple) the encoded size in bytes and the mean encode and decode
+        times in microseconds.
+    """
+    payload = encode_message(response, encoding)
+    encode = timeit.timeit(lambda: encode_message(response, encoding), number=repeat)
+    decode = timeit.timeit(lambda: decode_message(payload, encoding), number=repeat)
+    return len(payload), 1e6 * encode / repeat, 1e6 * decode / repeat
+
+
+def main(repeat):
+    """Print the benchmark table of all drivers and installed encodings.
+
+    Arguments
+    repeat (int): Number of encodes and decodes to time per measurement.
+    """
+    encodings = available_encodings()
+    missing = [encoding for encoding in ENCODINGS if encoding not in encodings]
+    if missing:
+        print("not installed: {}".format(", ".join(missing)))
+    print("{:<12} {:<8} {:>7} {:>6} {:>10} {:>10}".format(
+        "driver", "encoding", "bytes", "size", "encode us", "decode us"))
+    for driver, response in sample_responses().items():
+        json_size = None
+        for encoding in encodings:
+            size, encode, decode = benchmark(response, encoding, repeat)
+            if json_size is None:
+                json_size = size
+            print("{:<12} {:<8} {:>7} {:>5.0f}% {:>10.1f} {:>10.1f}".format(
+                driver, encoding, size, 100.0 * size / json_size, encode, decode))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="instrument message codec benchmark")
+    parser.add_argument(
+        "--repeat",
+        help="number of encodes and decodes timed per measurement",
+        type=int,
+        default=1000
+    )
+    args = parser.parse_args()
+    main(args.repeat)
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Scheduling queue for the commands sent to a serial instrument.
+"""
+import heapq
+import itertools
+import queue
+import threading
+
+__author__ = "Brent Maranzano"
+__license__ = "MIT"
+
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+
+
+class CommandQueue(object):
+    """Thread safe command queue with priorities, coalescing and a bounded
+    depth.
+        1. Commands are returned by priority (lowest value first) and in
+           the order they were put within the same priority.
+        2. A command put with a higher priority cancels the pending commands
+           of lower priority (e.g. a stop cancels the queued setpoints and
+           starts), so they can not undo it after it ran.
+        3. A command put with a coalescing key replaces the pending command
+           with the same key (last write wins) if that is the most recently
+           put command, so only the most recent setpoint is sent and no
+           command overtakes the commands put before it.
+        4. Putting a new command into a full queue raises queue.Full, so
+           the caller can tell the client to back off.
+    """
+
+    def __init__(self, maxsize=0):
+        """
+        Arguments
+        maxsize (int): Maximum number of pending commands (0 is unbounded).
+        """
+        self._maxsize = maxsize
+        # Heap of [priority, sequence, item, key] entries.
+        self._heap = []
+        # Most recently put entry, while it is pending.
+        self._last = None
+        self._sequence = itertools.count()
+        self._not_empty = threading.Condition()
+
+    def put(self, item, priority=PRIORITY_NORMAL, key=None):
+        """Queue a command.
+
+        Arguments
+        item: The command.
+        priority (int): Priority of the command (lower is sooner).
+        key (hashable): Coalescing key, or None to never coalesce.
+
+        Returns (tuple) the pending command that was replaced by item (None
+            if none) and the list of pending commands cancelled by item,
+            oldest first.
+        """
+        with self._not_empty:
+            last = self._last
+            if key is not None and last is not None and last[3] == key and last[0] == priority:
+                replaced = last[2]
+                last[2] = item
+                return replaced, []
+            cancelled = sorted((entry for entry in self._heap if entry[0] > priority),
+                               key=lambda entry: entry[1])
+            if cancelled:
+                self._heap = [entry for entry in self._heap if entry[0] <= priority]
+                heapq.heapify(self._heap)
+            if self._maxsize > 0 and len(self._heap) >= self._maxsize:
+                raise queue.Full
+            entry = [priority, next(self._sequence), item, key]
+            heapq.heappush(self._heap, entry)
+            self._last = entry
+            self._not_empty.notify()
+        return None, [entry[2] for entry in cancelled]
+
+    def get(self):
+        """Remove and return the next command, waiting until one is
+        available.
+
+        Returns the command.
+        """
+        with self._not_empty:
+            while not self._heap:
+                self._not_empty.wait()
+            entry = heapq.heappop(self._heap)
+            if entry is self._last:
+                self._last = None
+            return entry[2]
+
+    def qsize(self):
+        """Returns (int) the number of pending commands."""
+        with self._not_empty:
+            return len(self._heap)
@@ -6,7 +6,7 @@ Simulates a fake serial instrument for testing the software stack.
 import logging
 import argparse
 import random
-from instrument import SerialInstrument
+from instrument import SerialInstrument, add_instrument_arguments, instrument_options
 
 __author__ = "Brent Maranzano"
 __license__ = "MIT"
@@ -21,8 +21,9 @@ class FakeInstrument(SerialInstrument):
            _update_data
     """
 
-    def __init__(self, instrument_port, socket_ip, socket_port, host):
-        super(FakeInstrument, self).__init__(instrument_port, socket_ip, socket_port, host)
+    def __init__(self, instrument_port, socket_ip, socket_port, host, **options):
+        super(FakeInstrument, self).__init__(instrument_port, socket_ip, socket_port, host,
+                                             **options)
         # Inhereted attribute
         self._device_information = {
             "instrument": "fake",
@@ -141,6 +142,8 @@ if __name__ == "__main__":
         type=str,
         default="ape-0"
     )
+    add_instrument_arguments(parser)
     args = parser.parse_args()
-    fake_instrument = FakeInstrument(args.instrument_port, args.socket_ip, args.socket_port, args.host)
+    fake_instrument = FakeInstrument(args.instrument_port, args.socket_ip, args.socket_port, args.host,
+        **instrument_options(args))
     fake_instrument.run()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Message framing for the instrument socket protocol.
+
+Every connection starts in the "legacy" framing, in which one socket read
+is treated as one message. A client can negotiate a real framing with the
+"set_framing" command:
+    "legacy"  - one read per message (no framing, original behaviour).
+    "newline" - each message is terminated by a single newline ("\\n").
+    "length"  - each message is prefixed by its length in bytes as a
+                4 byte big-endian unsigned integer.
+"""
+import struct
+import asyncio
+
+__author__ = "Brent Maranzano"
+__license__ = "MIT"
+
+
+FRAMINGS = ("legacy", "newline", "length")
+LEGACY_READ_SIZE = 4096
+MAX_MESSAGE_SIZE = 16 * 1024 * 1024
+HEADER = struct.Struct("!I")
+
+
+class FramingError(Exception):
+    """Raised when a frame violates the negotiated framing."""
+
+
+def encode_frame(payload, framing):
+    """Frame a message for sending.
+
+    Arguments
+    payload (bytes): Encoded message.
+    framing (str): One of FRAMINGS.
+
+    Returns (bytes) the framed message.
+    """
+    if framing == "length":
+        return HEADER.pack(len(payload)) + payload
+    elif framing == "newline":
+        return payload + b"\n"
+    return payload
+
+
+async def read_frame(reader, framing):
+    """Read one complete message from the stream. Partial reads are
+    buffered by the reader until the frame is complete.
+
+    Arguments
+    reader (asyncio.StreamReader): Stream of the connection.
+    framing (str): One of FRAMINGS.
+
+    Returns (bytes) the message without framing, or b"" if the
+    connection was closed.
+    """
+    if framing == "length":
+        try:
+            header = await reader.readexactly(HEADER.size)
+        except asyncio.IncompleteReadError:
+            return b""
+        size = HEADER.unpack(header)[0]
+        if size > MAX_MESSAGE_SIZE:
+            raise FramingError("frame of {} bytes exceeds limit".format(size))
+        try:
+            return await reader.readexactly(size)
+        except asyncio.IncompleteReadError:
+            return b""
+    elif framing == "newline":
+        # Blank lines (e.g. keep-alives) are skipped.
+        message = b""
+        while not message:
+            try:
+                message = await reader.readuntil(b"\n")
+            except asyncio.IncompleteReadError:
+                return b""
+            except asyncio.LimitOverrunError:
+                raise FramingError("line exceeds {} bytes".format(MAX_MESSAGE_SIZE))
+            message = message.rstrip(b"\r\n")
+        return message
+    return await reader.read(LEGACY_READ_SIZE)
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Bounded time-series history of the numeric instrument data fields.
+"""
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+
+__author__ = "Brent Maranzano"
+__license__ = "MIT"
+
+
+class FieldHistory(object):
+    """Ring buffer of the (timestamp, value) samples of one data field,
+    backed by two arrays of doubles.
+    """
+
+    def __init__(self, capacity):
+        """
+        Arguments
+        capacity (int): Number of samples kept.
+        """
+        self._capacity = capacity
+        self._timestamps = array("d", bytes(8 * capacity))
+        self._values = array("d", bytes(8 * capacity))
+        # Number of samples ever appended.
+        self._count = 0
+
+    def append(self, timestamp, value):
+        """Append a sample, overwriting the oldest one when full.
+
+        Arguments
+        timestamp (float): Time of the sample (seconds since the epoch).
+        value (float): Value of the field.
+        """
+        index = self._count % self._capacity
+        self._timestamps[index] = timestamp
+        self._values[index] = value
+        self._count += 1
+
+    def samples(self):
+        """Returns (tuple) the timestamps and the values (arrays), oldest
+        first."""
+        if self._count <= self._capacity:
+            return self._timestamps[:self._count], self._values[:self._count]
+        start = self._count % self._capacity
+        return (self._timestamps[start:] + self._timestamps[:start],
+                self._values[start:] + self._values[:start])
+
+
+class History(object):
+    """Thread safe history of every numeric data field. Written by the
+    update thread and read by the event loop.
+    """
+
+    def __init__(self, capacity):
+        """
+        Arguments
+        capacity (int): Number of samples kept per field.
+        """
+        self._capacity = capacity
+        self._fields = {}
+        self._lock = threading.Lock()
+
+    def record(self, timestamp, data):
+        """Append the numeric fields of a data update. Other fields (e.g.
+        strings, lists or booleans) are ignored.
+
+        Arguments
+        timestamp (float): Time of the update (seconds since the epoch).
+        data (dict): Instrument data.
+        """
+        with self._lock:
+            for field, value in data.items():
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                if field not in self._fields:
+                    self._fields[field] = FieldHistory(self._capacity)
+                self._fields[field].append(timestamp, value)
+
+    def fields(self):
+        """Returns (list) the names of the recorded fields."""
+        with self._lock:
+            return list(self._fields)
+
+    def query(self, field, since=None, until=None, max_points=None):
+        """Get the samples of a field within a time range. If there are
+        more than max_points samples, the range is split in max_points / 2
+        buckets of consecutive samples and the minimum and maximum sample of
+        each bucket are returned (in time order), so that only recorded
+        values are returned and peaks are kept. With max_points 1 the last
+        sample is returned.
+
+        Arguments
+        field (str): Name of the field.
+        since (float): Only samples at or after this time (default all).
+        until (float): Only samples at or before this time (default all).
+        max_points (int): Maximum number of points returned (default all).
+
+        Returns (tuple) the lists of timestamps and values, None if the
+            field was never recorded.
+        """
+        with self._lock:
+            if field not in self._fields:
+                return None
+            timestamps, values = self._fields[field].samples()
+        start = 0 if since is None else bisect_left(timestamps, since)
+        end = len(timestamps) if until is None else bisect_right(timestamps, until)
+        timestamps = timestamps[start:end]
+        values = values[start:end]
+        if max_points is None or len(timestamps) <= max_points:
+            return timestamps.tolist(), values.tolist()
+        if max_points < 2:
+            return [timestamps[-1]], [values[-1]]
+        buckets = max_points // 2
+        indexes = []
+        for bucket in range(buckets):
+            first = bucket * len(timestamps) // buckets
+            last = (bucket + 1) * len(timestamps) // buckets
+            low = min(range(first, last), key=values.__getitem__)
+            high = max(range(first, last), key=values.__getitem__)
+            indexes.extend(sorted({low, high}))
+        return ([timestamps[index] for index in indexes],
+                [values[index] for index in indexes])
@@ -7,9 +7,8 @@ import os
 import logging
 import argparse
 import random
-from time import sleep
 from serial import Serial
-from instrument import SerialInstrument
+from instrument import SerialInstrument, add_instrument_arguments, instrument_options
 
 
 __author__ = "Brent Maranzano"
@@ -31,8 +30,9 @@ class Ika(SerialInstrument):
        be performed by the Instrument class methods.
     """
 
-    def __init__(self, instrument_port, socket_ip, socket_port, host):
-        super(Ika, self).__init__(instrument_port, socket_ip, socket_port, host)
+    def __init__(self, instrument_port, socket_ip, socket_port, host, **options):
+        super(Ika, self).__init__(instrument_port, socket_ip, socket_port, host,
+                                  **options)
         # Set information about the attached device.
         self._device_information = {
             "instrument": "IKA",
@@ -44,6 +44,14 @@ class Ika(SerialInstrument):
             "SP_speed": 0.0,
             "PV_speed": 0.0
         }
+        # The stirrer does not acknowledge OUT_SP_4, so leave it a short gap
+        # before the next command.
+        self._command_gap = 0.05
+        # Allows the speeds to be updated at their own rate (field_intervals).
+        self._field_readers = {
+            "SP_speed": self._get_SP_speed,
+            "PV_speed": self._get_PV_speed
+        }
         # start the IKA
         response = self._write_read_serial_command("IN_SP_4")
 
@@ -88,7 +96,8 @@ class Ika(SerialInstrument):
             buffer = self._instrument.inWaiting()
             junk = self._instrument.read(buffer)
             self._instrument.write(command)
-            sleep(0.3)
+            # readline returns as soon as the terminated response arrives
+            # (or after the serial timeout).
             response = self._instrument.readline().decode('ascii')
         except:
             response = None
@@ -153,7 +162,9 @@ if __name__ == "__main__":
         type=str,
         default="ape-0"
     )
+    add_instrument_arguments(parser)
     args = parser.parse_args()
     instrument = Ika(args.instrument_port, args.socket_ip,
-        args.socket_port, args.host)
+        args.socket_port, args.host,
+        **instrument_options(args))
     instrument.run()
@@ -7,19 +7,49 @@ import threading
 import queue
 import socket
 import argparse
-import selectors
+import asyncio
 import logging
 import logging.config
 import json
 import yaml
 import coloredlogs
-from time import sleep
+import itertools
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+from types import MappingProxyType
+from time import sleep, time, monotonic
+from command_queue import CommandQueue, PRIORITY_HIGH, PRIORITY_NORMAL
+from codec import BINARY_ENCODINGS, EncodingError, available_encodings, decode_message, encode_message
+from history import History
+from journal import Journal, JournalReader
+from framing import FRAMINGS, MAX_MESSAGE_SIZE, FramingError, encode_frame, read_frame
 
 __author__ = "Brent Maranzano"
 __license__ = "MIT"
 
+# Number of responses a connection may have waiting to be written.
+OUTBOX_SIZE = 64
+
+# Shortest allowed update interval (seconds) of the update scheduler.
+MIN_UPDATE_INTERVAL = 0.05
+
+# Number of commands that may be waiting for execution.
+COMMAND_QUEUE_SIZE = 64
+
+# Number of command records kept for get_command_status.
+COMMAND_RESULTS_SIZE = 256
+
+# Number of serialized responses kept between data publications.
+RESPONSE_CACHE_SIZE = 64
+JOURNAL_RESPONSE_RECORDS = 10000
+
+# Immutable view of the instrument data published by the update thread.
+#     version (int): Incremented on every publication.
+#     timestamp (float): Time (epoch seconds) of the publication.
+#     data (MappingProxyType): Read-only copy of the instrument data.
+# Responses and pushes serialize it once per version and encoding.
+Snapshot = namedtuple("Snapshot", ["version", "timestamp", "data"])
 
-sel = selectors.DefaultSelector()
 
 class SerialInstrument(object):
     """Base class to abstract serial instruments.
@@ -28,15 +58,40 @@ class SerialInstrument(object):
            that this method is over-ridden for each inheriting class for specific
            instruments.
         3. A first thread is started that reads the serial instrument values
-           at regular intervals (self._call_updates) and stores the data in the
-           class attribute (self._data). The self._update_data must be
-           over-ridden in inhereting classes for specific instruments.
+           at regular intervals (self._call_updates) on a drift-free schedule
+           and publishes a copy of
+           the data as an immutable snapshot (self._snapshot). Readers only
+           take a reference to the current snapshot, so they never wait on
+           the instrument lock. The self._update_data must be over-ridden in
+           inhereting classes for specific instruments; it may either return
+           the data or update self._data in place. Instruments that declare a
+           reader per data field (self._field_readers) can have individual
+           fields updated at their own rate (field_intervals).
+           Every update of the numeric fields is also recorded in a bounded
+           history (self._history), which clients query with "get_history",
+           and optionally appended to an on-disk journal (self._journal),
+           which clients replay with "get_journal".
         4. A second thread is started that executes queued commands sent from
-           connected clients (self._execute_queue).
-        5  The main thread process incoming socket client messages/commands
-           (self._process_message)
+           connected clients (self._execute_queue). Commands are sent back to
+           back; instrument methods are expected to return once the instrument
+           has completed (e.g. read its acknowledgement) and instruments that
+           do not acknowledge declare a minimum gap between serial accesses
+           (self._command_gap), which is kept between every command and data
+           update (self._serial_access).
+        5  The main thread runs an asyncio event loop (self.run) that serves
+           every connected client concurrently (self._handle_client) and
+           processes incoming socket client messages/commands
+           (self._process_message). The instrument lock is only held by the
+           two serial threads, never across a network round-trip.
+           Connections start in the legacy framing (one read is one message)
+           and may negotiate newline or length-prefixed framing with the
+           "set_framing" command (see framing.py). Framed connections can
+           "subscribe" to have every new data snapshot pushed to them
+           instead of polling with "get_data". Length-framed connections
+           may negotiate a compact binary encoding (MessagePack or CBOR)
+           with the "set_encoding" command (see codec.py).
            a. Parse the incoming message (self._load_json) as a UTF-8 encoded
-              serialized JSON string with the form:
+              serialized JSON string (or the negotiated encoding) with the form:
               {
                   "user": user_name,
                   "password": password,
@@ -52,8 +107,18 @@ class SerialInstrument(object):
               1. Some commands can be serviced by buffered data in class attributes.
               2. Commands that must be sent to the serial instrument are queued
                  (self._que_request) and executed by a separate thread. The server
-                 responds immediately after succesful queueing, so it is up to
-                 the client to check back and confirm that the command executed.
+                 responds immediately after succesful queueing with a
+                 "command_id". The client can check (or wait for) the result
+                 of the command with the "get_command_status" command.
+                 Priority commands (self._priority_commands, e.g. stop) are
+                 executed before the other queued commands, which they
+                 cancel. A queued setpoint command (self._coalesced_commands,
+                 by default the set_* methods) is replaced by a newer request
+                 of the same command that directly follows it, so only the
+                 last value is sent. A full queue refuses new
+                 commands until it drains. Several commands can be sent in
+                 a single "batch" request, which is queued and executed as
+                 one command without other commands interleaved.
                  Note that commands are executed as below and thus the "commands"
                  must use keyword arguments.
                  getattr(instrument_object, command)(**params)
@@ -63,12 +128,16 @@ class SerialInstrument(object):
                     "parameters": {"param1": <value>, "param2": <value>, ...}
                 }
             d.  The avilable commands (login, logout, get_data, get_about), will
-                write to the instance variable self._resonse with the required
-                results as a JSON object, which will always contain the key
-                "instrument_status" with either "ok" or "error: [error description]".
+                return the response for the client as a dictionary, which will
+                always contain the key "instrument_status" with either "ok" or
+                "error: [error description]". Responses are queued per
+                connection, so a client may send several requests without
+                waiting and receives the responses in the same order.
     """
 
-    def __init__(self, instrument_port, socket_ip, socket_port, host):
+    def __init__(self, instrument_port, socket_ip, socket_port, host,
+                 update_interval=2.0, field_intervals=None, history_size=3600,
+                 journal_dir=None, journal_segment_records=86400, journal_segments=7):
         """Start the logger, connect to the instrument (serial), start listening
         on a socket, and initialize the instrument data to None.
 
@@ -76,26 +145,77 @@ class SerialInstrument(object):
         instrument_port (str): device file for the instrument
             (e.g. "/dev/ttyUSB0")
         socket_ip (str): interface to bind socket (e.g. "0.0.0.0")
-        socket_port (int): port number to use for socket
+        socket_port (int): port number to use for socket, None if the
+            instrument is served by a supervisor (see supervisor.py)
         host (str): name of host (e.g. ape-0)
+        update_interval (float): seconds between updates of the instrument data
+        field_intervals (dict): seconds between updates of individual data
+            fields (e.g. {"PV_speed": 0.2}), overriding update_interval for
+            those fields. Requires the instrument to declare _field_readers.
+        history_size (int): number of data updates kept in the history of
+            each numeric data field (see get_history), 0 to keep none.
+        journal_dir (str): directory of the on-disk journal of the data
+            updates (see journal.py and get_journal), None to not journal.
+        journal_segment_records (int): data updates per journal segment file.
+        journal_segments (int): number of journal segment files kept.
         """
         # _device_information is set in the inheriting class.
-        self._response = {}
         self._user = ""
         self._password = ""
         self._user_tag = "untagged"
         # The following three variables are updated by inheretting class
         self._device_information = {}
         self._host = host
+        # Set by a supervisor that serves several instruments.
+        self._instrument_id = None
         self._instrument_status = "ok"
         self._data = {}
+        # Optionally set by inheriting class: {field: function returning the
+        # current value of the field}.
+        self._field_readers = {}
+        # Optionally set by inheriting class: minimum time (s) between the
+        # end of one serial access (command or data update) and the start of
+        # the next, for instruments that do not acknowledge commands.
+        self._command_gap = 0.0
+        # Optionally set by inheriting class: commands executed before all
+        # other queued commands, and setpoint commands of which only the
+        # most recent queued request is executed.
+        self._priority_commands = {"stop", "abort"}
+        self._coalesced_commands = {
+            name for name in dir(self) if name.startswith("set_")}
+        self._update_interval = max(update_interval, MIN_UPDATE_INTERVAL)
+        self._field_intervals = {
+            field: max(interval, MIN_UPDATE_INTERVAL)
+            for field, interval in (field_intervals or {}).items()
+        }
+        self._update_tasks = []
+        self._history = History(history_size) if history_size > 0 else None
+        self._journal = None
+        if journal_dir is not None:
+            self._journal = Journal(journal_dir, journal_segment_records, journal_segments)
+        self._snapshot = Snapshot(0, time(), MappingProxyType({}))
+        self._response_cache = {}
+        # Subscribed client connections (keyed by peer address) and the
+        # event loop serving them.
+        self._subscribers = {}
+        self._loop = None
         self._setup_logger()
         self._instrument = self._connect_instrument(instrument_port)
-        self._queue = queue.Queue()
+        self._queue = CommandQueue(maxsize=COMMAND_QUEUE_SIZE)
+        # Records of the most recent queued commands, keyed by command id,
+        # and the futures of clients waiting for them to finish.
+        self._command_ids = itertools.count(1)
+        self._command_results = OrderedDict()
+        self._command_waiters = {}
         self._thread_lock = threading.Lock()
+        # End (monotonic) of the last serial access.
+        self._last_access = 0.0
         self._update_thread = threading.Thread(target=self._call_updates, daemon=True)
         self._execute_thread = threading.Thread(target=self._execute_queue, daemon=True)
-        self._create_socket(HOST=socket_ip, PORT=socket_port)
+        if socket_port is None:
+            self._sock = None
+        else:
+            self._sock = self._create_socket(HOST=socket_ip, PORT=socket_port)
         self._logger.info("Instrument initiated")
 
     def _setup_logger(self, config_file="./logger_conf.yml"):
@@ -112,37 +232,23 @@ class SerialInstrument(object):
         self._logger.debug("instrument_server logger setup")
 
     def _create_socket(self, HOST="127.0.0.1", PORT=54132):
-        """Create a local socket server, register it with selector that will
-        call self._accept connection upon READ events (i.e. client
-        connections).
+        """Create a local socket server that is bound and listening. The
+        socket is handed to the asyncio event loop when the service is
+        run (self.run), which then accepts the client connections.
 
         Arguments:
         ip (string): IP address of host.
         port (int): Port number for socket server to listen.
 
-        Returns a socket connection.
+        Returns a socket.
         """
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         sock.bind((HOST, PORT))
-        sock.listen(1)
+        sock.listen(100)
         sock.setblocking(False)
-        sel.register(sock, selectors.EVENT_READ, self._accept_connection)
         self._logger.info("Socket server listening on {}:{}".format(HOST, PORT))
-
-    def _accept_connection(self, sock, mask):
-        """This method is called by the selector when a client attempts
-        to establish a connection. The  method accepts the connection,
-        registers the connection with selector that will call self._handle_connection
-        upon READ events (i.e. client attempts to send data).
-
-        Arguments:
-        sock (socket): Socket that is listening for instrument commands.
-        mask (1 | 2): The READ (1) or WRITE (2) event mask.
-        """
-        conn, addr = sock.accept()  # Should be ready
-        print('accepted', conn, 'from', addr)
-        conn.setblocking(False)
-        sel.register(conn, selectors.EVENT_READ, self._handle_connection_event)
+        return sock
 
     def _connect_instrument(self, port):
         """Connect to the instrument serial port. This method should be
@@ -155,34 +261,40 @@ class SerialInstrument(object):
 
     def _get_about(self):
         """Get information about the microcomputer and attached instrument.
-        Defines the self._response that the socket will write when avaialable.
+
+        Returns (dict) the response to send to the client.
         """
-        self._response = self._device_information
-        self._response.update({"host": self._host})
-        self._response["instrument_status"] = self._instrument_status
+        response = dict(self._device_information)
+        response["host"] = self._host
+        response["instrument_status"] = self._instrument_status
         self._logger.debug("retrieved about")
+        return response
 
     def _login(self, user_name, password):
         """Set the class attributes _user and _password with the passed
-        arguments, to "login" the user. Set the self._response attribute.
+        arguments, to "login" the user.
 
         Arguments:
         user_name (str): Username for currently logged in user.
         password (str): Password of currently logged in user.
+
+        Returns (dict) the response to send to the client.
         """
         self._user = user_name
         self._password = password
-        self._response["instrument_status"] = self._instrument_status
-        self._logger.debug("logged in user".format(self._user))
+        self._logger.debug("logged in user {}".format(self._user))
+        return {"instrument_status": self._instrument_status}
 
     def _logout(self):
         """Set the class attributes _user and _password to None to
-        "logout" the user. Set the self._response attribute.
+        "logout" the user.
+
+        Returns (dict) the response to send to the client.
         """
+        self._logger.debug("logged out user {}".format(self._user))
         self._user = None
         self._password = None
-        self._response["instrument_status"] = self._instrument_status
-        self._logger.debug("logged out user {}".format(self._user))
+        return {"instrument_status": self._instrument_status}
 
     def _set_user_tag(self, tag):
         """
@@ -191,32 +303,231 @@ class SerialInstrument(object):
 
         Arguments
         tag (str): User tag that is transmitted with data.
+
+        Returns (dict) the response to send to the client.
         """
         self._user_tag = tag
-        self._response["instrument_status"] = self._instrument_status
         self._logger.debug("set user tag{}".format(tag))
+        return {"instrument_status": self._instrument_status}
+
+    def _set_framing(self, framing, connection):
+        """Switch the message framing of a client connection. The response
+        to this request is still sent with the previous framing; all
+        following messages on the connection use the new framing.
+
+        Arguments
+        framing (str): One of "legacy", "newline" or "length".
+        connection (dict): State of the client connection.
+
+        Returns (dict) the response to send to the client.
+        """
+        if connection is None or framing not in FRAMINGS:
+            self._logger.error("invalid framing requested: {}".format(framing))
+            return {
+                "socket status": "error",
+                "description": "framing must be one of {}".format(", ".join(FRAMINGS))
+            }
+        connection["framing"] = framing
+        self._logger.debug("set framing of {} to {}".format(connection["peer"], framing))
+        return {
+            "instrument_status": self._instrument_status,
+            "framing": framing
+        }
+
+    def _set_encoding(self, encoding, connection):
+        """Switch the message encoding of a client connection. The response
+        to this request is still sent with the previous encoding; all
+        following messages on the connection use the new encoding. Binary
+        encodings require the length framing.
+
+        Arguments
+        encoding (str): One of "json", "msgpack" or "cbor" (if installed).
+        connection (dict): State of the client connection.
+
+        Returns (dict) the response to send to the client.
+        """
+        encodings = available_encodings()
+        if connection is None or encoding not in encodings:
+            self._logger.error("invalid encoding requested: {}".format(encoding))
+            return {
+                "socket status": "error",
+                "description": "encoding must be one of {}".format(", ".join(encodings))
+            }
+        if encoding in BINARY_ENCODINGS and connection["framing"] != "length":
+            self._logger.error("binary encoding requested without length framing")
+            return {
+                "socket status": "error",
+                "description": "encoding {} requires length framing".format(encoding)
+            }
+        connection["encoding"] = encoding
+        self._logger.debug("set encoding of {} to {}".format(connection["peer"], encoding))
+        return {
+            "instrument_status": self._instrument_status,
+            "encoding": encoding
+        }
 
-    def _get_data(self, parameters=None):
+    def _subscribe(self, parameters, connection):
+        """Subscribe a client connection to the instrument data. Every new
+        data snapshot is pushed to the connection as a message of the form
+            {"push": "data", "version": <int>, "timestamp": <float>,
+             "data": {<same as the get_data response>}}
+        Pushes are only available on connections with newline or length
+        framing, as they arrive in between the responses to requests. The
+        push also contains the "instrument" id if the instrument is served
+        by a supervisor.
+
+        Arguments
+        parameters (dict|None): Optional subscription settings:
+            fields (str|list): Only push these data keys.
+            changes_only (bool): Only push keys whose value changed since
+                the last push (no push if nothing changed).
+            min_interval (float): Minimum time in seconds between pushes.
+        connection (dict): State of the client connection.
+
+        Returns (dict) the response to send to the client.
+        """
+        if parameters is None:
+            parameters = {}
+        if connection is None or connection["framing"] == "legacy":
+            self._logger.error("subscribe requested without framing")
+            return {
+                "socket status": "error",
+                "description": "subscribe requires newline or length framing"
+            }
+        try:
+            fields = parameters.get("fields")
+            if type(fields) is str:
+                fields = [fields]
+            subscription = {
+                "fields": None if fields is None else list(fields),
+                "changes_only": bool(parameters.get("changes_only", False)),
+                "min_interval": float(parameters.get("min_interval") or 0),
+                "pushed": 0.0,
+                "last_sent": {}
+            }
+        except (AttributeError, TypeError, ValueError):
+            self._logger.error("invalid subscription: {}".format(parameters))
+            return {
+                "socket status": "error",
+                "description": "invalid subscription parameters: {}".format(parameters)
+            }
+        subscription["connection"] = connection
+        self._subscribers[connection["peer"]] = subscription
+        self._logger.info("subscribed {} to data".format(connection["peer"]))
+        return {
+            "instrument_status": self._instrument_status,
+            "subscribed": True
+        }
+
+    def _unsubscribe(self, connection):
+        """Stop pushing data to a client connection.
+
+        Arguments
+        connection (dict): State of the client connection.
+
+        Returns (dict) the response to send to the client.
+        """
+        if connection is not None:
+            self._subscribers.pop(connection["peer"], None)
+            self._logger.info("unsubscribed {} from data".format(connection["peer"]))
+        return {
+            "instrument_status": self._instrument_status,
+            "subscribed": False
+        }
+
+    def _push_data(self, snapshot):
+        """Push a data snapshot to the subscribed connections. Called in
+        the event loop for every published snapshot. A connection whose
+        outbound queue is full misses the push rather than stalling the
+        others.
+
+        Arguments
+        snapshot (Snapshot): Newly published data snapshot.
+        """
+        now = monotonic()
+        full = self._get_data(snapshot=snapshot)
+        # The full push is encoded once per encoding in use.
+        encoded_full = {}
+        for subscription in list(self._subscribers.values()):
+            connection = subscription["connection"]
+            if now - subscription["pushed"] < subscription["min_interval"]:
+                continue
+            data = full
+            if subscription["fields"] is not None:
+                data = {k: full[k] for k in subscription["fields"] if k in full}
+            if subscription["changes_only"]:
+                last_sent = subscription["last_sent"]
+                data = {k: v for k, v in data.items()
+                        if k not in last_sent or last_sent[k] != v}
+                if not data:
+                    continue
+            encoding = connection["encoding"]
+            if data is full:
+                if encoding not in encoded_full:
+                    encoded_full[encoding] = self._encode_response(
+                        self._push_message(snapshot, full), encoding)
+                message = encoded_full[encoding]
+            else:
+                message = self._encode_response(self._push_message(snapshot, data), encoding)
+            try:
+                connection["outbox"].put_nowait(encode_frame(message, connection["framing"]))
+            except asyncio.QueueFull:
+                self._logger.warning("dropped data push to {}".format(connection["peer"]))
+                continue
+            subscription["pushed"] = now
+            if subscription["changes_only"]:
+                subscription["last_sent"].update(data)
+
+    def _push_message(self, snapshot, data):
+        """Create the message pushed to subscribed connections.
+
+        Arguments
+        snapshot (Snapshot): Data snapshot that is pushed.
+        data (dict): Data (or the subset of it) to push.
+
+        Returns (dict) the push message.
+        """
+        message = {
+            "push": "data",
+            "version": snapshot.version,
+            "timestamp": snapshot.timestamp,
+            "data": data
+        }
+        if self._instrument_id is not None:
+            message["instrument"] = self._instrument_id
+        return message
+
+    def _get_data(self, parameters=None, snapshot=None):
         """Get the instrument data. If parameters are provided, respond
-        with the desired parameters, else respond with all the data. Set the
-        self._response attribute.
+        with the desired parameters, else respond with all the data.
 
         Arguments:
         parameteters (str|list): Key or keys for the data dictionary to return
+        snapshot (Snapshot): Data snapshot to respond with (default current).
+
+        Returns (dict) the response to send to the client.
         """
+        if snapshot is None:
+            snapshot = self._snapshot
+        data = snapshot.data
         if parameters is None:
-            self._response = self._data
+            response = dict(data)
         else:
             if type(parameters) is str:
                 parameters = [parameters]
             try:
-                self._response = {k: self._data[parameters[k]] for k in parameters}
+                response = {k: data[k] for k in parameters}
             except KeyError:
                 self._logger.error("request for invalid data parameters: {}".format(parameters))
-        self._response["user"] = self._user
-        self._response["user_tag"] = self._user_tag
-        self._response["instrument_status"] = self._instrument_status
-        self._logger.debug("retrieved data: {}".format(self._response))
+                return {
+                    "socket status": "error",
+                    "description": "invalid data parameters: {}".format(parameters)
+                }
+        response["user"] = self._user
+        response["user_tag"] = self._user_tag
+        response["instrument_status"] = self._instrument_status
+        self._logger.debug("retrieved data: {}".format(response))
+        return response
 
     def _update_data(self):
         """Update all the current instrument data values (self._data).  This
@@ -224,26 +535,331 @@ class SerialInstrument(object):
         """
         pass
 
-    def _call_updates(self, interval=10):
-        """Call the overloaded instrument specific function to update
-        the instrument data at intervals.
+    def _create_update_tasks(self):
+        """Create the scheduled update tasks. Without field readers all the
+        data is updated by self._update_data at the update interval. With
+        field readers, fields with their own interval get a task each and
+        the remaining fields are read together at the update interval.
+
+        Returns (list) of tasks (dict) with the keys:
+            name (str): "data" or the name of the field.
+            interval (float): seconds between updates.
+            fields (list|None): fields to read, None for self._update_data.
+            updates (int): number of completed updates.
+            overruns (int): number of updates that missed their deadline.
+            max_lateness (float): largest delay (s) of an update start.
+            last_duration (float): duration (s) of the last update.
+        """
+        specs = []
+        if self._field_readers:
+            fields = [f for f in self._field_readers if f not in self._field_intervals]
+            if fields:
+                specs.append(("data", self._update_interval, fields))
+            for field, interval in self._field_intervals.items():
+                if field in self._field_readers:
+                    specs.append((field, interval, [field]))
+                else:
+                    self._logger.error("no reader for field {}".format(field))
+        else:
+            if self._field_intervals:
+                self._logger.error("instrument does not support field intervals")
+            specs.append(("data", self._update_interval, None))
+        return [
+            {
+                "name": name,
+                "interval": interval,
+                "fields": fields,
+                "updates": 0,
+                "overruns": 0,
+                "max_lateness": 0.0,
+                "last_duration": 0.0
+            }
+            for name, interval, fields in specs
+        ]
+
+    def _run_update(self, fields):
+        """Read the instrument data (or only the given fields) and publish
+        a new snapshot.
 
         Arguments
-        interval (int): Time between updating the instrument data.
+        fields (list|None): Fields to read with their field reader, or None
+            to update all data with self._update_data.
         """
-        # Minimum allowable interval is 2 seconds to avoid serial problems.
-        interval = min(interval, 2)
-        self._logger.info("update data thread started")
+        with self._serial_access():
+            if fields is None:
+                data = self._update_data()
+                # Some instruments update self._data in place.
+                if data is None:
+                    data = self._data
+            else:
+                for field in fields:
+                    self._data[field] = self._field_readers[field]()
+                data = self._data
+        self._publish_data(data, fields)
+
+    def _call_updates(self):
+        """Call the overloaded instrument specific function to update
+        the instrument data at intervals. Deadlines are kept on the
+        monotonic clock, so the period does not drift by the duration of
+        the updates. An update that finishes after its next deadline is
+        counted as an overrun and the missed periods are skipped rather
+        than run back-to-back.
+        """
+        self._update_tasks = self._create_update_tasks()
+        start = monotonic()
+        for task in self._update_tasks:
+            task["deadline"] = start
+        self._logger.info("update data thread started: {}".format(
+            {task["name"]: task["interval"] for task in self._update_tasks}))
         while True:
-            with self._thread_lock:
-                self._data = self._update_data()
-            self._logger.debug("updated data")
-            sleep(interval)
+            task = min(self._update_tasks, key=lambda t: t["deadline"])
+            delay = task["deadline"] - monotonic()
+            if delay > 0:
+                sleep(delay)
+            started = monotonic()
+            try:
+                self._run_update(task["fields"])
+            except Exception:
+                self._logger.exception("failed to update {}".format(task["name"]))
+            finished = monotonic()
+            task["updates"] += 1
+            task["max_lateness"] = max(task["max_lateness"], started - task["deadline"])
+            task["last_duration"] = finished - started
+            task["deadline"] += task["interval"]
+            if task["deadline"] < finished:
+                missed = (finished - task["deadline"]) // task["interval"] + 1
+                task["deadline"] += missed * task["interval"]
+                task["overruns"] += 1
+                self._logger.debug("update of {} missed {} deadline(s)".format(
+                    task["name"], int(missed)))
+
+    def _get_update_stats(self):
+        """Get the timing statistics of the update scheduler.
+
+        Returns (dict) the response to send to the client.
+        """
+        keys = ("interval", "updates", "overruns", "max_lateness", "last_duration")
+        response = {
+            task["name"]: {k: task[k] for k in keys}
+            for task in self._update_tasks
+        }
+        response["instrument_status"] = self._instrument_status
+        return response
+
+    def _get_history(self, parameters=None):
+        """Get the recorded history of numeric data fields, optionally
+        limited to a time range and downsampled on the server (see
+        History.query).
+
+        Arguments:
+        parameters (dict|None): Optional query:
+            fields (str|list): Fields to return (default all recorded).
+            since (float): Start time (seconds since the epoch).
+            until (float): End time (seconds since the epoch).
+            max_points (int): Maximum number of points per field.
+
+        Returns (dict) the response to send to the client, with the
+            timestamps and values of each field:
+            {"history": {field: {"timestamps": [...], "values": [...]}}}
+        """
+        if parameters is None:
+            parameters = {}
+        if self._history is None:
+            return {
+                "socket status": "error",
+                "description": "history is disabled"
+            }
+        try:
+            fields = parameters.get("fields")
+            if type(fields) is str:
+                fields = [fields]
+            elif fields is None:
+                fields = self._history.fields()
+            since = parameters.get("since")
+            until = parameters.get("until")
+            since = None if since is None else float(since)
+            until = None if until is None else float(until)
+            max_points = parameters.get("max_points")
+            if max_points is not None:
+                max_points = int(max_points)
+                if max_points < 1:
+                    raise ValueError("max_points must be positive")
+            history = {}
+            for field in fields:
+                samples = self._history.query(field, since, until, max_points)
+                if samples is None:
+                    raise KeyError(field)
+                history[field] = {"timestamps": samples[0], "values": samples[1]}
+        except (AttributeError, TypeError, ValueError, KeyError):
+            self._logger.error("invalid history request: {}".format(parameters))
+            return {
+                "socket status": "error",
+                "description": "invalid history parameters: {}".format(parameters)
+            }
+        return {
+            "history": history,
+            "instrument_status": self._instrument_status
+        }
+
+    def _get_journal(self, parameters=None):
+        """Get the journaled data updates within a time range, e.g. to
+        replay the data missed while the upstream link was down. The
+        journal is read in the default executor, so that the disk access
+        does not block the event loop.
+
+        Arguments:
+        parameters (dict|None): Optional query:
+            since (float): Start time (seconds since the epoch), exclusive.
+            until (float): End time (seconds since the epoch).
+            limit (int): Maximum number of records (default and at most
+                JOURNAL_RESPONSE_RECORDS). Request the records since the
+                timestamp of the last one received to get the rest.
+
+        Returns (dict|coroutine) the response to send to the client (a
+            coroutine returning it if the journal is read), with the records
+            of each journal segment in the range:
+            {"journal": [{"fields": [...], "records": [[timestamp, version,
+             value of each field (None if missing)], ...]}, ...],
+             "complete": <false if the limit was reached>}
+        """
+        if parameters is None:
+            parameters = {}
+        if self._journal is None:
+            return {
+                "socket status": "error",
+                "description": "journal is disabled"
+            }
+        try:
+            since = parameters.get("since")
+            until = parameters.get("until")
+            since = None if since is None else float(since)
+            until = None if until is None else float(until)
+            limit = int(parameters.get("limit") or JOURNAL_RESPONSE_RECORDS)
+            if limit < 1:
+                raise ValueError("limit must be positive")
+        except (AttributeError, TypeError, ValueError):
+            self._logger.error("invalid journal request: {}".format(parameters))
+            return {
+                "socket status": "error",
+                "description": "invalid journal parameters: {}".format(parameters)
+            }
+        limit = min(limit, JOURNAL_RESPONSE_RECORDS)
+        if self._loop is None:
+            return self._read_journal(since, until, limit)
+        return self._wait_for_journal(since, until, limit)
+
+    async def _wait_for_journal(self, since, until, limit):
+        """Read the journal in the default executor.
+
+        Arguments
+        since (float|None): Start time (exclusive).
+        until (float|None): End time.
+        limit (int): Maximum number of records.
+
+        Returns (dict) the response to send to the client.
+        """
+        return await self._loop.run_in_executor(
+            None, self._read_journal, since, until, limit)
+
+    def _read_journal(self, since, until, limit):
+        """Read the journaled records within a time range.
+
+        Arguments
+        since (float|None): Start time (exclusive).
+        until (float|None): End time.
+        limit (int): Maximum number of records.
+
+        Returns (dict) the response to send to the client.
+        """
+        journal = []
+        count = 0
+        reader = JournalReader(self._journal.directory)
+        for fields, rows in reader.read(since, until, limit):
+            records = [[None if value != value else value for value in record]
+                       for record in rows.tolist()]
+            count += len(records)
+            journal.append({"fields": list(fields), "records": records})
+        return {
+            "journal": journal,
+            "complete": count < limit,
+            "instrument_status": self._instrument_status
+        }
+
+    def _publish_data(self, data, fields=None):
+        """Publish a new immutable snapshot of the instrument data. The
+        snapshot is swapped in with a single assignment, so readers always
+        see either the previous or the new snapshot in full. Only the
+        update thread publishes, so no lock is required.
+
+        Arguments
+        data (dict): Current instrument data.
+        fields (list|None): Fields read by this update, or None if all data
+            was read. Only these are recorded in the history and journal.
+        """
+        data = dict(data)
+        if fields is None:
+            update = data
+        else:
+            update = {field: data[field] for field in fields}
+        snapshot = Snapshot(
+            version=self._snapshot.version + 1,
+            timestamp=time(),
+            data=MappingProxyType(data)
+        )
+        self._snapshot = snapshot
+        if self._history is not None:
+            self._history.record(snapshot.timestamp, update)
+        if self._journal is not None:
+            try:
+                self._journal.append(snapshot.timestamp, snapshot.version, update)
+            except (OSError, ValueError) as err:
+                self._logger.error("could not journal data version {}: {}".format(
+                    snapshot.version, err))
+        # Cached responses are keyed on the version, so dropping the cache
+        # only releases responses that can no longer be served.
+        self._response_cache = {}
+        self._logger.debug("published data version {}".format(snapshot.version))
+        if self._loop is not None and self._subscribers:
+            self._loop.call_soon_threadsafe(self._push_data, snapshot)
+
+    def _cached_response(self, key, build, encoding="json"):
+        """Get a serialized response from the response cache. On a miss the
+        response is built, serialized and cached. The cache is only used
+        from the event loop and is replaced when new data is published.
+
+        Arguments
+        key (tuple): Everything the response depends on.
+        build (function): Returns the response (dict) for a cache miss.
+        encoding (str): Encoding to serialize the response with.
+
+        Returns (bytes) the serialized response.
+        """
+        cache = self._response_cache
+        key = key + (encoding,)
+        response = cache.get(key)
+        if response is None:
+            response = self._encode_response(build(), encoding)
+            if len(cache) >= RESPONSE_CACHE_SIZE:
+                cache.clear()
+            cache[key] = response
+        return response
+
+    def _encode_response(self, response, encoding="json"):
+        """Serialize a response for sending to a client.
+
+        Arguments
+        response (dict): Response to the client.
+        encoding (str): Encoding negotiated by the client (see codec.py).
+
+        Returns (bytes) the serialized response.
+        """
+        return encode_message(response, encoding)
 
     def _execute_queue(self):
-        """Execute commands in the que at a timing intervals sufficiently
-        slow to avoid serial errors. The inheretting class methods/commands
-        are called using (getattr(self, command)(**parameters).
+        """Execute the commands in the que as soon as the instrument is
+        ready for them. The inheretting class methods/commands are called
+        using (getattr(self, command)(**parameters) and are expected to
+        return when the instrument has completed the command.
         """
         self._logger.info("queue execution thread started")
         while True:
@@ -252,23 +868,175 @@ class SerialInstrument(object):
             command = request["command_name"]
             parameters = request["parameters"]
             if parameters is None:
-                try:
-                    with self._thread_lock:
-                        getattr(self, command)()
-                        self._logger.info("executed command: {}".format(command))
-                        # Sleep for a short time to avoid buffer conflict
-                        sleep(0.5)
-                except Exception:
-                    self._logger.error("command failed: {}".format(command))
-            else:
-                try:
-                    with self._thread_lock:
-                        getattr(self, command)(**parameters)
-                        # Sleep for a short time to avoid buffer conflict
-                        sleep(0.5)
-                except Exception:
-                    self._logger.error("command failed {}({})".format(command, **parameters))
-            sleep(1)
+                parameters = {}
+            record = request["record"]
+            try:
+                with self._serial_access():
+                    record["started"] = time()
+                    record["state"] = "running"
+                    serial_start = monotonic()
+                    try:
+                        if command == "batch":
+                            result = self._execute_batch(request["commands"], record)
+                        else:
+                            result = getattr(self, command)(**parameters)
+                    finally:
+                        record["serial_time"] = monotonic() - serial_start
+                record["result"] = self._result_value(result)
+                record["state"] = "done"
+                self._logger.info("executed command: {}".format(command))
+            except Exception as err:
+                record["error"] = "{}: {}".format(type(err).__name__, err)
+                record["state"] = "failed"
+                self._logger.exception("command failed {}({})".format(command, parameters))
+            record["finished"] = time()
+            if self._loop is not None:
+                self._loop.call_soon_threadsafe(self._command_finished, record["command_id"])
+
+    @contextmanager
+    def _serial_access(self):
+        """Hold the instrument lock for a serial access (a command or a data
+        update), starting it at least self._command_gap after the end of the
+        previous access.
+        """
+        with self._thread_lock:
+            wait = self._command_gap - (monotonic() - self._last_access)
+            if wait > 0:
+                sleep(wait)
+            try:
+                yield
+            finally:
+                self._last_access = monotonic()
+
+    def _execute_batch(self, commands, record):
+        """Execute the commands of a batch in order. Called by the execute
+        thread while holding the instrument lock, so no other command or
+        data update is interleaved. If a command fails, the remaining
+        commands are skipped and the exception is raised.
+
+        Arguments
+        commands (list): Commands ({"command_name": ..., "parameters": ...}).
+        record (dict): Record of the batch, updated with the results.
+
+        Returns (list) the result of each command.
+        """
+        results = [
+            {
+                "command_name": command["command_name"],
+                "state": "queued",
+                "result": None,
+                "error": None
+            }
+            for command in commands
+        ]
+        record["result"] = results
+        for index, (command, result) in enumerate(zip(commands, results)):
+            if index > 0 and self._command_gap > 0:
+                sleep(self._command_gap)
+            try:
+                value = getattr(self, command["command_name"])(**(command["parameters"] or {}))
+            except Exception as err:
+                result["state"] = "failed"
+                result["error"] = "{}: {}".format(type(err).__name__, err)
+                for remaining in results[index + 1:]:
+                    remaining["state"] = "skipped"
+                raise
+            result["result"] = self._result_value(value)
+            result["state"] = "done"
+        return results
+
+    def _result_value(self, result):
+        """Convert the return value of a command to a value that can be sent
+        to a client.
+
+        Arguments
+        result: Return value of the instrument command.
+
+        Returns the result if it is a JSON type, else its string form.
+        """
+        try:
+            json.dumps(result)
+        except (TypeError, ValueError):
+            result = str(result)
+        return result
+
+    def _command_finished(self, command_id):
+        """Wake the clients waiting for a command to finish. Called in the
+        event loop.
+
+        Arguments
+        command_id (int): Id of the finished command.
+        """
+        for future in self._command_waiters.pop(command_id, []):
+            if not future.done():
+                future.set_result(None)
+
+    def _get_command_status(self, parameters):
+        """Get the status of a queued command. If a wait time is given and
+        the command has not finished, the response is sent when the command
+        finishes or the wait time expires, whichever is first.
+
+        Arguments
+        parameters (int|dict): The command id, or {"command_id": <int>,
+            "wait": <seconds>}.
+
+        Returns (dict) the response to send to the client, or a coroutine
+            returning the response when waiting.
+        """
+        wait = 0
+        try:
+            if isinstance(parameters, dict):
+                wait = float(parameters.get("wait") or 0)
+                parameters = parameters.get("command_id")
+            record = self._command_results.get(parameters)
+        except (TypeError, ValueError):
+            record = None
+        if record is None:
+            return {
+                "socket status": "error",
+                "description": "unknown command id: {}".format(parameters)
+            }
+        if wait > 0 and record["state"] in ("queued", "running") and self._loop is not None:
+            return self._wait_for_command(record, wait)
+        return self._command_status(record)
+
+    def _command_status(self, record):
+        """Create the response for the status of a command.
+
+        Arguments
+        record (dict): Record of the command.
+
+        Returns (dict) the response to send to the client.
+        """
+        response = dict(record)
+        response["instrument_status"] = self._instrument_status
+        return response
+
+    async def _wait_for_command(self, record, timeout):
+        """Wait for a command to finish.
+
+        Arguments
+        record (dict): Record of the command.
+        timeout (float): Maximum time (s) to wait.
+
+        Returns (dict) the response to send to the client.
+        """
+        future = self._loop.create_future()
+        waiters = self._command_waiters.setdefault(record["command_id"], [])
+        waiters.append(future)
+        # The command may have finished before the future was registered.
+        if record["state"] not in ("queued", "running"):
+            future.set_result(None)
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            if future in waiters:
+                waiters.remove(future)
+            if not waiters:
+                self._command_waiters.pop(record["command_id"], None)
+        return self._command_status(record)
 
     def _que_request(self, request):
         """Queue the request to be executed at reasonable time intervals by
@@ -277,18 +1045,113 @@ class SerialInstrument(object):
         Arguments:
         request (dict): Request containing command and parameters to be executed
             on serial conneted device.
+
+        Returns (dict) the response to send to the client.
         """
-        self._queue.put(request)
-        self._response = {
+        command_id = next(self._command_ids)
+        record = {
+            "command_id": command_id,
+            "command_name": request["command_name"],
+            "state": "queued",
+            "queued": time(),
+            "started": None,
+            "finished": None,
+            "serial_time": None,
+            "result": None,
+            "error": None,
+            "superseded_by": None
+        }
+        request["record"] = record
+        command_name = request["command_name"]
+        if command_name in self._priority_commands:
+            priority = PRIORITY_HIGH
+        else:
+            priority = PRIORITY_NORMAL
+        key = command_name if command_name in self._coalesced_commands else None
+        try:
+            replaced, cancelled = self._queue.put(request, priority=priority, key=key)
+        except queue.Full:
+            self._logger.error("command queue full, refused {}".format(command_name))
+            return {
+                "socket status": "error",
+                "description": "command queue full, retry later"
+            }
+        self._command_results[command_id] = record
+        while len(self._command_results) > COMMAND_RESULTS_SIZE:
+            self._command_results.popitem(last=False)
+        if replaced is not None:
+            self._supersede(replaced["record"], "coalesced", command_id)
+        for request in cancelled:
+            self._supersede(request["record"], "cancelled", command_id)
+        self._logger.debug("command {} queued".format(command_name))
+        return {
             "socket status": "okay",
-            "description": "command queued for execution"
+            "description": "command queued for execution",
+            "command_id": command_id,
+            "queue_length": self._queue.qsize()
         }
-        self._logger.debug("command {} queued".format(request["command_name"]))
+
+    def _supersede(self, record, state, command_id):
+        """Finish a queued command that will not be executed.
+
+        Arguments:
+        record (dict): Record of the command.
+        state (str): "coalesced" or "cancelled".
+        command_id (int): Id of the command that superseded it.
+        """
+        record["state"] = state
+        record["superseded_by"] = command_id
+        record["finished"] = time()
+        self._command_finished(record["command_id"])
+        self._logger.debug("command {} {} by {}".format(record["command_id"], state, command_id))
+
+    def _que_batch(self, parameters):
+        """Validate a batch of instrument commands and queue it as a single
+        command, which executes the commands in order without anything
+        interleaved (see self._execute_batch).
+
+        Arguments:
+        parameters (list|dict): The commands, or {"commands": <list>,
+            "wait": <seconds>} to respond with the results once the batch
+            finished (or the wait time expired).
+
+        Returns (dict) the response to send to the client, or a coroutine
+            returning the response when waiting.
+        """
+        commands = parameters
+        wait = 0
+        if isinstance(parameters, dict):
+            commands = parameters.get("commands")
+            wait = parameters.get("wait") or 0
+        if not isinstance(commands, list) or not commands:
+            return {
+                "socket status": "error",
+                "description": "batch requires a list of commands"
+            }
+        batch = []
+        for command in commands:
+            command_name = command.get("command_name") if isinstance(command, dict) else None
+            parameters = command.get("parameters") if isinstance(command, dict) else None
+            if (not isinstance(command_name, str) or not hasattr(self, command_name)
+                    or not isinstance(parameters, (dict, type(None)))):
+                self._logger.info("invalid batch command: {}".format(command))
+                return {
+                    "socket status": "error",
+                    "description": "invalid batch command: {}".format(command)
+                }
+            batch.append({"command_name": command_name, "parameters": parameters})
+        response = self._que_request({
+            "command_name": "batch",
+            "parameters": None,
+            "commands": batch
+        })
+        if wait and "command_id" in response:
+            return self._get_command_status({"command_id": response["command_id"], "wait": wait})
+        return response
 
     def _validate_credentials(self, request):
         """Confirm that the request contains the logged in usernme with
-        correct password. Set the self._response attribute according the
-        the success or fail of the validation.
+        correct password.
 
         Arguments
         request (dict): Request command and credentials. See class description
@@ -306,13 +1169,9 @@ class SerialInstrument(object):
         else:
             self._logger.error("request with invalid credentials")
             valid = False
-            self._response = {
-                "socket status": "error",
-                "description": "invalid user name or password"
-            }
         return valid
 
-    def _process_request(self, request):
+    def _process_request(self, request, connection=None):
         """If the request does not require instrument communication (e.g.
         _login, _logout, _get_data), attempt to service the request. If the
         request does require direct instrument communication, communication
@@ -320,43 +1179,72 @@ class SerialInstrument(object):
 
         Arguments:
         request (dict): Command and command parameters to be executed.
+        connection (dict): State of the client connection that sent the request.
+
+        Returns (dict|bytes) the response to send to the client, bytes if
+            the response is already serialized, or a coroutine returning the
+            response if it has to wait.
         """
-        # Retrieve data without requiring credentials
-        if request["command"]["command_name"] == "get_about":
-            self._get_about()
-        elif request["command"]["command_name"] == "get_data":
-            self._get_data(request["command"]["parameters"])
-        elif self._validate_credentials(request):
-            if request["command"]["command_name"] == "login":
-                self._login(request["user"], request["password"])
-            elif request["command"]["command_name"] == "logout":
-                self._logout()
-            elif request["command"]["command_name"] == "set_user_tag":
-                self._set_user_tag(request["command"]["parameters"])
-            # Queue serial commands (e.g. measure, set_point, ...).
-            elif hasattr(self, request["command"]["command_name"]):
-                command_name = request["command"]["command_name"]
-                if "parameters" in request["command"]:
-                    parameters = request["command"]["parameters"]
-                else:
-                    parameters = None
-                command = {
-                    "command_name": command_name,
-                    "parameters": parameters
-                }
-                self._que_request(command)
-            else:
-                # If no command was found set response and return.
-                self._logger.info("invalid command called: {}".format(request["command_name"]))
-                self._response = {
-                    "socket status": "error",
-                    "descripton": "command '{}' not found".format(request["command_name"])
-                }
+        command_name = request["command"]["command_name"]
+        parameters = request["command"].get("parameters")
+        encoding = "json" if connection is None else connection["encoding"]
+        # Retrieve data without requiring credentials. These responses are
+        # served from the cache of serialized responses.
+        if command_name == "get_about":
+            key = ("get_about", self._instrument_status)
+            return self._cached_response(key, self._get_about, encoding)
+        elif command_name == "set_framing":
+            return self._set_framing(parameters, connection)
+        elif command_name == "set_encoding":
+            return self._set_encoding(parameters, connection)
+        elif command_name == "subscribe":
+            return self._subscribe(parameters, connection)
+        elif command_name == "unsubscribe":
+            return self._unsubscribe(connection)
+        elif command_name == "get_update_stats":
+            return self._get_update_stats()
+        elif command_name == "get_history":
+            return self._get_history(parameters)
+        elif command_name == "get_journal":
+            return self._get_journal(parameters)
+        elif command_name == "get_command_status":
+            return self._get_command_status(parameters)
+        elif command_name == "get_data":
+            snapshot = self._snapshot
+            key = ("get_data", snapshot.version, repr(parameters), repr(self._user),
+                   repr(self._user_tag), self._instrument_status)
+            return self._cached_response(
+                key, lambda: self._get_data(parameters, snapshot), encoding)
+        elif not self._validate_credentials(request):
+            return {
+                "socket status": "error",
+                "description": "invalid user name or password"
+            }
+        elif command_name == "login":
+            return self._login(request["user"], request["password"])
+        elif command_name == "logout":
+            return self._logout()
+        elif command_name == "set_user_tag":
+            return self._set_user_tag(parameters)
+        elif command_name == "batch":
+            return self._que_batch(parameters)
+        # Queue serial commands (e.g. measure, set_point, ...).
+        elif hasattr(self, command_name):
+            command = {
+                "command_name": command_name,
+                "parameters": parameters
+            }
+            return self._que_request(command)
+        else:
+            self._logger.info("invalid command called: {}".format(command_name))
+            return {
+                "socket status": "error",
+                "description": "command '{}' not found".format(command_name)
+            }
 
     def _parse_request(self, request):
-        """Parse the request to get the command name and parameters. If
-        the parse fails set request to None. Set the self._response attribute
-        according to parse results.
+        """Check that the request contains the credentials and a command
+        with a command name. If the check fails set request to None.
 
         Arguments:
         request (dict): Instrument request
@@ -365,21 +1253,14 @@ class SerialInstrument(object):
             {"command_name": command_name, "parameters": parameters},
             else returns None.
         """
-        if ("user" not in request or "password" not in request
-           or "command" not in request):
+        if (not isinstance(request, dict) or "user" not in request
+           or "password" not in request or "command" not in request):
             self._logger.error("request does not contain required keys")
             self._logger.debug("request:\n{}".format(request))
-            self._response = {
-                "socket status": "error",
-                "descripton": "invalid request format"
-            }
             request = None
-        elif "command_name" not in request["command"]:
+        elif (not isinstance(request["command"], dict)
+              or "command_name" not in request["command"]):
             self._logger.error("request does not contain required keys")
-            self._response = {
-                "socket status": "error",
-                "descripton": "invalid request format"
-            }
             self._logger.debug("request:\n{}".format(request))
             request = None
         else:
@@ -393,7 +1274,7 @@ class SerialInstrument(object):
         Arguments
         message (str): string to try to interpret as JSON.
 
-        Returns dictionary if JSON successfully parsed, else return False.
+        Returns dictionary if JSON successfully parsed, else return None.
         """
         request = None
         try:
@@ -402,93 +1283,226 @@ class SerialInstrument(object):
         except json.decoder.JSONDecodeError:
             self._logger.error("message not valid JSON")
             self._logger.error("message: {}".format(message))
-            self._response = {
-                "socket status": "error",
-                "description": "request type not valid JSON"
-            }
-            self._logger.debug("request:\n{}".format(request))
         return request
 
-    def _process_message(self, message):
+    def _process_message(self, message, connection=None):
         """If the message is valid JSON and a valid command format, then
         extract the request (i.e. command) from the message and call the
         _process_request(request) method.
 
         Arguments:
-        message (JSON): See class description for valid format.
+        message (JSON|bytes): See class description for valid format, bytes
+            if the connection negotiated a binary encoding.
+        connection (dict): State of the client connection that sent the message.
+
+        Returns (dict|bytes) the response to send to the client.
         """
-        # Try to create dict from message (valid JSON).
-        request = self._load_json(message)
+        encoding = "json" if connection is None else connection["encoding"]
+        if encoding == "json":
+            # Try to create dict from message (valid JSON).
+            request = self._load_json(message)
+        else:
+            try:
+                request = decode_message(message, encoding)
+            except EncodingError as err:
+                self._logger.error(err)
+                request = None
         if request is None:
-            return
+            return {
+                "socket status": "error",
+                "description": "request type not valid {}".format(
+                    "JSON" if encoding == "json" else encoding)
+            }
 
         # Check if valid request
         request = self._parse_request(request)
         if request is None:
-            return
+            return {
+                "socket status": "error",
+                "description": "invalid request format"
+            }
 
         # Send the request for execution.
-        self._process_request(request)
+        return self._process_request(request, connection)
 
-    def _process_write_event(self, conn):
-        """Send the self._response back to the client and set the selector to
-        READ. If it fails, do nothing.
+    async def _write_responses(self, writer, connection):
+        """Write the queued responses of a connection to the client, in the
+        order the requests were received, until a None is queued.
+
+        Arguments:
+        writer (asyncio.StreamWriter): Outgoing stream of the client.
+        connection (dict): State of the client connection.
         """
-        response = json.dumps(self._response, ensure_ascii=True)
+        outbox = connection["outbox"]
+        connected = True
+        while True:
+            frame = await outbox.get()
+            if frame is None:
+                break
+            if not connected:
+                # Keep draining the queue so that the reader never blocks on
+                # a full queue of a dead connection.
+                continue
+            try:
+                writer.write(frame)
+                await writer.drain()
+                self._logger.debug("wrote message to {}".format(connection["peer"]))
+            except ConnectionError as err:
+                self._logger.error("error sending response to {}: {}".format(
+                    connection["peer"], err))
+                connected = False
+                writer.close()
+
+    async def _handle_client(self, reader, writer):
+        """Service a client connection for as long as it is open. Requests
+        are read and processed back-to-back (pipelined) and the responses
+        are put on the outbound queue of the connection, which a separate
+        task writes to the client in order. Nothing is shared between
+        connections and the instrument lock is never taken, so a slow
+        client (or a slow serial exchange) does not stall the other clients.
+
+        Arguments:
+        reader (asyncio.StreamReader): Incoming stream of the client.
+        writer (asyncio.StreamWriter): Outgoing stream of the client.
+        """
+        peer = writer.get_extra_info("peername")
+        connection = {
+            "peer": peer,
+            "framing": "legacy",
+            "encoding": "json",
+            "outbox": asyncio.Queue(maxsize=OUTBOX_SIZE)
+        }
+        self._logger.info("accepted connection from {}".format(peer))
+        write_task = asyncio.ensure_future(self._write_responses(writer, connection))
         try:
-            conn.sendall(response.encode(encoding="UTF-8"))
-            self._logger.info("wrote message to {}".format(conn))
-            self._logger.debug("message:\n{}".format(response))
-        except:
-            self._logger.error("error sending response")
-            self._logger.error("message:\n{}".format(response))
-            pass
+            while True:
+                framing = connection["framing"]
+                encoding = connection["encoding"]
+                message = await read_frame(reader, framing)
+                if not message:
+                    break
+                if encoding == "json":
+                    message = message.decode('ascii')
+                self._logger.debug("message received from {}".format(peer))
+                self._logger.debug("message:\n{}".format(message))
+                response = self._process_message(message, connection)
+                # Later responses on the connection wait for this one, so
+                # that the responses stay in the order of the requests.
+                if asyncio.iscoroutine(response):
+                    response = await response
+                if not isinstance(response, bytes):
+                    response = self._encode_response(response, encoding)
+                # Reply with the framing (and encoding) the request was sent with. The
+                # queue is bounded, so a client that does not read its
+                # responses stops being read from.
+                await connection["outbox"].put(encode_frame(response, framing))
+                self._logger.debug("message:\n{}".format(response))
+            await connection["outbox"].put(None)
+            await write_task
+        except (ConnectionError, UnicodeDecodeError, FramingError) as err:
+            self._logger.error("error on connection {}: {}".format(peer, err))
+        except Exception:
+            self._logger.exception("error processing message from {}".format(peer))
         finally:
-            sel.modify(conn, selectors.EVENT_READ, self._handle_connection_event)
+            self._close_connection(connection)
+            write_task.cancel()
+            writer.close()
+            self._logger.info("Closed connection to {}".format(peer))
 
-    def _process_read_event(self, conn):
-        """If message is not null, decode and process the message and set the
-        selector to WRITE. If message is null, close the connection.
+    def _close_connection(self, connection):
+        """Release the state kept for a client connection that closed.
 
         Arguments:
-        conn (socket connection): A socket connection to a client.
-        """
-        message = conn.recv(4096)
-        message = message.decode('ascii')
-        self._logger.debug("message received from {}".format(conn))
-        self._logger.debug("message:\n{}".format(message))
-        if message:
-            self._process_message(message)
-            self._logger.debug("changing connection to write")
-            sel.modify(conn, selectors.EVENT_WRITE, self._handle_connection_event)
-        else:
-            sel.unregister(conn)
-            conn.close()
-            self._logger.info("Closed connection to {}".format(conn))
-
-    def _handle_connection_event(self, conn, mask):
-        """If the event is READ send to _process_read_event and check the return
-        value. If the return value is False, then close the connection; else
-        set the selector to write state.
-        """
-        if mask == selectors.EVENT_READ:
-            self._thread_lock.acquire(blocking=True)
-            self._process_read_event(conn)
-        elif mask == selectors.EVENT_WRITE:
-            self._process_write_event(conn)
-            self._thread_lock.release()
+        connection (dict): State of the client connection.
+        """
+        self._subscribers.pop(connection["peer"], None)
 
-    def run(self):
-        """Run the socket server. Accept clients and service requests.
+    async def _serve(self):
+        """Serve client connections on the listening socket until the
+        event loop is stopped.
+        """
+        self._loop = asyncio.get_running_loop()
+        server = await asyncio.start_server(self._handle_client, sock=self._sock,
+                                            limit=MAX_MESSAGE_SIZE)
+        async with server:
+            await server.serve_forever()
+
+    def _start_threads(self):
+        """Start the update and the command execution threads.
         """
         self._update_thread.start()
         self._execute_thread.start()
+
+    def run(self):
+        """Run the socket server. Accept clients and service requests.
+        """
+        self._start_threads()
         self._logger.info("Instrument service run started.")
-        while True:
-            events = sel.select()
-            for key, mask in events:
-                callback = key.data
-                callback(key.fileobj, mask)
+        asyncio.run(self._serve())
+
+
+def add_instrument_arguments(parser):
+    """Add the command line arguments of the SerialInstrument options to
+    the argument parser of an instrument.
+
+    Arguments
+    parser (argparse.ArgumentParser): Argument parser of the instrument.
+    """
+    parser.add_argument(
+        "--update_interval",
+        help="seconds between updates of the instrument data",
+        type=float,
+        default=2.0
+    )
+    parser.add_argument(
+        "--field_intervals",
+        help='seconds between updates per data field as JSON (e.g. \'{"PV_speed": 0.2}\')',
+        type=json.loads,
+        default=None
+    )
+    parser.add_argument(
+        "--history_size",
+        help="number of data updates kept in the history of each numeric field",
+        type=int,
+        default=3600
+    )
+    parser.add_argument(
+        "--journal_dir",
+        help="directory of the on-disk journal of the instrument data (default none)",
+        type=str,
+        default=None
+    )
+    parser.add_argument(
+        "--journal_segment_records",
+        help="number of data updates per journal segment file",
+        type=int,
+        default=86400
+    )
+    parser.add_argument(
+        "--journal_segments",
+        help="number of journal segment files kept",
+        type=int,
+        default=7
+    )
+
+
+def instrument_options(args):
+    """Get the SerialInstrument options from the parsed command line
+    arguments (see add_instrument_arguments).
+
+    Arguments
+    args (argparse.Namespace): Parsed command line arguments.
+
+    Returns (dict) keyword arguments for SerialInstrument.
+    """
+    return {
+        "update_interval": args.update_interval,
+        "field_intervals": args.field_intervals,
+        "history_size": args.history_size,
+        "journal_dir": args.journal_dir,
+        "journal_segment_records": args.journal_segment_records,
+        "journal_segments": args.journal_segments
+    }
 
 
 if __name__ == "__main__":
@@ -517,6 +1531,7 @@ if __name__ == "__main__":
         type=str,
         default="ape-0"
     )
+    add_instrument_arguments(parser)
     args = parser.parse_args()
     instrument = SerialInstrument(args.instrument_port, args.socket_ip,
-        args.socket_port, args.host)
+        args.socket_port, args.host, **instrument_options(args))
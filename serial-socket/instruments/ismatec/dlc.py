@@ -7,7 +7,7 @@ dynamic load cell (dlc).
 import logging
 import argparse
 from serial import Serial
-from instrument import SerialInstrument
+from instrument import SerialInstrument, add_instrument_arguments, instrument_options
 
 
 __author__ = "Brent Maranzano"
@@ -26,9 +26,10 @@ class Ismatec(SerialInstrument):
            _set_about
     """
 
-    def __init__(self, instrument_port, socket_ip, socket_port, host):
+    def __init__(self, instrument_port, socket_ip, socket_port, host,
+                 **options):
         super(Ismatec, self).__init__(instrument_port, socket_ip, socket_port,
-                                      host)
+                                      host, **options)
         # Set information about the attached device.
         # TODO add additional commands
         self._device_information = {
@@ -41,6 +42,9 @@ class Ismatec(SerialInstrument):
             "SP": 0.0,
             "PV": 0.0
         }
+        # The pump acknowledgements are not read, so leave the pump a short
+        # gap between commands.
+        self._command_gap = 0.1
 
     def _connect_instrument(self, port):
         """Connect to the Ismatec using RS232
@@ -199,7 +203,9 @@ if __name__ == "__main__":
         type=str,
         default="ape-53"
     )
+    add_instrument_arguments(parser)
     args = parser.parse_args()
     instrument = Ismatec(args.instrument_port, args.socket_ip,
-                         args.socket_port, args.host)
+                         args.socket_port, args.host,
+                         **instrument_options(args))
     instrument.run()
@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Append-only on-disk journal of the instrument data.
+
+The journal is a directory of segment files. Each segment is a preallocated,
+memory-mapped file of fixed size records:
+    header  - magic (4 bytes), schema size (uint32), capacity (uint64) and
+              record count (uint64), followed by the schema: the JSON list
+              of the journaled fields.
+    records - starting at the next multiple of 64 bytes, one
+              record per data update of len(fields) + 2 doubles: timestamp,
+              version and the value of each field (NaN if the field was
+              missing).
+Only numeric fields are journaled. A new segment is started when the current
+one is full or a new numeric field appears, and the oldest segments are
+deleted beyond the configured number of segments. Numbers are stored in the
+native byte order of the machine.
+"""
+import os
+import json
+import mmap
+import struct
+from math import isnan, nan
+
+__author__ = "Brent Maranzano"
+__license__ = "MIT"
+
+
+MAGIC = b"SIJ1"
+HEADER = struct.Struct("=4sIQQ")
+COUNT = struct.Struct("=Q")
+COUNT_OFFSET = 16
+SUFFIX = ".journal"
+
+
+def _numeric(value):
+    """Returns (bool) True if the value is journaled (int or float)."""
+    return not isinstance(value, bool) and isinstance(value, (int, float))
+
+
+class Segment(object):
+    """One memory-mapped segment file of the journal."""
+
+    def __init__(self, path, mm, fields, capacity, data_offset):
+        """Use Segment.create or Segment.open.
+
+        Arguments
+        path (str): File of the segment.
+        mm (mmap.mmap): Memory map of the file.
+        fields (tuple): Journaled fields.
+        capacity (int): Number of records the segment holds.
+        data_offset (int): Offset of the first record.
+        """
+        self.path = path
+        self.fields = fields
+        self.capacity = capacity
+        self._mm = mm
+        self._data_offset = data_offset
+        self._record = struct.Struct("={}d".format(len(fields) + 2))
+
+    @classmethod
+    def create(cls, path, fields, capacity):
+        """Create and map a new, empty segment file.
+
+        Arguments
+        path (str): File of the segment.
+        fields (tuple): Journaled fields.
+        capacity (int): Number of records the segment holds.
+
+        Returns (Segment) the segment, open for appending.
+        """
+        schema = json.dumps(list(fields)).encode("UTF-8")
+        data_offset = -(-(HEADER.size + len(schema)) // 64) * 64
+        size = data_offset + capacity * 8 * (len(fields) + 2)
+        with open(path, "w+b") as file_obj:
+            file_obj.truncate(size)
+            mm = mmap.mmap(file_obj.fileno(), size)
+        HEADER.pack_into(mm, 0, MAGIC, len(schema), capacity, 0)
+        mm[HEADER.size:HEADER.size + len(schema)] = schema
+        return cls(path, mm, tuple(fields), capacity, data_offset)
+
+    @classmethod
+    def open(cls, path):
+        """Map an existing segment file read-only.
+
+        Arguments
+        path (str): File of the segment.
+
+        Returns (Segment) the segment.
+        """
+        with open(path, "rb") as file_obj:
+            mm = mmap.mmap(file_obj.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, schema_size, capacity, _ = HEADER.unpack_from(mm, 0)
+        if magic != MAGIC:
+            raise ValueError("{} is not a journal segment".format(path))
+        fields = json.loads(mm[HEADER.size:HEADER.size + schema_size].decode("UTF-8"))
+        data_offset = -(-(HEADER.size + schema_size) // 64) * 64
+        return cls(path, mm, tuple(fields), capacity, data_offset)
+
+    @property
+    def count(self):
+        """Number of records in the segment."""
+        return COUNT.unpack_from(self._mm, COUNT_OFFSET)[0]
+
+    def append(self, timestamp, version, values):
+        """Append a record. The record count is updated after the record is
+        written, so readers never see a partial record.
+
+        Arguments
+        timestamp (float): Time of the data update.
+        version (int): Version of the data snapshot.
+        values (list): Value of each field.
+        """
+        count = self.count
+        offset = self._data_offset + count * self._record.size
+        self._record.pack_into(self._mm, offset, timestamp, version, *values)
+        COUNT.pack_into(self._mm, COUNT_OFFSET, count + 1)
+
+    def rows(self, start=0, stop=None):
+        """Get records without copying them.
+
+        Arguments
+        start (int): Index of the first record.
+        stop (int): Index after the last record (default count).
+
+        Returns (memoryview) the records as a 2-D view of doubles,
+            rows[i, 0] is the timestamp, rows[i, 1] the version and
+            rows[i, 2 + j] the value of fields[j].
+        """
+        if stop is None:
+            stop = self.count
+        stop = max(start, stop)
+        width = len(self.fields) + 2
+        begin = self._data_offset + start * 8 * width
+        end = self._data_offset + stop * 8 * width
+        return memoryview(self._mm)[begin:end].cast("d", shape=[stop - start, width])
+
+    def bisect(self, timestamp, right=False):
+        """Find the index of the first record at (or, if right, after) the
+        timestamp. Records are in time order.
+
+        Arguments
+        timestamp (float): Time to search.
+        right (bool): Skip records at the timestamp.
+
+        Returns (int) the index.
+        """
+        view = memoryview(self._mm)[self._data_offset:].cast("d")
+        width = len(self.fields) + 2
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            value = view[middle * width]
+            if value < timestamp or (right and value == timestamp):
+                low = middle + 1
+            else:
+                high = middle
+        view.release()
+        return low
+
+    def flush(self):
+        """Write the changes of the segment to disk."""
+        self._mm.flush()
+
+    def close(self):
+        """Unmap the segment file. Views from rows must be released first."""
+        self._mm.close()
+
+
+class JournalReader(object):
+    """Reads the journal of a directory, which may be written at the same
+    time by a Journal (in this or another process).
+    """
+
+    def __init__(self, directory):
+        """
+        Arguments
+        directory (str): Directory of the journal.
+        """
+        self._directory = directory
+
+    def segments(self):
+        """Get the time index of the journal.
+
+        Returns (list) a (first timestamp, path) tuple per segment, oldest
+        first.
+        """
+        index = []
+        for name in os.listdir(self._directory):
+            if name.endswith(SUFFIX):
+                # <first timestamp in ms>[-<number>].journal
+                parts = [int(part) for part in name[:-len(SUFFIX)].split("-")]
+                index.append((parts + [0], os.path.join(self._directory, name)))
+        return [(key[0] / 1000.0, path) for key, path in sorted(index)]
+
+    def read(self, since=None, until=None, limit=None):
+        """Get the records within a time range without copying them. since
+        is exclusive, so the timestamp of the last record read gives the
+        next page.
+
+        Arguments
+        since (float): Only records after this time (default all).
+        until (float): Only records at or before this time (default all).
+        limit (int): Maximum number of records (default all).
+
+        Yields (tuple) the fields and the records (see Segment.rows) of
+            each segment with records in the range, oldest first. The
+            records are only valid until the next segment is read, as each
+            segment is unmapped when done.
+        """
+        for first, path in self.segments():
+            if until is not None and first > until:
+                break
+            try:
+                segment = Segment.open(path)
+            except (OSError, ValueError):
+                # Deleted by the retention of the writer.
+                continue
+            try:
+                start = 0 if since is None else segment.bisect(since, right=True)
+                stop = segment.count if until is None else segment.bisect(until, right=True)
+                if limit is not None:
+                    stop = min(stop, start + limit)
+                if stop <= start:
+                    continue
+                rows = segment.rows(start, stop)
+                try:
+                    yield segment.fields, rows
+                finally:
+                    rows.release()
+            finally:
+                segment.close()
+            if limit is not None:
+                limit -= stop - start
+                if limit <= 0:
+                    break
+
+    def replay(self, since=None, until=None):
+        """Get the journaled data updates within a time range.
+
+        Arguments
+        since (float): Only records after this time (default all).
+        until (float): Only records at or before this time (default all).
+
+        Yields (tuple) the timestamp, version and data (dict) of each
+            record, oldest first.
+        """
+        for fields, rows in self.read(since, until):
+            for record in rows.tolist():
+                data = {field: value for field, value in zip(fields, record[2:])
+                        if not isnan(value)}
+                yield record[0], int(record[1]), data
+
+
+class Journal(object):
+    """Writes the numeric fields of every data update to a journal
+    directory. Only used by the update thread.
+    """
+
+    def __init__(self, directory, segment_records=86400, max_segments=7):
+        """
+        Arguments
+        directory (str): Directory of the journal (created if missing).
+        segment_records (int): Number of records per segment file.
+        max_segments (int): Number of segment files kept.
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self._segment_records = segment_records
+        self._max_segments = max_segments
+        self._segment = None
+
+    def append(self, timestamp, version, data):
+        """Journal a data update.
+
+        Arguments
+        timestamp (float): Time of the data update.
+        version (int): Version of the data snapshot.
+        data (dict): Instrument data.
+        """
+        segment = self._segment
+        if (segment is None or segment.count >= segment.capacity
+                or any(_numeric(value) and field not in segment.fields
+                       for field, value in data.items())):
+            segment = self._rotate(timestamp, data)
+        values = []
+        for field in segment.fields:
+            value = data.get(field)
+            values.append(value if _numeric(value) else nan)
+        segment.append(timestamp, version, values)
+
+    def _rotate(self, timestamp, data):
+        """Start a new segment and delete the oldest segments beyond
+        max_segments.
+
+        Arguments
+        timestamp (float): Time of the first record of the segment.
+        data (dict): Instrument data (defines the fields of the segment).
+
+        Returns (Segment) the new segment.
+        """
+        fields = [field for field, value in data.items() if _numeric(value)]
+        if self._segment is not None:
+            # Keep fields that are temporarily missing in the same columns.
+            fields = list(self._segment.fields) + [
+                field for field in fields if field not in self._segment.fields]
+            self._segment.flush()
+            self._segment.close()
+        name = "{:015d}".format(int(timestamp * 1000))
+        path = os.path.join(self.directory, name + SUFFIX)
+        number = 0
+        while os.path.exists(path):
+            number += 1
+            path = os.path.join(self.directory, "{}-{}{}".format(name, number, SUFFIX))
+        self._segment = Segment.create(path, fields, self._segment_records)
+        segments = JournalReader(self.directory).segments()
+        for _, old_path in segments[:max(0, len(segments) - self._max_segments)]:
+            os.remove(old_path)
+        return self._segment
+
+    def close(self):
+        """Flush the current segment to disk and unmap it."""
+        if self._segment is not None:
+            self._segment.flush()
+            self._segment.close()
+            self._segment = None
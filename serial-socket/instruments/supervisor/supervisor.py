@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Serves several serial instruments from one process and one socket.
+"""
+import logging
+import argparse
+import asyncio
+import importlib
+import yaml
+from collections import OrderedDict
+from instrument import SerialInstrument
+
+__author__ = "Brent Maranzano"
+__license__ = "MIT"
+
+logger = logging.getLogger(__name__)
+
+
+class InstrumentSupervisor(SerialInstrument):
+    """Hosts several instruments (one per serial port) in a single process.
+       The instruments are loaded from a configuration file of the form:
+           socket_ip: 0.0.0.0
+           socket_port: 54132
+           host: ape-0
+           instruments:
+               <instrument id>:
+                   driver: ika.ika.Ika
+                   instrument_port: /dev/ttyUSB0
+                   options: {update_interval: 1.0}
+       Each instrument keeps its own update and execute threads, data
+       snapshots, command queue, caches and subscribers. The supervisor
+       serves all of them on one listening socket and one event loop. A
+       request is routed by its "instrument" key to that instrument, e.g.
+           {
+               "instrument": <instrument id>,
+               "user": user_name,
+               "password": password,
+               "command": {"command_name": command_name, "parameters": ...}
+           }
+       Requests without an "instrument" key are answered by the supervisor
+       itself (get_about lists the instruments, set_framing, set_encoding).
+       This class over-rides the following base clase methods:
+           __init__
+           _get_about
+           _process_request
+           _close_connection
+           _serve
+           run
+    """
+
+    def __init__(self, config_file):
+        """Load the configuration, start listening on the socket and create
+        the configured instruments.
+
+        Arguments
+        config_file (str): YAML configuration file (see class description).
+        """
+        with open(config_file, 'rt') as file_obj:
+            config = yaml.safe_load(file_obj.read())
+        host = config.get("host", "ape-0")
+        super(InstrumentSupervisor, self).__init__(
+            None, config.get("socket_ip", "0.0.0.0"),
+            config.get("socket_port", 54132), host)
+        self._device_information = {
+            "instrument": "supervisor",
+            "description": "Serves several instruments on one socket.",
+        }
+        self._instruments = OrderedDict()
+        for instrument_id, settings in config["instruments"].items():
+            self._instruments[instrument_id] = self._load_instrument(
+                instrument_id, settings, host)
+
+    def _load_instrument(self, instrument_id, settings, host):
+        """Import the driver of an instrument and create the instrument
+        without a socket of its own.
+
+        Arguments
+        instrument_id (str): Id used to route requests to the instrument.
+        settings (dict): driver (module.Class), instrument_port and
+            (optional) options of the instrument.
+        host (str): name of host (e.g. ape-0)
+
+        Returns the instrument (SerialInstrument).
+        """
+        module_name, class_name = settings["driver"].rsplit(".", 1)
+        driver = getattr(importlib.import_module(module_name), class_name)
+        instrument = driver(settings["instrument_port"], None, None, host,
+                            **settings.get("options", {}))
+        instrument._instrument_id = instrument_id
+        instrument._logger = logging.getLogger(
+            "instrument_logger.{}".format(instrument_id))
+        self._logger.info("loaded instrument {} ({}) on {}".format(
+            instrument_id, settings["driver"], settings["instrument_port"]))
+        return instrument
+
+    def _get_about(self):
+        """Get information about the supervisor and its instruments.
+
+        Returns (dict) the response to send to the client.
+        """
+        response = super(InstrumentSupervisor, self)._get_about()
+        response["instruments"] = {
+            instrument_id: instrument._get_about()
+            for instrument_id, instrument in self._instruments.items()
+        }
+        return response
+
+    def _process_request(self, request, connection=None):
+        """Route the request to the instrument given by its "instrument"
+        key. Requests without the key are for the supervisor.
+
+        Arguments:
+        request (dict): Command and command parameters to be executed.
+        connection (dict): State of the client connection that sent the request.
+
+        Returns the response of the instrument (see
+            SerialInstrument._process_request).
+        """
+        instrument_id = request.get("instrument")
+        if instrument_id is not None:
+            instrument = self._instruments.get(instrument_id)
+            if instrument is None:
+                self._logger.error("request for unknown instrument {}".format(instrument_id))
+                return {
+                    "socket status": "error",
+                    "description": "instrument '{}' not found".format(instrument_id)
+                }
+            return instrument._process_request(request, connection)
+        command_name = request["command"]["command_name"]
+        if command_name == "get_about":
+            return self._get_about()
+        elif command_name == "set_framing":
+            return self._set_framing(request["command"].get("parameters"), connection)
+        elif command_name == "set_encoding":
+            return self._set_encoding(request["command"].get("parameters"), connection)
+        return {
+            "socket status": "error",
+            "description": "request requires an instrument id, one of {}".format(
+                ", ".join(self._instruments))
+        }
+
+    def _close_connection(self, connection):
+        """Release the state kept by every instrument for a client
+        connection that closed.
+
+        Arguments:
+        connection (dict): State of the client connection.
+        """
+        for instrument in self._instruments.values():
+            instrument._close_connection(connection)
+
+    async def _serve(self):
+        """Serve client connections for all the instruments until the
+        event loop is stopped.
+        """
+        loop = asyncio.get_running_loop()
+        for instrument in self._instruments.values():
+            instrument._loop = loop
+        await super(InstrumentSupervisor, self)._serve()
+
+    def run(self):
+        """Start the threads of every instrument and run the socket server.
+        """
+        for instrument in self._instruments.values():
+            instrument._start_threads()
+        self._logger.info("Supervisor run started with {} instruments.".format(
+            len(self._instruments)))
+        asyncio.run(self._serve())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="multi-instrument socket server")
+    parser.add_argument(
+        "--config",
+        help="YAML file with the socket settings and the instruments",
+        type=str,
+        default="supervisor/supervisor_conf.yml"
+    )
+    args = parser.parse_args()
+    supervisor = InstrumentSupervisor(args.config)
+    supervisor.run()
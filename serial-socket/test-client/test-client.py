@@ -1,9 +1,10 @@
-import socket
 import argparse
 import logging
 from time import sleep
 from pdb import set_trace
 import json
+from instrument_client import Connection
+
 
 class TestClient(object):
     """Create a socket client to test the serial-socket FakeInstrument.
@@ -13,7 +14,7 @@ class TestClient(object):
         self._username = "myName"
         self._password = "myPassword"
         self._setup_logger()
-        self._sock = self._make_connection(socket_ip, socket_port)
+        self._connection = self._make_connection(socket_ip, socket_port)
 
     def _setup_logger(self):
         """Start the logger.
@@ -26,10 +27,10 @@ class TestClient(object):
         self._logger.info("instrument client logger setup")
 
     def _make_connection(self, ip, port):
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.connect((ip, port))
-        self._logger.info("connected to socket:\n{}".format(sock))
-        return sock
+        """Open a persistent, length framed connection to the socket."""
+        connection = Connection(ip, port, logger=self._logger)
+        connection.connect()
+        return connection
 
     def get_about(self):
         message = {
@@ -120,11 +121,8 @@ class TestClient(object):
         self._send_message(message)
 
     def _send_message(self, message):
-        message = json.dumps(message)
-        self._logger.info("sending message:\n{}".format(message))
-        self._sock.sendall(message.encode('ascii'))
-        received = self._sock.recv(4096)
-        received = json.loads(received.decode('ascii'))
+        self._logger.info("sending message:\n{}".format(json.dumps(message)))
+        received = self._connection.request(message)
         self._logger.info("received message:\n{}".format(received))
         return
 
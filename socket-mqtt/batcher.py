@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Batching of data samples into fewer MQTT messages.
+"""
+import threading
+from time import monotonic
+
+__author__ = "Brent Maranzano"
+__license__ = "MIT"
+
+
+class Batcher(object):
+    """Collects the samples of each topic and hands them to the publish
+    function in batches. A batch is flushed when it holds max_samples
+    samples or its oldest sample is max_age seconds old, whichever comes
+    first. The flush policy of a topic is looked up by the full topic, then
+    by the Sparkplug message type of the topic (e.g. "NDATA"), else the
+    default policy is used, e.g.
+        policies = {"NDATA": {"max_samples": 50, "max_age": 1.0}}
+    """
+
+    def __init__(self, publish, max_samples=1, max_age=0.0, policies=None):
+        """
+        Arguments
+        publish (function): Called as publish(topic, samples, batched) with
+            the list of samples of a batch; batched is False if the policy
+            of the topic publishes every sample on its own.
+        max_samples (int): Default maximum number of samples per batch.
+        max_age (float): Default maximum time (s) a sample waits in a
+            batch, 0 to only flush full batches.
+        policies (dict): Flush policies by topic or message type.
+        """
+        self._publish = publish
+        self._default = {"max_samples": max_samples, "max_age": max_age}
+        self._policies = policies or {}
+        for policy in [self._default] + list(self._policies.values()):
+            if int(policy.get("max_samples", 1)) < 1:
+                raise ValueError("max_samples must be at least 1: {}".format(policy))
+        # Open batches by topic: {"samples": [...], "deadline": <monotonic>}
+        self._batches = {}
+        # Samples are published with the condition held, so the batches of
+        # a topic are published in order.
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._flush_expired, daemon=True)
+        self._thread.start()
+
+    def policy(self, topic):
+        """Get the flush policy of a topic.
+
+        Arguments
+        topic (str): MQTT topic.
+
+        Returns (dict) max_samples and max_age of the topic.
+        """
+        parts = topic.split("/")
+        policy = self._policies.get(topic)
+        if policy is None and len(parts) > 2:
+            policy = self._policies.get(parts[2])
+        if policy is None:
+            return self._default
+        return {
+            "max_samples": int(policy.get("max_samples", self._default["max_samples"])),
+            "max_age": float(policy.get("max_age", self._default["max_age"]))
+        }
+
+    def add(self, topic, sample):
+        """Add a sample to the batch of its topic, publishing the batch if
+        it is full.
+
+        Arguments
+        topic (str): MQTT topic.
+        sample (dict): Data sample.
+        """
+        policy = self.policy(topic)
+        with self._condition:
+            batch = self._batches.get(topic)
+            if batch is None:
+                deadline = None
+                if policy["max_age"] > 0:
+                    deadline = monotonic() + policy["max_age"]
+                batch = {"samples": [], "deadline": deadline, "policy": policy}
+                self._batches[topic] = batch
+                self._condition.notify()
+            batch["samples"].append(sample)
+            if len(batch["samples"]) >= policy["max_samples"]:
+                del self._batches[topic]
+                self._publish(topic, batch["samples"], policy["max_samples"] > 1)
+
+    def flush(self):
+        """Publish every open batch."""
+        with self._condition:
+            for topic, batch in list(self._batches.items()):
+                del self._batches[topic]
+                self._publish(topic, batch["samples"], batch["policy"]["max_samples"] > 1)
+
+    def _flush_expired(self):
+        """Publish the batches whose oldest sample reached max_age. Runs in
+        its own thread.
+        """
+        with self._condition:
+            while True:
+                now = monotonic()
+                deadlines = [batch["deadline"] for batch in self._batches.values()
+                             if batch["deadline"] is not None]
+                for topic, batch in list(self._batches.items()):
+                    if batch["deadline"] is not None and batch["deadline"] <= now:
+                        del self._batches[topic]
+                        self._publish(topic, batch["samples"],
+                                      batch["policy"]["max_samples"] > 1)
+                pending = [deadline for deadline in deadlines if deadline > now]
+                self._condition.wait(min(pending) - now if pending else None)
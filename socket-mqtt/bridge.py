@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Bridge of many instrument sockets to one MQTT connection, using asyncio.
+"""
+import asyncio
+import json
+import threading
+from time import monotonic, time
+from instrument_client import AsyncConnection
+from outbox import Outbox
+from batcher import Batcher
+from deadband import DeadbandFilter
+from dispatcher import command_ack, command_status, status_request
+from sparkplug import SparkplugNode
+from socket_mqtt import SocketMqtt
+
+__author__ = "Brent Maranzano"
+__license__ = "MIT"
+
+# Seconds before the bridge of a failed instrument is restarted.
+RESTART_DELAY = 5.0
+
+
+class MqttBridge(SocketMqtt):
+    """SocketMqtt for several instruments: one event loop holds a subscribed
+    connection to every instrument socket and all of them share one MQTT
+    connection, outbox and batcher. Each instrument is published as its own
+    Sparkplug device, with the topics of SocketMqtt
+        spBv1.0/<group>/NBIRTH/<host>/<device_id>
+        spBv1.0/<group>/NDATA/<host>/<device_id>
+    where host is the host of the instrument's about. DCMD commands are
+    routed by the host and device id of their topic to the instrument, and
+    executed one at a time per instrument; their acknowledgement is
+    published as DACK, like in SocketMqtt. An instrument that is unreachable
+    is retried in the background and born (NBIRTH) once it answers, without
+    holding up the others.
+    Instruments are given as a list of
+        {"socket_host": "fake", "socket_port": 54132, "device_id": "fake"}
+    with an optional "instrument" key, the id of the instrument on a
+    supervisor socket (see serial-socket/instruments/supervisor).
+    With the "sparkplug" payload encoding every host is a Sparkplug edge
+    node (NBIRTH once per MQTT session, then a DBIRTH per instrument, and
+    DDATA), as in SocketMqtt, except that the bridge has no NDEATH will, as
+    one MQTT connection carries several nodes.
+    """
+
+    def __init__(self, instruments, mqtt_broker="", group_id="proto",
+                 socket_encoding="json", payload_encoding="json",
+                 outbox_size=1000, spool_dir=None, spool_files=1000,
+                 replay_rate=50.0, replay_batch=20,
+                 batch_size=1, batch_interval=0.0, flush_policies=None,
+                 report_by_exception=False, deadbands=None, heartbeat=60.0,
+                 socket_timeout=10.0, command_queue_size=100, command_wait=5.0):
+        """Start the logger and connect to the MQTT broker. The instrument
+        sockets are connected by run.
+
+        Arguments:
+        instruments (list): Instrument sockets (see class description).
+        Other arguments as in SocketMqtt; command_queue_size applies per
+        instrument.
+        """
+        self._group_id = group_id
+        self._setup_logger()
+        self._check_encodings(socket_encoding, payload_encoding)
+        self._socket_encoding = socket_encoding
+        self._payload_encoding = payload_encoding
+        self._sparkplug = None
+        # Sparkplug nodes by host.
+        self._nodes = {}
+        self._socket_timeout = socket_timeout
+        self._command_queue_size = command_queue_size
+        self._command_wait = command_wait
+        self._devices = []
+        for settings in instruments:
+            device = {
+                "socket_host": settings["socket_host"],
+                "socket_port": int(settings["socket_port"]),
+                "device_id": settings["device_id"],
+                "instrument": settings.get("instrument"),
+                "about": None,
+                "topics": None,
+                "data": None,
+                "filter": None,
+                "commands": None
+            }
+            if report_by_exception:
+                device["filter"] = DeadbandFilter(deadbands, heartbeat)
+            self._devices.append(device)
+        # Devices by (host, device_id), once their about is known.
+        self._routes = {}
+        self._hosts = set()
+        # Guards the routes, hosts, nodes and device state, which the MQTT
+        # callbacks and the event loop both change.
+        self._state_lock = threading.RLock()
+        self._loop = None
+        self._outbox = Outbox(outbox_size, spool_dir, spool_files)
+        self._replay_rate = replay_rate
+        self._replay_batch = replay_batch
+        self._connected = threading.Event()
+        # Cleared by the on_disconnect of SocketMqtt; sessions of the bridge
+        # start in its own on_connect.
+        self._session_pending = threading.Event()
+        self._batcher = Batcher(self._publish_samples, batch_size, batch_interval,
+                                flush_policies)
+        client_id = "{}-bridge-{}".format(group_id, self._devices[0]["device_id"])
+        self._mqttc = self._setup_mqtt(mqtt_broker, client_id)
+        self._logger.info("Bridge of {} instruments initiated".format(len(self._devices)))
+
+    def _request(self, device, command_name, parameters=None):
+        """Returns (dict) a request message for the instrument of a device."""
+        message = {
+            "user": None,
+            "password": None,
+            "command": {
+                "command_name": command_name,
+                "parameters": parameters
+            }
+        }
+        if device["instrument"] is not None:
+            message["instrument"] = device["instrument"]
+        return message
+
+    def _birth(self, device):
+        """Subscribe to the commands of the host of a device and publish its
+        NBIRTH message (with Sparkplug payloads the NBIRTH of the host, once
+        per MQTT session, then the DBIRTH of the device). Called on every
+        MQTT connect, and when the device (re)connects while MQTT is
+        connected.
+
+        Arguments:
+        device (dict): Device with a known about.
+        """
+        with self._state_lock:
+            host = device["about"]["host"]
+            device["topics"] = self._device_topics(host, device["device_id"])
+            self._routes[(host, device["device_id"])] = device
+            if self._payload_encoding == "sparkplug" and host not in self._nodes:
+                self._nodes[host] = SparkplugNode()
+            if not self._connected.is_set():
+                return
+            if device["filter"] is not None:
+                device["filter"].reset()
+            if host not in self._hosts:
+                self._mqttc.subscribe(device["topics"]["DCMD"])
+                self._hosts.add(host)
+                self._logger.debug("set subscribe topic: {}".format(device["topics"]["DCMD"]))
+                if self._payload_encoding == "sparkplug":
+                    self._mqttc.subscribe(device["topics"]["NCMD"])
+                    self._mqttc.publish(device["topics"]["NBIRTH"],
+                                        payload=self._nodes[host].node_birth(),
+                                        qos=0, retain=False)
+            if self._payload_encoding == "sparkplug":
+                self._publish_device_birth(device["topics"]["DATA"])
+                return
+            about = dict(device["about"])
+            about["payload_encoding"] = self._payload_encoding
+            if device["filter"] is not None and device["data"] is not None:
+                about["metrics"] = device["data"]
+            self._mqttc.publish(device["topics"]["NBIRTH"], payload=json.dumps(about),
+                                qos=1, retain=True)
+
+    def _sparkplug_node(self, topic):
+        """Returns (SparkplugNode) the Sparkplug node of the host of a topic."""
+        return self._nodes[topic.split("/")[3]]
+
+    def _publish_device_birth(self, topic):
+        """Publish the Sparkplug DBIRTH message of the device of a data
+        topic.
+
+        Arguments:
+        topic (str): DDATA topic of the device.
+        """
+        parts = topic.split("/")
+        with self._state_lock:
+            device = self._routes[(parts[3], parts[4])]
+            node = self._nodes[parts[3]]
+            payload = node.device_birth(device["device_id"], device["about"], device["data"])
+            self._mqttc.publish(device["topics"]["DBIRTH"], payload=node.stamp(payload),
+                                qos=0, retain=False)
+
+    def _rebirth(self, client, topic):
+        """Publish the births of a host again, as requested by a Sparkplug
+        NCMD.
+
+        Arguments:
+        client (mqtt.Client): MQTT client.
+        topic (str): NCMD topic of the request.
+        """
+        host = topic.split("/")[3]
+        with self._state_lock:
+            self._hosts.discard(host)
+            for device in self._devices:
+                if device["about"] is not None and device["about"]["host"] == host:
+                    self._birth(device)
+
+    def _create_mqtt_on_connect(self):
+        """Create a function for the MQTT on_connect callback, which
+        subscribes to the commands and publishes the NBIRTH of every device
+        whose instrument answered.
+
+        Return function
+        """
+        def on_connect(client, userdata, flags, rc):
+            if rc != 0:
+                self._logger.error("MQTT connection refused: {}".format(rc))
+                return
+            with self._state_lock:
+                self._hosts.clear()
+                self._connected.set()
+                for device in self._devices:
+                    if device["about"] is not None:
+                        self._birth(device)
+        return on_connect
+
+    def _create_mqtt_on_message(self):
+        """Create a function for the MQTT on_message callback, which hands
+        the command to the event loop, to be queued for its device.
+
+        Return function
+        """
+        def on_message(client, userdata, message):
+            try:
+                payload = self._decode_command(client, message)
+            except Exception as err:
+                self._logger.error("could not decode command on {}: {}".format(
+                    message.topic, err))
+                return
+            if payload is None:
+                return
+            parts = message.topic.split("/")
+            device = self._routes.get(tuple(parts[3:5]))
+            if device is None or self._loop is None:
+                self._logger.warning("no device for command on {}".format(message.topic))
+                return
+            self._loop.call_soon_threadsafe(self._submit, device, message.topic, payload, time())
+        return on_message
+
+    def _submit(self, device, topic, message, received):
+        """Queue a command for its device, or reject it if the queue of the
+        device is full. Called in the event loop.
+        """
+        try:
+            device["commands"].put_nowait((topic, message, received, monotonic()))
+        except asyncio.QueueFull:
+            self._logger.warning("command queue of {} full, rejected: {}".format(
+                device["device_id"], message))
+            self._publish_command_ack(topic, command_ack(
+                message, "rejected", {"description": "command queue is full"}, received,
+                0.0, 0.0))
+
+    async def _execute_commands(self, device, connection):
+        """Execute the queued commands of a device, one at a time."""
+        while True:
+            topic, message, received, queued_at = await device["commands"].get()
+            if device["instrument"] is not None and isinstance(message, dict):
+                message.setdefault("instrument", device["instrument"])
+            start = monotonic()
+            try:
+                response = await connection.request(message)
+                request = status_request(message, response, self._command_wait)
+                if request is not None:
+                    response = await connection.request(request, retry=True)
+                status = command_status(response)
+            except Exception as err:
+                response = {"description": str(err)}
+                status = "failed"
+            try:
+                self._publish_command_ack(topic, command_ack(
+                    message, status, response, received, start - queued_at,
+                    monotonic() - start))
+            except Exception as err:
+                self._logger.warning("could not acknowledge command on {}: {}".format(
+                    topic, err))
+
+    async def _run_device(self, device):
+        """Bridge one instrument: keep a subscribed connection to its socket,
+        publish its data and execute its commands. Runs as a task.
+        """
+        async def subscribe(connection):
+            about = await connection.request(self._request(device, "get_about"), retry=True)
+            if not isinstance(about, dict) or "host" not in about:
+                raise ConnectionError("could not get about of {}: {}".format(
+                    device["device_id"], about))
+            received = await connection.request(self._request(device, "subscribe"))
+            if not received.get("subscribed"):
+                self._logger.error("subscription of {} refused: {}".format(
+                    device["device_id"], received))
+                raise ConnectionError("could not subscribe to device data")
+            self._logger.info("subscribed to data of {}".format(device["device_id"]))
+            with self._state_lock:
+                device["about"] = about
+                self._birth(device)
+
+        device["commands"] = asyncio.Queue(maxsize=self._command_queue_size)
+        connection = AsyncConnection(device["socket_host"], device["socket_port"],
+                                     encoding=self._socket_encoding,
+                                     timeout=self._socket_timeout, on_connect=subscribe,
+                                     logger=self._logger)
+        await connection.start()
+        worker = asyncio.ensure_future(self._execute_commands(device, connection))
+        try:
+            while True:
+                received = await connection.receive()
+                if received.get("push") != "data" or device["about"] is None:
+                    continue
+                data = dict(received["data"])
+                data["timestamp"] = received["timestamp"]
+                with self._state_lock:
+                    device["data"] = data
+                    if device["filter"] is not None:
+                        data = device["filter"].filter(data)
+                    topic = device["topics"]["DATA"]
+                if data is not None:
+                    self._batcher.add(topic, data)
+        finally:
+            worker.cancel()
+            await connection.close()
+
+    async def _watch_device(self, device):
+        """Run the bridge of one instrument, restarting it if it fails, so
+        that one instrument can not stop the others.
+        """
+        while True:
+            try:
+                await self._run_device(device)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self._logger.exception("bridge of {} failed, restart in {} s".format(
+                    device["device_id"], RESTART_DELAY))
+            await asyncio.sleep(RESTART_DELAY)
+
+    async def _run_devices(self):
+        """Run the bridge of every instrument."""
+        self._loop = asyncio.get_event_loop()
+        await asyncio.gather(*[self._watch_device(device) for device in self._devices])
+
+    def run(self):
+        """Start the MQTT service loop and the outbox replay, then bridge the
+        instruments until stopped.
+        """
+        self._logger.info("Starting MQTT Loop")
+        self._mqttc.loop_start()
+        replay_thread = threading.Thread(target=self._replay_outbox, daemon=True)
+        replay_thread.start()
+        asyncio.run(self._run_devices())
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Report-by-exception filtering of the data samples published on MQTT.
+"""
+import threading
+from time import monotonic
+
+__author__ = "Brent Maranzano"
+__license__ = "MIT"
+
+
+class DeadbandFilter(object):
+    """Reduces data samples to the metrics worth reporting:
+        1. A numeric metric is reported when it moved out of its deadband
+           around the last reported value. The deadband of a metric is
+           configured as an absolute and/or a percent (of the last reported
+           value) threshold; with both, the larger band applies. The "*"
+           entry is the deadband of metrics without their own entry, e.g.
+               {"PV_speed": {"absolute": 0.5}, "*": {"percent": 1.0}}
+           Metrics without a deadband are reported on any change.
+        2. Other metrics are reported when their value changed.
+        3. Every metric is reported at least every heartbeat seconds.
+        4. After reset (e.g. on NBIRTH) the next sample is reported in full.
+    """
+
+    def __init__(self, deadbands=None, heartbeat=60.0):
+        """
+        Arguments
+        deadbands (dict): Deadbands by metric (see class description).
+        heartbeat (float): Maximum time (s) a metric is not reported, 0 for
+            no heartbeat.
+        """
+        self._deadbands = deadbands or {}
+        self._heartbeat = heartbeat
+        # Last reported value and time of each metric.
+        self._reported = {}
+        self._lock = threading.Lock()
+
+    def reset(self):
+        """Forget the reported values, so the next sample is reported in
+        full."""
+        with self._lock:
+            self._reported = {}
+
+    def filter(self, sample):
+        """Reduce a sample to the metrics to report.
+
+        Arguments
+        sample (dict): Data sample (with "timestamp").
+
+        Returns (dict) the metrics to report and the timestamp, None if
+            there is nothing to report.
+        """
+        now = monotonic()
+        report = {}
+        with self._lock:
+            for field, value in sample.items():
+                if field == "timestamp":
+                    continue
+                reported = self._reported.get(field)
+                if (reported is None or self._exceeds(field, value, reported[0])
+                        or (self._heartbeat > 0 and now - reported[1] >= self._heartbeat)):
+                    report[field] = value
+                    self._reported[field] = (value, now)
+        if not report:
+            return None
+        if "timestamp" in sample:
+            report["timestamp"] = sample["timestamp"]
+        return report
+
+    def _exceeds(self, field, value, reported):
+        """Check if a value left the deadband of a metric.
+
+        Arguments
+        field (str): Name of the metric.
+        value: New value of the metric.
+        reported: Last reported value of the metric.
+
+        Returns (bool) True if the value has to be reported.
+        """
+        numeric = all(isinstance(v, (int, float)) and not isinstance(v, bool)
+                      for v in (value, reported))
+        deadband = self._deadbands.get(field, self._deadbands.get("*"))
+        if not numeric or deadband is None:
+            return value != reported
+        band = max(float(deadband.get("absolute", 0.0)),
+                   float(deadband.get("percent", 0.0)) / 100.0 * abs(reported))
+        if band == 0:
+            return value != reported
+        return abs(value - reported) > band
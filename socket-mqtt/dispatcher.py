@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Dispatching of the commands received on MQTT to the instrument socket.
+"""
+import logging
+import queue
+import threading
+from time import monotonic, time
+
+__author__ = "Brent Maranzano"
+__license__ = "MIT"
+
+# Statuses of the command acknowledgements.
+STATUSES = ("done", "failed", "rejected", "queued", "cancelled", "coalesced")
+
+
+def command_status(response):
+    """Get the status of an executed command from the instrument response,
+    which is the command status record (see status_request) for commands
+    the instrument queued.
+
+    Arguments
+    response: Response of the instrument socket.
+
+    Returns (str) "done", "failed", "cancelled" or "coalesced" (superseded
+        by a later command), or "queued" if the command has not finished.
+    """
+    if (not isinstance(response, dict) or response.get("socket status") == "error"
+            or response.get("status") == "failed"):
+        return "failed"
+    state = response.get("state")
+    if state in ("failed", "cancelled", "coalesced"):
+        return state
+    if state in ("queued", "running") or (state is None and "command_id" in response):
+        return "queued"
+    return "done"
+
+
+def status_request(message, response, wait):
+    """Create the request for the status of a command that the instrument
+    queued, which responds once the command finished (or after wait
+    seconds).
+
+    Arguments
+    message (dict): Command message.
+    response: Response of the instrument socket to the command.
+    wait (float): Seconds the instrument waits for the command to finish.
+
+    Returns (dict) the get_command_status request, None if the command was
+        not queued or wait is 0.
+    """
+    if (wait <= 0 or not isinstance(response, dict) or "command_id" not in response
+            or "state" in response):
+        return None
+    request = {
+        "user": message.get("user"),
+        "password": message.get("password"),
+        "command": {
+            "command_name": "get_command_status",
+            "parameters": {"command_id": response["command_id"], "wait": wait}
+        }
+    }
+    if "instrument" in message:
+        request["instrument"] = message["instrument"]
+    return request
+
+
+def command_ack(message, status, response, received, queued, latency):
+    """Create the acknowledgement of a command (see CommandDispatcher).
+
+    Arguments
+    message (dict): Command message.
+    status (str): "rejected" or a status of command_status.
+    response: Response of the instrument socket.
+    received (float): Time (epoch s) the command was received.
+    queued (float): Seconds the command waited in the queue.
+    latency (float): Seconds the command took to execute.
+
+    Returns (dict) the acknowledgement.
+    """
+    command = message.get("command") if isinstance(message, dict) else None
+    ack = {
+        "command_name": command.get("command_name") if isinstance(command, dict) else None,
+        "status": status,
+        "response": response,
+        "received": received,
+        "queued": queued,
+        "latency": latency
+    }
+    if isinstance(message, dict) and "request_id" in message:
+        ack["request_id"] = message["request_id"]
+    return ack
+
+
+class CommandDispatcher(object):
+    """Bounded queue of commands that a worker thread executes one at a
+    time, in the order received, so the MQTT network thread never waits for
+    the instrument. Every command is acknowledged with
+        {"command_name": ..., "status": "done"|"failed"|"rejected"|...,
+         "response": <instrument response>, "received": <epoch s>,
+         "queued": <s waited in the queue>, "latency": <s to execute>}
+    plus the "request_id" of the command message, if it has one (see
+    command_status for the other statuses). A command that finds the queue
+    full is rejected right away. The command statistics (see stats) are
+    logged every stats_interval seconds while commands arrive.
+    """
+
+    def __init__(self, execute, acknowledge, queue_size=100, stats_interval=60.0,
+                 logger=None):
+        """
+        Arguments
+        execute (function): Called as execute(message) in the worker
+            thread; returns the instrument response.
+        acknowledge (function): Called as acknowledge(topic, ack) with the
+            topic of the command and the acknowledgement.
+        queue_size (int): Maximum number of waiting commands.
+        stats_interval (float): Seconds between logs of the statistics.
+        logger (logging.Logger): Logger (default the module logger).
+        """
+        self._execute = execute
+        self._acknowledge = acknowledge
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._stats = dict.fromkeys(STATUSES, 0)
+        self._stats.update(latency=0.0, max_latency=0.0)
+        self._lock = threading.Lock()
+        self._stats_interval = stats_interval
+        self._stats_logged = monotonic()
+        self._logger = logger or logging.getLogger(__name__)
+        self._thread = threading.Thread(target=self._work, daemon=True)
+        self._thread.start()
+
+    def submit(self, topic, message):
+        """Queue a command.
+
+        Arguments
+        topic (str): MQTT topic the command was received on.
+        message (dict): Command message for the instrument socket.
+
+        Returns (bool) False if the command was rejected.
+        """
+        try:
+            self._queue.put_nowait((topic, message, time(), monotonic()))
+        except queue.Full:
+            self._finish(topic, message, time(), "rejected",
+                         {"description": "command queue is full"}, 0.0, 0.0)
+            return False
+        return True
+
+    def stats(self):
+        """Returns (dict) the number of commands by status, the mean and
+        maximum execution latency (s) and the number of "waiting" commands.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+        executed = sum(stats[status] for status in STATUSES if status != "rejected")
+        stats["latency"] = stats["latency"] / executed if executed else 0.0
+        stats["waiting"] = self._queue.qsize()
+        return stats
+
+    def _work(self):
+        """Execute the queued commands. Runs in its own thread."""
+        while True:
+            topic, message, received, queued_at = self._queue.get()
+            start = monotonic()
+            try:
+                response = self._execute(message)
+                status = command_status(response)
+            except Exception as err:
+                response = {"description": str(err)}
+                status = "failed"
+            self._finish(topic, message, received, status, response,
+                         start - queued_at, monotonic() - start)
+
+    def _finish(self, topic, message, received, status, response, queued, latency):
+        """Record and acknowledge a command."""
+        with self._lock:
+            self._stats[status] += 1
+            if status != "rejected":
+                self._stats["latency"] += latency
+                self._stats["max_latency"] = max(self._stats["max_latency"], latency)
+            log_stats = monotonic() - self._stats_logged >= self._stats_interval
+            if log_stats:
+                self._stats_logged = monotonic()
+        try:
+            self._acknowledge(topic, command_ack(message, status, response, received,
+                                                 queued, latency))
+        except Exception as err:
+            self._logger.warning("could not acknowledge command on {}: {}".format(topic, err))
+        if log_stats:
+            self._logger.info("command stats: {}".format(self.stats()))
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Store-and-forward outbox of the MQTT messages that could not be published.
+"""
+import os
+import struct
+import threading
+from collections import deque
+
+__author__ = "Brent Maranzano"
+__license__ = "MIT"
+
+# Topic and payload sizes of a message in a spool file.
+RECORD = struct.Struct("!HI")
+SUFFIX = ".spool"
+
+
+class Outbox(object):
+    """Thread safe, bounded FIFO of (topic, payload) messages.
+        1. Messages are kept in memory up to memory_size messages.
+        2. If a spool directory is given, a full memory is written to a new
+           spool file, up to spool_files files (the oldest file is dropped
+           beyond that). Spool files left by a previous run are sent first.
+        3. Without a spool directory the oldest message is dropped when the
+           memory is full.
+    Messages are taken in batches (get_batch) and either acknowledged
+    (done) or put back at the front (requeue) if publishing failed.
+    """
+
+    def __init__(self, memory_size=1000, spool_dir=None, spool_files=1000):
+        """
+        Arguments
+        memory_size (int): Number of messages kept in memory.
+        spool_dir (str): Directory of the spool files, None to not spool.
+        spool_files (int): Maximum number of spool files.
+        """
+        self._memory_size = memory_size
+        self._spool_dir = spool_dir
+        self._spool_files = spool_files
+        # Oldest messages, loaded from a spool file or requeued.
+        self._front = deque()
+        self._memory = deque()
+        self._files = deque()
+        self._in_flight = 0
+        self._sequence = 0
+        self.dropped = 0
+        self._lock = threading.Lock()
+        if spool_dir is not None:
+            os.makedirs(spool_dir, exist_ok=True)
+            names = sorted(name for name in os.listdir(spool_dir) if name.endswith(SUFFIX))
+            self._files.extend(os.path.join(spool_dir, name) for name in names)
+            if names:
+                self._sequence = int(names[-1][:-len(SUFFIX)]) + 1
+
+    def pending(self):
+        """Returns (bool) True if messages are queued or being published."""
+        with self._lock:
+            return bool(self._in_flight or self._front or self._memory or self._files)
+
+    def put(self, topic, payload):
+        """Queue a message.
+
+        Arguments
+        topic (str): MQTT topic.
+        payload (bytes): MQTT payload.
+        """
+        with self._lock:
+            if len(self._memory) >= self._memory_size:
+                if self._spool_dir is None:
+                    self._memory.popleft()
+                    self.dropped += 1
+                else:
+                    self._spool()
+            self._memory.append((topic, payload))
+
+    def get_batch(self, size):
+        """Take the oldest messages for publishing. They have to be
+        acknowledged with done or put back with requeue.
+
+        Arguments
+        size (int): Maximum number of messages.
+
+        Returns (list) the (topic, payload) messages, oldest first.
+        """
+        with self._lock:
+            if not self._front and self._files:
+                self._front.extend(self._load(self._files.popleft()))
+            source = self._front if self._front else self._memory
+            batch = [source.popleft() for _ in range(min(size, len(source)))]
+            self._in_flight += len(batch)
+            return batch
+
+    def done(self, count):
+        """Acknowledge published messages.
+
+        Arguments
+        count (int): Number of messages published.
+        """
+        with self._lock:
+            self._in_flight -= count
+
+    def requeue(self, messages):
+        """Put messages that could not be published back at the front.
+
+        Arguments
+        messages (list): The (topic, payload) messages, oldest first.
+        """
+        with self._lock:
+            self._in_flight -= len(messages)
+            self._front.extendleft(reversed(messages))
+
+    def _spool(self):
+        """Write the messages in memory to a new spool file. Called with
+        the lock held.
+        """
+        path = os.path.join(self._spool_dir, "{:012d}{}".format(self._sequence, SUFFIX))
+        self._sequence += 1
+        with open(path, "wb") as file_obj:
+            for topic, payload in self._memory:
+                topic = topic.encode("UTF-8")
+                file_obj.write(RECORD.pack(len(topic), len(payload)) + topic + payload)
+        self._memory.clear()
+        self._files.append(path)
+        while len(self._files) > self._spool_files:
+            old_path = self._files.popleft()
+            self.dropped += len(self._load(old_path))
+
+    def _load(self, path):
+        """Read and delete a spool file.
+
+        Arguments
+        path (str): Spool file.
+
+        Returns (list) the (topic, payload) messages of the file.
+        """
+        messages = []
+        with open(path, "rb") as file_obj:
+            buffer = file_obj.read()
+        os.remove(path)
+        offset = 0
+        while offset + RECORD.size <= len(buffer):
+            topic_size, payload_size = RECORD.unpack_from(buffer, offset)
+            offset += RECORD.size
+            topic = buffer[offset:offset + topic_size].decode("UTF-8")
+            offset += topic_size
+            messages.append((topic, buffer[offset:offset + payload_size]))
+            offset += payload_size
+        return messages
@@ -3,7 +3,8 @@
 """
 Module to convert between from MQTT to socket and conversely.
 """
-import socket
+import threading
+from time import sleep
 import argparse
 import logging
 import logging.config
@@ -11,11 +12,30 @@ import json
 import yaml
 import coloredlogs
 import paho.mqtt.client as mqtt
-from time import sleep
+from outbox import Outbox
+from batcher import Batcher
+from deadband import DeadbandFilter
+from dispatcher import CommandDispatcher, status_request
+from sparkplug import REBIRTH, SparkplugNode, decode_payload
+from instrument_client import (Connection, ConnectionPool, available_encodings,
+                               decode_message, encode_message)
 
 __author__ = "Brent Maranzano"
 __license__ = "MIT"
 
+# Encodings of the socket messages and the MQTT payloads.
+ENCODINGS = ("json", "msgpack", "cbor")
+# MQTT payloads may also be Sparkplug B protobuf (see sparkplug.py).
+PAYLOAD_ENCODINGS = ENCODINGS + ("sparkplug",)
+# Message type of the command acknowledgements (in place of DCMD).
+ACK_TYPE = "DACK"
+# Topic namespace of the (JSON) acknowledgements with Sparkplug payloads, as
+# everything under spBv1.0/ has to be a Sparkplug message.
+ACK_NAMESPACE = "socket-mqtt"
+# Seconds between queries of the device about while the instrument does not
+# answer.
+ABOUT_RETRY_INTERVAL = 5.0
+
 
 class SocketMqtt(object):
     """Receives messages via MQTT (e.g. a JSON object that contains an
@@ -23,12 +43,63 @@ class SocketMqtt(object):
     send to an instrument serial port to set/change a instrument parameter).
     Also, reads from a socket (such as instrument data) and tramsmitts via
     MQTT.
+    The instrument socket and the MQTT payloads may use a compact binary
+    encoding (msgpack or cbor) instead of JSON. The NBIRTH message is always
+    JSON and announces the "payload_encoding" of the NDATA messages. DCMD
+    messages are accepted as JSON or in the payload encoding.
+    Data that can not be published while the broker is unreachable is
+    stored in an outbox (in memory, spilling to spool files) and replayed
+    in order, at a limited rate, once the connection is back. Every NDATA
+    payload contains the "timestamp" of the data update, so replayed data
+    keeps its time.
+    Samples can be batched into one NDATA message (see batcher.py), which
+    then has the form
+        {"timestamp": <last>, "samples": <n>, "timestamps": [...],
+         "metrics": {<field>: [<value of each sample, None if missing>]}}
+    With report by exception, samples only contain the metrics that left
+    their deadband, plus a heartbeat of every metric (see deadband.py). The
+    NBIRTH message then contains the last full sample ("metrics") and the
+    next sample is published in full.
+    The instrument socket is used through persistent connections (see
+    instrument-client) that reconnect with backoff: commands run on a small
+    pool of connections, and the data subscription has its own connection
+    that subscribes again after every reconnect.
+    DCMD commands are queued and executed one at a time by a worker thread
+    (see dispatcher.py), so a slow instrument does not hold up the MQTT
+    traffic. A command the instrument queues is waited for (up to
+    command_wait seconds) with get_command_status. The result of every
+    command, with its queueing and execution time, is published on the
+    command topic with the message type DACK (e.g.
+    spBv1.0/<group>/DACK/<host>/<device>).
+    The device about, and the topics built from its host, are cached. The
+    about is queried again only when the data connection to the instrument
+    was reopened or the instrument_status in the data changed, and a new
+    NBIRTH message is published if it changed.
+    With the "sparkplug" payload encoding the messages are Sparkplug B
+    protobuf payloads in the Sparkplug topology: the process is the edge
+    node <host>-<device_id>, as every edge node has its own sequence numbers
+    and aliases (NBIRTH with bdSeq, NDEATH as MQTT will, NCMD for "Node
+    Control/Rebirth"), and the instrument its device (DBIRTH with the about
+    as "Properties/..." metrics and every metric's alias and data type,
+    then DDATA with only the aliases and values of the reported metrics). Every
+    message carries a sequence number. DCMD commands are then sent as JSON
+    or as a Sparkplug payload with a "command" metric holding the JSON
+    command, and acknowledged in JSON outside the Sparkplug namespace
+    (socket-mqtt/<group>/DACK/<node>/<device>).
     """
 
     def __init__(self, socket_host="", socket_port=54132,
-                 mqtt_broker="", group_id="proto", device_id="default"):
+                 mqtt_broker="", group_id="proto", device_id="default",
+                 socket_encoding="json", payload_encoding="json",
+                 outbox_size=1000, spool_dir=None, spool_files=1000,
+                 replay_rate=50.0, replay_batch=20,
+                 batch_size=1, batch_interval=0.0, flush_policies=None,
+                 report_by_exception=False, deadbands=None, heartbeat=60.0,
+                 socket_timeout=10.0, socket_pool_size=2, command_queue_size=100,
+                 command_wait=5.0):
         """Start the logger, connect to a socket and mqtt broker. Start
-        polling the socket for data and publishing on to MQTT.
+        receiving the instrument data from the socket and publishing on to
+        MQTT.
 
         Arguments:
         socket_host (str): Name of the socket host. This is the service
@@ -38,16 +109,85 @@ class SocketMqtt(object):
         mqtt_broker (str): Namre or address of the MQTT broker.
         group_id (str): MQTT Sparkplug group id.
         device_id (str): MQTT Sparkplug device id.
+        socket_encoding (str): Encoding of the instrument socket messages.
+        payload_encoding (str): Encoding of the MQTT data payloads, one of
+            PAYLOAD_ENCODINGS.
+        outbox_size (int): Number of unpublished messages kept in memory.
+        spool_dir (str): Directory to spill unpublished messages to, None
+            to keep (and drop beyond outbox_size) them in memory only.
+        spool_files (int): Maximum number of spool files of outbox_size
+            messages.
+        replay_rate (float): Maximum messages per second when replaying.
+        replay_batch (int): Number of messages replayed at once.
+        batch_size (int): Number of samples per NDATA message (1 publishes
+            every sample in its own message, as a single data dictionary).
+        batch_interval (float): Maximum time (s) a sample waits for its
+            batch to fill, 0 to wait for full batches only.
+        flush_policies (dict): Flush policies by topic or message type,
+            overriding batch_size and batch_interval (see batcher.py).
+        report_by_exception (bool): Only publish metrics that changed.
+        deadbands (dict): Deadbands of the metrics (see deadband.py).
+        heartbeat (float): Maximum time (s) a metric is not published when
+            reporting by exception, 0 for no heartbeat.
+        socket_timeout (float): Seconds to wait for a socket response.
+        socket_pool_size (int): Number of socket connections for commands.
+        command_queue_size (int): Maximum number of DCMD commands waiting
+            to be executed; further commands are rejected.
+        command_wait (float): Seconds to wait for a queued command to finish
+            before acknowledging it as "queued" (less than socket_timeout).
         """
         self._group_id = group_id
         self._device_id = device_id
         self._device_data = None
+        # Cached device about and the topics built from it.
+        self._about = None
+        self._topics = None
+        self._about_lock = threading.Lock()
+        self._socket_host = socket_host
+        self._socket_port = socket_port
         self._setup_logger()
-        self._sock = self._connect_socket(socket_host, socket_port)
+        self._check_encodings(socket_encoding, payload_encoding)
+        self._socket_encoding = socket_encoding
+        self._payload_encoding = payload_encoding
+        self._sparkplug = None
+        if payload_encoding == "sparkplug":
+            self._sparkplug = SparkplugNode()
+        self._socket_timeout = socket_timeout
+        # Requests fail after socket_timeout if the instrument is down, so
+        # that neither the MQTT callbacks nor the commands wait for it.
+        self._socket_pool = ConnectionPool(socket_host, socket_port, socket_pool_size,
+                                           encoding=socket_encoding, timeout=socket_timeout,
+                                           retry_timeout=socket_timeout, logger=self._logger)
+        self._outbox = Outbox(outbox_size, spool_dir, spool_files)
+        self._replay_rate = replay_rate
+        self._replay_batch = replay_batch
+        self._connected = threading.Event()
+        self._deadband_filter = None
+        if report_by_exception:
+            self._deadband_filter = DeadbandFilter(deadbands, heartbeat)
+        self._batcher = Batcher(self._publish_samples, batch_size, batch_interval,
+                                flush_policies)
+        self._command_wait = command_wait
+        self._dispatcher = CommandDispatcher(self._execute_command,
+                                             self._publish_command_ack, command_queue_size,
+                                             logger=self._logger)
+        # Set when an MQTT session could not be started (see on_connect).
+        self._session_pending = threading.Event()
+        if self._sparkplug is not None:
+            # The NDEATH will needs the host before connecting.
+            self._wait_for_device_about()
         client_id = group_id + device_id
         self._mqttc = self._setup_mqtt(mqtt_broker, client_id)
         self._logger.info("Instrument initiated")
 
+    def _check_encodings(self, socket_encoding, payload_encoding):
+        """Raise ValueError if an encoding is not installed."""
+        for encoding, available in ((socket_encoding, available_encodings()),
+                                    (payload_encoding, available_encodings() + ("sparkplug",))):
+            if encoding not in available:
+                self._logger.error("encoding {} is not installed".format(encoding))
+                raise ValueError("encoding {} is not available".format(encoding))
+
     def _setup_logger(self, config_file="./logger_conf.yml"):
         """Start the logger using the provided configuration file.
         """
@@ -61,29 +201,6 @@ class SocketMqtt(object):
         self._logger = logging.getLogger("socket_mqtt_logger")
         self._logger.info("socket-mqtt logger setup")
 
-    def _connect_socket(self, host, port):
-        """Connect to socket. Note that the socket is left
-        as blocking and shouldn't be modified unless a selector
-        is used.
-
-        Arguments:
-        host (string): hostname or IP address of host.
-        port (int): Socket server port number.
-
-        Returns a socket connection.
-        """
-        try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.connect((host, port))
-        except socket.error as err:
-            self._logger.error(
-                    "Failed to connect to socket {}:{}".format(host, port))
-            raise err
-        else:
-            self._logger.info(
-                    "Connected to socket host: {}, port: {}".format(host, port))
-        return sock
-
     def _setup_mqtt(self, mqtt_broker, client_id):
         """Connect to the MQTT broker and subscribe to the
         device_id command topic.
@@ -98,73 +215,221 @@ class SocketMqtt(object):
         try:
             mqttc = mqtt.Client(client_id=client_id)
             mqttc.on_connect = self._create_mqtt_on_connect()
+            mqttc.on_disconnect = self._create_mqtt_on_disconnect()
             mqttc.on_message = self._create_mqtt_on_message()
+            if self._sparkplug is not None:
+                mqttc.will_set(self._topics["NDEATH"], self._sparkplug.node_death(), qos=1)
             mqttc.connect(mqtt_broker, 1883, 10)
         except Exception as err:
             self._logger.error("Could not connect to MQTT broker")
             raise err
         else:
             self._logger.info("Connected to MQTT broker: {}".format(mqtt_broker))
-            about = self._get_device_about()
-            host = about["host"]
-            subscribe_topic = "+/+/DCMD/{}/+".format(host)
-            mqttc.subscribe(subscribe_topic)
-            self._logger.debug("set subscribe topic: {}".format(subscribe_topic))
         return mqttc
 
     def _create_mqtt_on_connect(self):
         """Create a function for the MQTT on_connect callback.
         Uses both self._group_id and self._device_id to create topic.
+        The command topic is (re)subscribed on every connection. If the
+        device about can not be queried, the session is started by run once
+        the instrument answers.
 
         Return function
         """
         def on_connect(client, userdata, flags, rc):
-            about = self._get_device_about()
-            host = about["host"]
-            topic = "spBv1.0/{}/NBIRTH/{}/{}".format(self._group_id, host, self._device_id)
-            self._mqttc.publish(topic, payload=json.dumps(about), qos=1, retain=True)
-            self._logger.debug("on_connect callback publish about")
+            if rc != 0:
+                self._logger.error("MQTT connection refused: {}".format(rc))
+                return
+            try:
+                self._start_session(client)
+            except ConnectionError as err:
+                self._logger.error("MQTT session not started: {}".format(err))
+                self._session_pending.set()
         return on_connect
 
+    def _start_session(self, client):
+        """Subscribe to the commands and publish the births of a new MQTT
+        session, then let the data be published.
+
+        Arguments:
+        client (mqtt.Client): MQTT client.
+        """
+        self._device_about()
+        client.subscribe(self._topics["DCMD"])
+        self._logger.debug("set subscribe topic: {}".format(self._topics["DCMD"]))
+        if self._sparkplug is not None:
+            client.subscribe(self._topics["NCMD"])
+        self._publish_birth(client)
+        self._logger.debug("on_connect callback publish about")
+        self._session_pending.clear()
+        self._connected.set()
+
+    def _publish_birth(self, client):
+        """Publish the NBIRTH message of the cached device about (and with
+        Sparkplug payloads the DBIRTH message of the device).
+
+        Arguments:
+        client (mqtt.Client): MQTT client.
+        """
+        if self._sparkplug is not None:
+            self._device_about()
+            if self._deadband_filter is not None:
+                self._deadband_filter.reset()
+            client.publish(self._topics["NBIRTH"], payload=self._sparkplug.node_birth(),
+                           qos=0, retain=False)
+            self._publish_device_birth(self._topics["DATA"])
+            return
+        about = dict(self._device_about())
+        about["payload_encoding"] = self._payload_encoding
+        if self._deadband_filter is not None:
+            self._deadband_filter.reset()
+            if self._device_data is not None:
+                about["metrics"] = self._device_data
+        client.publish(self._topics["NBIRTH"], payload=json.dumps(about), qos=1, retain=True)
+
+    def _create_mqtt_on_disconnect(self):
+        """Create a function for the MQTT on_disconnect callback, which
+        makes new data go to the outbox until the connection is back.
+
+        Return function
+        """
+        def on_disconnect(client, userdata, rc):
+            self._connected.clear()
+            self._session_pending.clear()
+            self._logger.warning("disconnected from MQTT broker: {}".format(rc))
+            if self._sparkplug is not None:
+                # The next session is born with the next bdSeq.
+                self._sparkplug.bd_seq = (self._sparkplug.bd_seq + 1) % 256
+                client.will_set(self._topics["NDEATH"], self._sparkplug.node_death(), qos=1)
+        return on_disconnect
+
+    def _sparkplug_node(self, topic):
+        """Returns (SparkplugNode) the Sparkplug node of a topic."""
+        return self._sparkplug
+
+    def _publish_device_birth(self, topic):
+        """Publish the Sparkplug DBIRTH message of the device of a data
+        topic.
+
+        Arguments:
+        topic (str): DDATA topic of the device.
+        """
+        payload = self._sparkplug.device_birth(self._device_id, self._device_about(),
+                                               self._device_data)
+        self._mqttc.publish(self._topics["DBIRTH"], payload=self._sparkplug.stamp(payload),
+                            qos=0, retain=False)
+
+    def _rebirth(self, client, topic):
+        """Publish the births again, as requested by a Sparkplug NCMD.
+
+        Arguments:
+        client (mqtt.Client): MQTT client.
+        topic (str): NCMD topic of the request.
+        """
+        self._publish_birth(client)
+
+    def _decode_command(self, client, message):
+        """Decode the payload of a command message.
+
+        Arguments:
+        client (mqtt.Client): MQTT client.
+        message (mqtt.MQTTMessage): Command message.
+
+        Returns the command for the instrument socket, None if there is none
+            (e.g. a Sparkplug NCMD, which is handled here).
+        """
+        # JSON clients can always send commands.
+        if message.payload.lstrip()[:1] == b"{":
+            return decode_message(message.payload, "json")
+        if self._payload_encoding != "sparkplug":
+            return decode_message(message.payload, self._payload_encoding)
+        metrics = {metric["name"]: metric["value"]
+                   for metric in decode_payload(message.payload)["metrics"]}
+        if message.topic.split("/")[2] == "NCMD":
+            if metrics.get(REBIRTH):
+                self._logger.info("rebirth requested on {}".format(message.topic))
+                self._rebirth(client, message.topic)
+            return None
+        if not isinstance(metrics.get("command"), str):
+            raise ValueError("no \"command\" metric in {}".format(metrics))
+        return json.loads(metrics["command"])
+
     def _create_mqtt_on_message(self):
         """Create a function for the MQTT on_message callback. The on_message callback
-        sends the message to the instrument socket.
+        queues the message for the command dispatcher, which sends it to the
+        instrument socket.
 
         Return function
         """
         def on_message(client, userdata, message):
-            payload = json.loads(message.payload.decode('ascii'))
+            try:
+                payload = self._decode_command(client, message)
+            except Exception as err:
+                self._logger.error("could not decode command on {}: {}".format(
+                    message.topic, err))
+                return
+            if payload is None:
+                return
             self._logger.debug("received message:\n{}".format(payload))
-            status = self._send_socket_message(payload)
+            if not self._dispatcher.submit(message.topic, payload):
+                self._logger.warning("command queue full, rejected: {}".format(payload))
         return on_message
 
-    def _send_socket_message(self, message):
+    def _publish_command_ack(self, topic, ack):
+        """Publish the acknowledgement of a DCMD command (see
+        CommandDispatcher).
+
+        Arguments:
+        topic (str): Topic the command was received on.
+        ack (dict): Acknowledgement of the command.
+        """
+        parts = topic.split("/")
+        if len(parts) > 2:
+            parts[2] = ACK_TYPE
+        encoding = self._payload_encoding
+        if encoding == "sparkplug":
+            # Sparkplug has no acknowledgement message.
+            parts[0] = ACK_NAMESPACE
+            encoding = "json"
+        self._logger.debug("command {} {} in {:.3f} s (queued {:.3f} s)".format(
+            ack["command_name"], ack["status"], ack["latency"], ack["queued"]))
+        self._mqttc.publish("/".join(parts), payload=encode_message(ack, encoding),
+                            qos=1, retain=False)
+
+    def _execute_command(self, message):
+        """Send a command to the host socket and, if the instrument queued
+        it, wait for its result.
+
+        Arguments:
+        message (dict): Command message.
+
+        Returns the response, the command status record for queued commands.
+        """
+        response = self._send_socket_message(message)
+        request = status_request(message, response, self._command_wait)
+        if request is not None:
+            response = self._send_socket_message(request, retry=True)
+        return response
+
+    def _send_socket_message(self, message, retry=False):
         """Send a message to the host socket.
 
         Arguments:
         message (JSON): Message to be sent to socket
+        retry (bool): Send the message again if the connection was lost
+            before the response arrived (only for requests that are safe to
+            repeat).
 
         Returns (JSON) The response from the socket.
         """
         received = {"status": "failed"}
         self._logger.debug("sending message to socket:\n{}".format(message))
-        message = json.dumps(message).encode('ascii')
         try:
-            self._sock.sendall(message)
+            received = self._socket_pool.request(message, retry)
         except Exception as err:
-            self._logger.error("error sending message to socket:\n{}".format(err))
+            self._logger.error("error exchanging message with socket:\n{}".format(err))
         else:
-            try:
-                received = self._sock.recv(4096)
-            except Exception as err:
-                self._logger.error("error receiving message from socket:\n{}".format(err))
-            else:
-                try:
-                    received = json.loads(received.decode('ascii'))
-                    self._logger.debug("received message from socket:\n{}".format(received))
-                except Exception as err:
-                    self._logger.error("error decoding response: {}".format(
-                        received.decode('ascii')))
+            self._logger.debug("received message from socket:\n{}".format(received))
         return received
 
     def _get_device_data(self):
@@ -180,7 +445,7 @@ class SocketMqtt(object):
                 "parameters": None
             }
         }
-        data = self._send_socket_message(message)
+        data = self._send_socket_message(message, retry=True)
         self._logger.debug("retrived device data: {}".format(data))
         return data
 
@@ -197,31 +462,286 @@ class SocketMqtt(object):
                     "parameters": None
                 }
         }
-        about = self._send_socket_message(message)
+        about = self._send_socket_message(message, retry=True)
         self._logger.debug("retrived device about: {}".format(about))
         return about
 
+    def _device_about(self):
+        """Get the cached device "about", querying the instrument only if
+        nothing is cached. Concurrent callers share one query.
+
+        Returns (dict) the "about" instrument parameters.
+        """
+        with self._about_lock:
+            if self._about is None:
+                about = self._get_device_about()
+                if "host" not in about:
+                    raise ConnectionError("could not get device about: {}".format(about))
+                node_id = about["host"]
+                if self._payload_encoding == "sparkplug":
+                    # Other processes may publish devices of the same host.
+                    node_id = "{}-{}".format(node_id, self._device_id)
+                self._topics = self._device_topics(node_id, self._device_id)
+                self._about = about
+            return self._about
+
+    def _device_topics(self, host, device_id):
+        """Get the MQTT topics of a device: "DCMD" (subscription of the
+        commands of the host), "NBIRTH" and "DATA", and with Sparkplug
+        payloads "NDEATH", "NCMD" and "DBIRTH".
+
+        Arguments:
+        host (str): Host of the device about, or with Sparkplug payloads
+            the edge node id.
+        device_id (str): Device id.
+
+        Returns (dict) the topics by message type.
+        """
+        node = "spBv1.0/{}/{{}}/{}".format(self._group_id, host)
+        if self._payload_encoding != "sparkplug":
+            return {
+                "DCMD": "+/+/DCMD/{}/+".format(host),
+                "NBIRTH": node.format("NBIRTH") + "/" + device_id,
+                "DATA": node.format("NDATA") + "/" + device_id
+            }
+        return {
+            "DCMD": "+/+/DCMD/{}/+".format(host),
+            "NBIRTH": node.format("NBIRTH"),
+            "NDEATH": node.format("NDEATH"),
+            "NCMD": node.format("NCMD"),
+            "DBIRTH": node.format("DBIRTH") + "/" + device_id,
+            "DATA": node.format("DDATA") + "/" + device_id
+        }
+
+    def _refresh_about(self):
+        """Invalidate the cached device about and query it again. If it
+        changed, the command topic is resubscribed (for a new host) and a
+        new NBIRTH message is published.
+        """
+        with self._about_lock:
+            old_about, old_topics = self._about, self._topics
+            self._about = None
+        try:
+            about = self._device_about()
+        except ConnectionError as err:
+            # Keep publishing with the previous about.
+            with self._about_lock:
+                if self._about is None:
+                    self._about, self._topics = old_about, old_topics
+            self._logger.warning("could not refresh the device about: {}".format(err))
+            return
+        if about == old_about:
+            return
+        self._logger.info("device about changed: {}".format(about))
+        if self._connected.is_set():
+            for message_type in ("DCMD", "NCMD"):
+                if (old_topics is not None and message_type in old_topics
+                        and old_topics[message_type] != self._topics[message_type]):
+                    self._mqttc.unsubscribe(old_topics[message_type])
+                    self._mqttc.subscribe(self._topics[message_type])
+            self._publish_birth(self._mqttc)
+
+    def _wait_for_device_about(self):
+        """Get the device about, querying the instrument every
+        ABOUT_RETRY_INTERVAL seconds until it answers.
+
+        Returns (dict) the "about" instrument parameters.
+        """
+        while True:
+            try:
+                return self._device_about()
+            except ConnectionError as err:
+                self._logger.warning("{}, retry in {} s".format(err, ABOUT_RETRY_INTERVAL))
+                sleep(ABOUT_RETRY_INTERVAL)
+
+    def _subscribe_device_data(self):
+        """Open a connection that is subscribed to the instrument data, so
+        that every data update is pushed by the instrument instead of being
+        polled. The subscription is renewed whenever the connection is
+        reopened, and the device about is refreshed, as the instrument may
+        have been restarted. Command requests keep using the connection
+        pool.
+
+        Returns (Connection) the subscribed connection.
+        """
+        reconnect = []
+
+        def subscribe(connection):
+            message = {
+                "user": None,
+                "password": None,
+                "command": {
+                    "command_name": "subscribe",
+                    "parameters": None
+                }
+            }
+            received = connection.request(message)
+            if not received.get("subscribed"):
+                self._logger.error("subscription refused: {}".format(received))
+                raise ConnectionError("could not subscribe to device data")
+            self._logger.info("subscribed to device data")
+            if reconnect:
+                self._refresh_about()
+            reconnect.append(True)
+
+        connection = Connection(self._socket_host, self._socket_port,
+                                encoding=self._socket_encoding, timeout=self._socket_timeout,
+                                on_connect=subscribe, logger=self._logger)
+        connection.connect()
+        return connection
+
+    def _receive_device_data(self, connection):
+        """Wait for the next data update pushed by the instrument.
+
+        Arguments:
+        connection (Connection): Connection subscribed to the device data.
+
+        Returns JSON of device data, with the "timestamp" of the update.
+        """
+        while True:
+            received = connection.receive()
+            if received.get("push") == "data":
+                self._logger.debug("received device data version {}".format(
+                    received["version"]))
+                data = dict(received["data"])
+                data["timestamp"] = received["timestamp"]
+                return data
+
+    def _publish_data(self, topic, payload):
+        """Publish a data payload, or store it in the outbox while the
+        broker is unreachable or older data is still waiting to be replayed
+        (so the data stays in order).
+
+        Arguments:
+        topic (str): MQTT topic.
+        payload (bytes): MQTT payload.
+        """
+        if self._connected.is_set() and not self._outbox.pending():
+            info = self._mqttc.publish(topic, payload=self._stamp(topic, payload),
+                                       qos=0, retain=False)
+            if info.rc == mqtt.MQTT_ERR_SUCCESS:
+                return
+            self._connected.clear()
+        self._outbox.put(topic, payload)
+
+    def _stamp(self, topic, payload):
+        """Give a Sparkplug payload its sequence number right before it is
+        published (so replayed data follows the current NBIRTH).
+
+        Arguments:
+        topic (str): MQTT topic.
+        payload (bytes): MQTT payload.
+
+        Returns (bytes) the payload to publish.
+        """
+        if self._payload_encoding != "sparkplug":
+            return payload
+        return self._sparkplug_node(topic).stamp(payload)
+
+    def _publish_samples(self, topic, samples, batched):
+        """Encode and publish a batch of data samples (see Batcher).
+
+        Arguments:
+        topic (str): MQTT topic.
+        samples (list): Data samples, oldest first.
+        batched (bool): False to publish the single sample as is.
+        """
+        if self._payload_encoding == "sparkplug":
+            # Every metric of a DDATA message has its own timestamp.
+            node = self._sparkplug_node(topic)
+            payload, rebirth = node.device_data(topic.split("/")[4], samples)
+            if rebirth and self._connected.is_set():
+                self._publish_device_birth(topic)
+            self._publish_data(topic, payload)
+            return
+        if batched:
+            payload = self._batch_payload(samples)
+        else:
+            payload = samples[0]
+        self._publish_data(topic, encode_message(payload, self._payload_encoding))
+
+    def _batch_payload(self, samples):
+        """Combine data samples into one payload of metric arrays.
+
+        Arguments:
+        samples (list): Data samples (with "timestamp"), oldest first.
+
+        Returns (dict) the payload (see class description).
+        """
+        metrics = {}
+        for index, sample in enumerate(samples):
+            for field, value in sample.items():
+                if field == "timestamp":
+                    continue
+                if field not in metrics:
+                    metrics[field] = [None] * len(samples)
+                metrics[field][index] = value
+        return {
+            "timestamp": samples[-1]["timestamp"],
+            "samples": len(samples),
+            "timestamps": [sample["timestamp"] for sample in samples],
+            "metrics": metrics
+        }
+
+    def _replay_outbox(self):
+        """Publish the messages of the outbox whenever the broker is
+        connected, in batches of replay_batch messages at no more than
+        replay_rate messages per second. Runs in its own thread.
+        """
+        while True:
+            self._connected.wait()
+            batch = self._outbox.get_batch(self._replay_batch)
+            if not batch:
+                sleep(0.1)
+                continue
+            for index, (topic, payload) in enumerate(batch):
+                info = self._mqttc.publish(topic, payload=self._stamp(topic, payload),
+                                           qos=1, retain=False)
+                if info.rc != mqtt.MQTT_ERR_SUCCESS:
+                    self._logger.warning("replay interrupted: {}".format(info.rc))
+                    self._outbox.done(index)
+                    self._outbox.requeue(batch[index:])
+                    self._connected.clear()
+                    break
+            else:
+                self._outbox.done(len(batch))
+                self._logger.debug("replayed {} messages".format(len(batch)))
+            sleep(len(batch) / self._replay_rate)
+
     def run(self):
         """Start the MQTT service loop; send the instrument startup information,
-        then start infinite loop sending instrument data.
+        then start infinite loop sending instrument data as the instrument
+        pushes it.
         """
+        # Cache the about (and topics) before MQTT (re)connects need it.
+        self._wait_for_device_about()
         self._logger.info("Starting MQTT Loop")
         self._mqttc.loop_start()
-        # Create the publish topic outside loop
-        about = self._get_device_about()
-        host = about["host"]
-        topic = "spBv1.0/{}/NDATA/{}/{}".format(self._group_id, host,
-            self._device_id)
-        # Wait to finsish request about device
-        sleep(2)
+        data_connection = self._subscribe_device_data()
+        replay_thread = threading.Thread(target=self._replay_outbox, daemon=True)
+        replay_thread.start()
         while True:
             # get instrument data
-            data = self._get_device_data()
+            data = self._receive_device_data(data_connection)
+            self._device_data = data
+            about = self._about
+            if about is None or data.get("instrument_status") != about.get("instrument_status"):
+                self._refresh_about()
+            if self._session_pending.is_set():
+                self._session_pending.clear()
+                try:
+                    self._start_session(self._mqttc)
+                except ConnectionError as err:
+                    self._logger.error("MQTT session not started: {}".format(err))
+                    self._session_pending.set()
+            if self._deadband_filter is not None:
+                data = self._deadband_filter.filter(data)
+                if data is None:
+                    continue
+            topic = self._topics["DATA"]
             self._logger.debug("publishing:\n topic: {}\n data: {}"
                 .format(topic, data))
-            self._mqttc.publish(topic, payload=json.dumps(data), qos=0,
-                retain=False)
-            sleep(5)
+            self._batcher.add(topic, data)
 
 
 if __name__ == "__main__":
@@ -256,7 +776,132 @@ if __name__ == "__main__":
         type=str,
         default="fake"
     )
+    parser.add_argument(
+        "--socket_encoding",
+        help="encoding of the instrument socket messages",
+        choices=ENCODINGS,
+        default="json"
+    )
+    parser.add_argument(
+        "--payload_encoding",
+        help="encoding of the MQTT data payloads (sparkplug: Sparkplug B protobuf)",
+        choices=PAYLOAD_ENCODINGS,
+        default="json"
+    )
+    parser.add_argument(
+        "--outbox_size",
+        help="number of unpublished messages kept in memory",
+        type=int,
+        default=1000
+    )
+    parser.add_argument(
+        "--spool_dir",
+        help="directory to spill unpublished messages to (default none)",
+        type=str,
+        default=None
+    )
+    parser.add_argument(
+        "--spool_files",
+        help="maximum number of spool files",
+        type=int,
+        default=1000
+    )
+    parser.add_argument(
+        "--replay_rate",
+        help="maximum messages per second when replaying unpublished messages",
+        type=float,
+        default=50.0
+    )
+    parser.add_argument(
+        "--replay_batch",
+        help="number of unpublished messages replayed at once",
+        type=int,
+        default=20
+    )
+    parser.add_argument(
+        "--batch_size",
+        help="number of data samples published in one NDATA message",
+        type=int,
+        default=1
+    )
+    parser.add_argument(
+        "--batch_interval",
+        help="maximum seconds a sample waits for its batch to fill (0 waits for full batches)",
+        type=float,
+        default=0.0
+    )
+    parser.add_argument(
+        "--flush_policies",
+        help='flush policies by topic or message type as JSON (e.g. \'{"NDATA": {"max_samples": 50, "max_age": 1.0}}\')',
+        type=json.loads,
+        default=None
+    )
+    parser.add_argument(
+        "--report_by_exception",
+        help="only publish the metrics that changed (see --deadbands)",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--deadbands",
+        help='deadbands per metric as JSON (e.g. \'{"PV_speed": {"absolute": 0.5}, "*": {"percent": 1}}\')',
+        type=json.loads,
+        default=None
+    )
+    parser.add_argument(
+        "--heartbeat",
+        help="maximum seconds a metric is not published when reporting by exception",
+        type=float,
+        default=60.0
+    )
+    parser.add_argument(
+        "--socket_timeout",
+        help="seconds to wait for a response of the instrument socket",
+        type=float,
+        default=10.0
+    )
+    parser.add_argument(
+        "--socket_pool_size",
+        help="number of instrument socket connections used for commands",
+        type=int,
+        default=2
+    )
+    parser.add_argument(
+        "--command_queue_size",
+        help="maximum number of MQTT commands waiting for the instrument",
+        type=int,
+        default=100
+    )
+    parser.add_argument(
+        "--command_wait",
+        help="seconds to wait for a queued command to finish before acknowledging it",
+        type=float,
+        default=5.0
+    )
+    parser.add_argument(
+        "--instruments",
+        help='bridge several instrument sockets as JSON, replacing --socket_host, --socket_port and --device_id (e.g. \'[{"socket_host": "fake", "socket_port": 54132, "device_id": "fake"}]\')',
+        type=json.loads,
+        default=None
+    )
     args = parser.parse_args()
-    socket_mqtt = SocketMqtt(args.socket_host, args.socket_port,
-                             args.mqtt_broker, args.group_id, args.device_id)
-    socket_mqtt.run()
+    if args.instruments:
+        from bridge import MqttBridge
+        bridge = MqttBridge(args.instruments, args.mqtt_broker, args.group_id,
+                            args.socket_encoding, args.payload_encoding,
+                            args.outbox_size, args.spool_dir, args.spool_files,
+                            args.replay_rate, args.replay_batch,
+                            args.batch_size, args.batch_interval, args.flush_policies,
+                            args.report_by_exception, args.deadbands, args.heartbeat,
+                            args.socket_timeout, args.command_queue_size, args.command_wait)
+        bridge.run()
+    else:
+        socket_mqtt = SocketMqtt(args.socket_host, args.socket_port,
+                                 args.mqtt_broker, args.group_id, args.device_id,
+                                 args.socket_encoding, args.payload_encoding,
+                                 args.outbox_size, args.spool_dir, args.spool_files,
+                                 args.replay_rate, args.replay_batch,
+                                 args.batch_size, args.batch_interval, args.flush_policies,
+                                 args.report_by_exception, args.deadbands, args.heartbeat,
+                                 args.socket_timeout, args.socket_pool_size,
+                                 args.command_queue_size, args.command_wait)
+        socket_mqtt.run()
@@ -0,0 +1,363 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Sparkplug B payloads of the MQTT messages. The Payload and Metric messages
+of sparkplug_b.proto are written and read directly in the protobuf wire
+format, so no generated code or protobuf package is needed.
+"""
+import json
+import struct
+import threading
+from time import time
+
+__author__ = "Brent Maranzano"
+__license__ = "MIT"
+
+# Sparkplug B data types (the subset used).
+INT64 = 4
+UINT64 = 8
+DOUBLE = 10
+BOOLEAN = 11
+STRING = 12
+DOUBLE_ARRAY = 31
+
+# Field numbers of the Payload message.
+PAYLOAD_TIMESTAMP = 1
+PAYLOAD_METRICS = 2
+PAYLOAD_SEQ = 3
+# Field numbers of the Metric message.
+METRIC_NAME = 1
+METRIC_ALIAS = 2
+METRIC_TIMESTAMP = 3
+METRIC_DATATYPE = 4
+METRIC_IS_NULL = 7
+METRIC_INT = 10
+METRIC_LONG = 11
+METRIC_FLOAT = 12
+METRIC_DOUBLE = 13
+METRIC_BOOLEAN = 14
+METRIC_STRING = 15
+METRIC_BYTES = 16
+
+BD_SEQ = "bdSeq"
+REBIRTH = "Node Control/Rebirth"
+# Prefix of the metrics of the device about in DBIRTH.
+PROPERTIES = "Properties/"
+
+_DOUBLE = struct.Struct("<d")
+_FLOAT = struct.Struct("<f")
+
+
+def _varint(value):
+    """Returns (bytes) the protobuf varint of a non-negative integer."""
+    data = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            data.append(byte | 0x80)
+        else:
+            data.append(byte)
+            return bytes(data)
+
+
+def _field_varint(field, value):
+    return _varint(field << 3) + _varint(value)
+
+
+def _field_bytes(field, data):
+    return _varint(field << 3 | 2) + _varint(len(data)) + data
+
+
+def _field_double(field, value):
+    return _varint(field << 3 | 1) + _DOUBLE.pack(value)
+
+
+def datatype(value):
+    """Get the Sparkplug data type a value is published as: numbers as
+    Double, lists of numbers as DoubleArray, other values as String (JSON
+    for lists and dictionaries).
+
+    Arguments
+    value: Metric value.
+
+    Returns (int) the data type, None for a None value.
+    """
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return BOOLEAN
+    if isinstance(value, (int, float)):
+        return DOUBLE
+    if (isinstance(value, (list, tuple)) and value
+            and all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in value)):
+        return DOUBLE_ARRAY
+    return STRING
+
+
+def encode_metric(name, alias, timestamp, data_type, value, birth=False):
+    """Serialize a Metric message.
+
+    Arguments
+    name (str): Metric name, None to only send the alias.
+    alias (int): Metric alias, None for none.
+    timestamp (float): Time (epoch s) of the value, None for none.
+    data_type (int): Data type the value is converted to.
+    value: Value (None, or a value that does not fit the data type, is
+        written as null).
+    birth (bool): Write the data type (in births).
+
+    Returns (bytes) the metric.
+    """
+    data = b""
+    if name is not None:
+        data += _field_bytes(METRIC_NAME, name.encode("UTF-8"))
+    if alias is not None:
+        data += _field_varint(METRIC_ALIAS, alias)
+    if timestamp is not None:
+        data += _field_varint(METRIC_TIMESTAMP, int(timestamp * 1000))
+    if birth:
+        data += _field_varint(METRIC_DATATYPE, data_type)
+    if data_type in (INT64, UINT64) and isinstance(value, int) and not isinstance(value, bool):
+        return data + _field_varint(METRIC_LONG, value & 0xFFFFFFFFFFFFFFFF)
+    if data_type == STRING and value is not None:
+        if not isinstance(value, str):
+            value = json.dumps(value)
+        return data + _field_bytes(METRIC_STRING, value.encode("UTF-8"))
+    value_type = datatype(value)
+    if value_type is None or value_type != data_type:
+        return data + _field_varint(METRIC_IS_NULL, 1)
+    if value_type == DOUBLE:
+        return data + _field_double(METRIC_DOUBLE, float(value))
+    if value_type == BOOLEAN:
+        return data + _field_varint(METRIC_BOOLEAN, int(value))
+    return data + _field_bytes(METRIC_BYTES, struct.pack("<{}d".format(len(value)), *value))
+
+
+def encode_payload(metrics, timestamp=None, seq=None):
+    """Serialize a Payload message.
+
+    Arguments
+    metrics (list): Serialized metrics (see encode_metric).
+    timestamp (float): Time (epoch s) of the payload.
+    seq (int): Sequence number, None to leave it to stamp.
+
+    Returns (bytes) the payload.
+    """
+    data = b""
+    if timestamp is not None:
+        data += _field_varint(PAYLOAD_TIMESTAMP, int(timestamp * 1000))
+    data += b"".join(_field_bytes(PAYLOAD_METRICS, metric) for metric in metrics)
+    if seq is not None:
+        data += _field_varint(PAYLOAD_SEQ, seq)
+    return data
+
+
+def _fields(data):
+    """Iterate over the (field, wire type, value) of a protobuf message."""
+    offset = 0
+    while offset < len(data):
+        key, offset = _read_varint(data, offset)
+        field, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, offset = _read_varint(data, offset)
+        elif wire_type == 1:
+            value, offset = data[offset:offset + 8], offset + 8
+        elif wire_type == 2:
+            size, offset = _read_varint(data, offset)
+            value, offset = data[offset:offset + size], offset + size
+        elif wire_type == 5:
+            value, offset = data[offset:offset + 4], offset + 4
+        else:
+            raise ValueError("unsupported protobuf wire type {}".format(wire_type))
+        yield field, wire_type, value
+
+
+def _read_varint(data, offset):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, offset
+        shift += 7
+
+
+def decode_payload(payload):
+    """Deserialize a Payload message (e.g. of an NCMD or DCMD message).
+
+    Arguments
+    payload (bytes): Serialized payload.
+
+    Returns (dict) the "timestamp" (ms), "seq" and "metrics", a list of
+        dictionaries with the "name", "alias", "timestamp", "datatype" and
+        "value" of each metric.
+    """
+    decoded = {"timestamp": None, "seq": None, "metrics": []}
+    for field, _, value in _fields(bytes(payload)):
+        if field == PAYLOAD_TIMESTAMP:
+            decoded["timestamp"] = value
+        elif field == PAYLOAD_SEQ:
+            decoded["seq"] = value
+        elif field == PAYLOAD_METRICS:
+            decoded["metrics"].append(_decode_metric(value))
+    return decoded
+
+
+def _decode_metric(data):
+    metric = {"name": None, "alias": None, "timestamp": None, "datatype": None, "value": None}
+    for field, _, value in _fields(data):
+        if field == METRIC_NAME:
+            metric["name"] = value.decode("UTF-8")
+        elif field == METRIC_ALIAS:
+            metric["alias"] = value
+        elif field == METRIC_TIMESTAMP:
+            metric["timestamp"] = value
+        elif field == METRIC_DATATYPE:
+            metric["datatype"] = value
+        elif field in (METRIC_INT, METRIC_LONG):
+            metric["value"] = value
+        elif field == METRIC_FLOAT:
+            metric["value"] = _FLOAT.unpack(value)[0]
+        elif field == METRIC_DOUBLE:
+            metric["value"] = _DOUBLE.unpack(value)[0]
+        elif field == METRIC_BOOLEAN:
+            metric["value"] = bool(value)
+        elif field == METRIC_STRING:
+            metric["value"] = value.decode("UTF-8")
+        elif field == METRIC_BYTES:
+            metric["value"] = value
+    if metric["datatype"] == DOUBLE_ARRAY and isinstance(metric["value"], bytes):
+        metric["value"] = list(struct.unpack("<{}d".format(len(metric["value"]) // 8),
+                                             metric["value"]))
+    return metric
+
+
+class SparkplugNode(object):
+    """Sparkplug B state of an edge node (a host) and its devices:
+        1. The metrics of the devices get aliases, unique in the node, when
+           they are first seen. DBIRTH messages carry the name, alias, data
+           type and value of every metric; DDATA messages only the alias
+           and value of the reported metrics (and their timestamp, if it is
+           not the one of the payload, e.g. in batches).
+        2. A metric that is new, or whose data type changed, requires a new
+           DBIRTH of its device before the DDATA that contains it.
+        3. Every message gets the next sequence number (0 to 255) when it
+           is published (stamp), so data replayed after a reconnect follows
+           the new NBIRTH (seq 0) in order.
+        4. bd_seq is the birth/death sequence number of the MQTT session
+           (in NBIRTH and in the NDEATH will).
+    """
+
+    def __init__(self):
+        # (alias, data type) by (device, metric name).
+        self._metrics = {}
+        self._next_alias = 1
+        self._seq = 0
+        self.bd_seq = 0
+        self._lock = threading.Lock()
+
+    def node_birth(self):
+        """Returns (bytes) the NBIRTH payload (seq 0)."""
+        with self._lock:
+            self._seq = 0
+            now = time()
+            metrics = [
+                encode_metric(BD_SEQ, None, now, UINT64, self.bd_seq, birth=True),
+                encode_metric(REBIRTH, None, now, BOOLEAN, False, birth=True)
+            ]
+            return encode_payload(metrics, now, 0)
+
+    def node_death(self):
+        """Returns (bytes) the NDEATH payload (the MQTT will)."""
+        now = time()
+        return encode_payload([encode_metric(BD_SEQ, None, now, UINT64, self.bd_seq, birth=True)],
+                              now)
+
+    def device_birth(self, device, about, data):
+        """Create the DBIRTH payload of a device (to be stamped).
+
+        Arguments
+        device (str): Device id.
+        about (dict): Device about, published as "Properties/<key>".
+        data (dict): Latest data sample (with "timestamp"), None if there
+            is none yet.
+
+        Returns (bytes) the payload.
+        """
+        now = time()
+        data = data or {}
+        timestamp = data.get("timestamp", now)
+        with self._lock:
+            self._register(device, data)
+            metrics = [encode_metric(PROPERTIES + key, None, now,
+                                     datatype(value) or STRING, value, birth=True)
+                       for key, value in sorted(about.items())]
+            for (metric_device, name), (alias, data_type) in self._metrics.items():
+                if metric_device == device:
+                    metrics.append(encode_metric(name, alias, timestamp, data_type,
+                                                 data.get(name), birth=True))
+        return encode_payload(metrics, now)
+
+    def device_data(self, device, samples):
+        """Create the DDATA payload of data samples (to be stamped).
+
+        Arguments
+        device (str): Device id.
+        samples (list): Data samples (with "timestamp"), oldest first.
+
+        Returns (bytes, bool) the payload and True if the device has to be
+            born again first (see class description).
+        """
+        metrics = []
+        payload_timestamp = samples[-1].get("timestamp", time())
+        with self._lock:
+            rebirth = False
+            for sample in samples:
+                rebirth = self._register(device, sample) or rebirth
+                # Metrics of the payload timestamp go without their own.
+                timestamp = sample.get("timestamp")
+                if timestamp == payload_timestamp:
+                    timestamp = None
+                for name, value in sample.items():
+                    if name == "timestamp":
+                        continue
+                    alias, data_type = self._metrics[(device, name)]
+                    metrics.append(encode_metric(None, alias, timestamp, data_type, value))
+        return encode_payload(metrics, payload_timestamp), rebirth
+
+    def stamp(self, payload):
+        """Give a payload the next sequence number.
+
+        Arguments
+        payload (bytes): Payload without sequence number.
+
+        Returns (bytes) the payload with sequence number.
+        """
+        with self._lock:
+            self._seq = (self._seq + 1) % 256
+            return payload + _field_varint(PAYLOAD_SEQ, self._seq)
+
+    def _register(self, device, sample):
+        """Give the new metrics of a sample an alias and record the data
+        type of its metrics. Called with the lock held.
+
+        Returns (bool) True if a metric is new or changed its data type.
+        """
+        changed = False
+        for name, value in sample.items():
+            if name == "timestamp":
+                continue
+            key = (device, name)
+            data_type = datatype(value)
+            known = self._metrics.get(key)
+            if known is None:
+                self._metrics[key] = (self._next_alias, data_type or STRING)
+                self._next_alias += 1
+                changed = True
+            elif data_type is not None and data_type != known[1]:
+                self._metrics[key] = (known[0], data_type)
+                changed = True
+        return changed